@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# micro-benchmark: compiled blacklist matchers vs. the old nested loops
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from picdescbot import common  # noqa: E402
+
+WORDS = ['river', 'bridge', 'mountain', 'harbour', 'station', 'museum', 'park',
+         'building', 'portrait', 'street', 'village', 'castle', 'lake', 'train',
+         'ship', 'flower', 'tree', 'bird', 'market', 'festival']
+
+
+def random_title(rng, words=4):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).title()
+
+
+def make_page(rng, categories, usages):
+    "Build a fake (clean) page, as returned by the MediaWiki API"
+    return {'title': 'File:%s.jpg' % random_title(rng),
+            'categories': [{'title': 'Category:' + random_title(rng)}
+                           for i in range(categories)],
+            'globalusage': [{'title': random_title(rng, 6)}
+                            for i in range(usages)],
+            'description': ' '.join(rng.choice(WORDS) for i in range(60))}
+
+
+def make_dirty_page(rng, categories, usages):
+    """Build a fake page that exactly one blacklist entry should reject.
+    Returns the page and the (field, rule) that should reject it."""
+    page = make_page(rng, categories, usages)
+    word_filter = common.word_filter
+    badword = rng.choice(sorted(word_filter.blacklist))
+    # Entries that aren't caught by the word filter as well, so there's only
+    # one right answer to which rule rejects the page
+    phrase = rng.choice(sorted(phrase for phrase in common.blacklisted_phrases
+                               if not word_filter.blacklisted(phrase)))
+    category = rng.choice(sorted(category for category in common.category_blacklist
+                                 if not word_filter.blacklisted(category)))
+    field, rule = rng.choice([('title', 'badword'), ('description', 'badword'),
+                              ('description', 'phrase'), ('categories', 'category'),
+                              ('usage', 'badword'), ('usage', 'category')])
+    if field == 'title':
+        page['title'] = 'File:{0} {1}.jpg'.format(random_title(rng, 2), badword)
+    elif field == 'description':
+        page['description'] += ' ' + (badword if rule == 'badword' else phrase)
+    elif field == 'categories':
+        page['categories'].insert(rng.randrange(categories + 1),
+                                  {'title': 'Category:' + category.title()})
+    else:
+        # The old check matched blacklisted categories in page titles case
+        # sensitively, and the category blacklist is in lower case
+        text = badword if rule == 'badword' else category
+        page['globalusage'].insert(rng.randrange(usages + 1),
+                                   {'title': 'History of ' + text})
+    return page, (field, rule)
+
+
+def legacy(page):
+    """The checks as they were done before the matchers, nested loops and all.
+    Returns the (field, rule) that rejected the page, or None."""
+    word_filter = common.word_filter
+    if word_filter.blacklisted(page['title']):
+        return ('title', 'badword')
+    description = page['description']
+    if word_filter.blacklisted(description):
+        return ('description', 'badword')
+    for phrase in common.blacklisted_phrases:
+        if phrase in description.lower().strip():
+            return ('description', 'phrase')
+    for blacklisted_category in common.category_blacklist:
+        for category in page['categories']:
+            if blacklisted_category in category['title'].lower():
+                return ('categories', 'category')
+    for wikipage in page['globalusage']:
+        if word_filter.blacklisted(wikipage['title'].lower()):
+            return ('usage', 'badword')
+        for blacklisted_category in common.category_blacklist:
+            if blacklisted_category in wikipage['title']:
+                return ('usage', 'category')
+    return None
+
+
+def compiled(page):
+    "The same checks, using the compiled matchers"
+    filters = common.get_filters()
+    match = filters['text'].search(page['title'])
+    if match:
+        return ('title', match.rule)
+    match = filters['description'].search(page['description'])
+    if match:
+        return ('description', match.rule)
+    hit = filters['categories'].search_many(c['title'] for c in page['categories'])
+    if hit:
+        return ('categories', hit[1].rule)
+    hit = filters['usage'].search_many(u['title'] for u in page['globalusage'])
+    if hit:
+        return ('usage', hit[1].rule)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the blacklist matchers')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--categories', type=int, default=30)
+    parser.add_argument('--usages', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    pages = [make_page(rng, args.categories, args.usages)
+             for i in range(args.pages)]
+    common.get_filters()  # don't count compiling the matchers
+
+    # Both have to reject the same pages, for the same reasons
+    for page in pages:
+        assert legacy(page) is None and compiled(page) is None
+    for i in range(args.pages):
+        page, expected = make_dirty_page(rng, args.categories, args.usages)
+        assert legacy(page) == compiled(page) == expected, (page['title'], expected)
+
+    print("{0} pages, {1} categories and {2} global usages each".format(
+        args.pages, args.categories, args.usages))
+    for func in (legacy, compiled):
+        best = min(timeit.repeat(lambda: [func(page) for page in pages],
+                                 number=1, repeat=args.repeat))
+        print("{0:>10}: {1:8.2f} ms total, {2:8.1f} us/page".format(
+            func.__name__, best * 1000, best * 1e6 / len(pages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# benchmark for building a candidate index from synthetic Commons dumps, and sampling from it
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import gzip
+import logging
+import os.path
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from picdescbot import dumpindex  # noqa: E402
+
+# Rows per INSERT statement, about what mysqldump does for these tables
+ROWS_PER_INSERT = 1000
+
+IMAGE_TABLE = """CREATE TABLE `image` (
+  `img_name` varbinary(255) NOT NULL DEFAULT '',
+  `img_size` bigint(20) unsigned NOT NULL DEFAULT 0,
+  `img_width` int(11) NOT NULL DEFAULT 0,
+  `img_height` int(11) NOT NULL DEFAULT 0,
+  `img_metadata` mediumblob NOT NULL,
+  `img_bits` int(11) NOT NULL DEFAULT 0,
+  `img_media_type` enum('UNKNOWN','BITMAP','DRAWING','AUDIO','VIDEO','MULTIMEDIA','OFFICE','TEXT','EXECUTABLE','ARCHIVE','3D') DEFAULT NULL,
+  PRIMARY KEY (`img_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+"""
+
+PAGE_TABLE = """CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `page_namespace` int(11) NOT NULL DEFAULT 0,
+  `page_title` varbinary(255) NOT NULL DEFAULT '',
+  PRIMARY KEY (`page_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+"""
+
+CATEGORYLINKS_TABLE = """CREATE TABLE `categorylinks` (
+  `cl_from` int(10) unsigned NOT NULL DEFAULT 0,
+  `cl_to` varbinary(255) NOT NULL DEFAULT '',
+  `cl_sortkey` varbinary(230) NOT NULL DEFAULT '',
+  `cl_type` enum('page','subcat','file') NOT NULL DEFAULT 'page',
+  PRIMARY KEY (`cl_from`,`cl_to`)
+) ENGINE=InnoDB DEFAULT CHARSET=binary;
+"""
+
+CATEGORIES = ['Boats', 'Harbours', 'Flowers', 'Castles', 'Logos_of_companies', 'Trains']
+
+
+def _write_dump(path, table, create, rows):
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) as f:
+        f.write(create)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == ROWS_PER_INSERT:
+                f.write("INSERT INTO `{0}` VALUES {1};\n".format(table, ','.join(batch)))
+                batch = []
+        if batch:
+            f.write("INSERT INTO `{0}` VALUES {1};\n".format(table, ','.join(batch)))
+
+
+def synthesize(path, count, seed=0):
+    """Write image, page and categorylinks dumps with `count` files, some of
+    them drawings, tiny, PDFs, or in a blacklisted category."""
+    rng = random.Random(seed)
+    files = []
+    for i in range(count):
+        extension = rng.choice(['jpg', 'jpg', 'jpg', 'png', 'pdf'])
+        name = "Picture_{0}_of_a_boat\\'s_harbour.{1}".format(i, extension)
+        files.append((i + 1, name, rng.choice(['BITMAP', 'BITMAP', 'BITMAP', 'DRAWING']),
+                      rng.choice([30, 800, 1200, 4000])))
+    dumps = {table: os.path.join(path, table + '.sql.gz')
+             for table in ('image', 'page', 'categorylinks')}
+    _write_dump(dumps['image'], 'image', IMAGE_TABLE,
+                ("('{0}',{1},{2},{3},'a:0:{{}}',8,'{4}')".format(name, rng.randint(1000, 10**7),
+                                                                 width, width * 3 // 4, media_type)
+                 for page_id, name, media_type, width in files))
+    _write_dump(dumps['page'], 'page', PAGE_TABLE,
+                ("({0},6,'{1}')".format(page_id, name) for page_id, name, media_type, width in files))
+    _write_dump(dumps['categorylinks'], 'categorylinks', CATEGORYLINKS_TABLE,
+                ("({0},'{1}','{2}','file')".format(page_id, rng.choice(CATEGORIES), 'KEY')
+                 for page_id, name, media_type, width in files))
+    return dumps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building and sampling a candidate index')
+    parser.add_argument('--files', type=int, default=200000,
+                        help='How many files the synthetic dumps have')
+    parser.add_argument('--samples', type=int, default=100000)
+    args = parser.parse_args()
+
+    # Progress messages would drown the results
+    logging.getLogger('').addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dumps = synthesize(tmp, args.files)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        indexed = dumpindex.build(os.path.join(tmp, 'candidates.idx'), dumps['image'],
+                                  dumps['page'], dumps['categorylinks'])
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        size = os.path.getsize(os.path.join(tmp, 'candidates.idx'))
+        print("build:")
+        print("  files/sec                : {0:8.0f}".format(args.files / elapsed))
+        print("  indexed                  : {0:8d} of {1}".format(indexed, args.files))
+        print("  index size               : {0:8.1f} KB".format(size / 1024))
+        print("  peak RSS growth          : {0:8.1f} MB".format((after - before) / 1024))
+
+        index = dumpindex.CandidateIndex(os.path.join(tmp, 'candidates.idx'))
+        start = time.perf_counter()
+        for i in range(args.samples // 20):
+            index.sample(20)
+        elapsed = time.perf_counter() - start
+        print("sample:")
+        print("  titles/sec               : {0:8.0f}".format(args.samples / elapsed))
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# throughput benchmark: finding, describing and downloading pictures against replayed APIs
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import logging
+import os.path
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from picdescbot import common, dumpindex, mediastore, metrics, ratelimit, renditions, replay  # noqa: E402
+
+CAPTIONS = ['a boat in the harbour', 'a red train on a bridge', 'a bowl of fruit on a table',
+            'a castle on a hill', 'a flower in a garden', 'a tall building in a city']
+
+
+def _page(pageid, rng, bad):
+    "A synthetic page from the MediaWiki API, `bad` ones are rejected by a filter"
+    name = 'Picture_{0}.jpg'.format(pageid)
+    url = replay.UPLOAD_URL + 'wikipedia/commons/a/ab/' + name
+    categories = ['Boats', 'Nudity' if bad == 'category' else 'Harbours']
+    # Some pictures are used all over the place, and some of those in pages
+    # we don't want, which MediaWiki only tells us about a few pages in
+    usage = ['Harbour']
+    if bad == 'usage' or rng.random() < 0.1:
+        usage += ['Harbour_{0}'.format(i) for i in range(rng.randint(200, 3000))]
+    if bad == 'usage':
+        usage.insert(rng.randint(0, len(usage)), 'Nazi propaganda')
+    return {'pageid': pageid, 'ns': 6, 'title': 'File:' + name.replace('_', ' '),
+            'categories': [{'ns': 14, 'title': 'Category:' + category} for category in categories],
+            'globalusage': [{'title': title, 'wiki': 'en.wikipedia.org'} for title in usage],
+            'imageinfo': [{'url': url,
+                           'thumburl': url.replace('/commons/', '/commons/thumb/') + '/1080px-' + name,
+                           'descriptionshorturl': 'https://commons.wikimedia.org/w/index.php?curid={0}'.format(pageid),
+                           'width': rng.randint(800, 4000), 'height': rng.randint(600, 3000),
+                           'size': rng.randint(100000, 2000000), 'mediatype': 'BITMAP',
+                           'extmetadata': {'ObjectName': {'value': name},
+                                           'Restrictions': {'value': ''},
+                                           'Categories': {'value': '|'.join(categories)},
+                                           'ImageDescription': {'value': '<p>A picture</p>'}}}]}
+
+
+def synthesize(path, queries, batch_size, picture_size, seed=0):
+    """Create fixtures with `queries` random queries of `batch_size` pages.
+    About a third of the pages fail the metadata filters, and a fourth of the
+    rest fail the description filters. A tenth are used in hundreds or
+    thousands of pages."""
+    rng = random.Random(seed)
+    fixtures = replay.Fixtures(path)
+    pageid = 0
+    for i in range(queries):
+        pages = {}
+        for j in range(batch_size):
+            pageid += 1
+            bad = rng.choice(['category', 'usage', 'adult', None, None, None])
+            page = _page(pageid, rng, bad)
+            pages[str(pageid)] = page
+            imageinfo = page['imageinfo'][0]
+            fixtures.cv[replay._filename(imageinfo['url'])] = {
+                'description': {'captions': [{'text': rng.choice(CAPTIONS)}], 'tags': ['outdoor']},
+                'adult': {'isAdultContent': bad == 'adult', 'isRacyContent': False}}
+            # The picture is downloaded in the size that was described
+            fixtures.add_image(renditions.select(imageinfo, common.CV_RENDITION),
+                               os.urandom(picture_size))
+        fixtures.mediawiki.append({'params': {'generator': 'random', 'grnlimit': str(batch_size)},
+                                   'response': {'batchcomplete': '', 'query': {'pages': pages}}})
+    fixtures.save()
+    return fixtures
+
+
+def index_fixtures(path, server):
+    "Write a candidate index with every picture in the fixtures"
+    writer = dumpindex.IndexWriter(path)
+    for title in sorted(server.pages):
+        writer.add(title[len('File:'):].replace(' ', '_').encode('utf-8'))
+    writer.close()
+    return dumpindex.CandidateIndex(path)
+
+
+def bench_describe(cvapi, server, count):
+    fetched = metrics.candidates_fetched.get()
+    calls = server.calls.copy()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    results = [cvapi.get_picture_and_description() for i in range(count)]
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    calls = server.calls - calls
+    candidates = metrics.candidates_fetched.get() - fetched
+    print("get_picture_and_description:")
+    print("  candidates/sec           : {0:8.1f}".format(candidates / elapsed))
+    print("  accepted posts/min       : {0:8.1f}".format(count / elapsed * 60))
+    print("  API calls per post       : {0:8.2f} ({1} MediaWiki, {2} CV, {3} rate limited, {4} failed)".format(
+        (calls['mediawiki'] + calls['cv']) / count, calls['mediawiki'], calls['cv'],
+        calls['429'], calls['failed']))
+    print("  peak memory              : {0:8.1f} KB".format(peak / 1024))
+    return results
+
+
+def bench_download(results, server, label="download_picture"):
+    calls = server.calls.copy()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    total = 0
+    for result in results:
+        picture = result.download_picture()
+        total += len(picture.read())
+        picture.close(really=True)
+        result.release_picture()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    calls = server.calls - calls
+    print(label + ":")
+    print("  pictures/sec             : {0:8.1f}".format(len(results) / elapsed))
+    print("  throughput               : {0:8.1f} MB/s".format(total / elapsed / 1024 / 1024))
+    print("  requests per picture     : {0:8.2f}".format(calls['image'] / len(results)))
+    print("  peak memory              : {0:8.1f} KB".format(peak / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the picture pipeline against replayed APIs')
+    parser.add_argument('--fixtures', default=None,
+                        help='Recorded fixtures (see picdescbot.replay), synthetic ones are used by default')
+    parser.add_argument('--posts', type=int, default=20,
+                        help='How many usable pictures to find')
+    parser.add_argument('--batch-size', type=int, default=common.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=3)
+    parser.add_argument('--describe-batch', type=int, default=0,
+                        help='Describe this many pictures in one go')
+    parser.add_argument('--local-backend', action='store_true',
+                        help='Describe pictures from the fixtures directly, instead of through the server')
+    parser.add_argument('--from-index', action='store_true',
+                        help='Pick pictures from a candidate index (see picdescbot.dumpindex) instead of random ones')
+    parser.add_argument('--media-store', action='store_true',
+                        help='Keep downloaded pictures in a media store, and download them all twice')
+    parser.add_argument('--picture-size', type=int, default=256*1024,
+                        help='Size of the synthetic pictures, in bytes')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Delay added to every response, in seconds')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='Answer every Nth request with a 429')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Fraction of requests that fail with a 503')
+    args = parser.parse_args()
+
+    # Rejections are logged as warnings, which would drown the results
+    logging.getLogger('').addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.fixtures is None:
+            fixtures = synthesize(tmp, 10, args.batch_size, args.picture_size)
+        else:
+            fixtures = replay.Fixtures.load(args.fixtures)
+        with replay.ReplayServer(fixtures, args.latency, args.rate_limit_every,
+                                 failure_rate=args.failure_rate) as server:
+            endpoint = server.install()
+            if args.from_index:
+                common.candidate_index = index_fixtures(os.path.join(tmp, 'candidates.idx'), server)
+            backend = None
+            if args.local_backend:
+                backend = replay.FixtureBackend(fixtures, args.concurrency, args.latency)
+            cvapi = common.CVAPIClient('bench', endpoint, args.batch_size,
+                                       args.concurrency,
+                                       limiter=ratelimit.RateLimiter(1000),
+                                       backend=backend,
+                                       describe_batch_size=args.describe_batch)
+            tracemalloc.start()
+            results = bench_describe(cvapi, server, args.posts)
+            if args.media_store:
+                common.media_store = mediastore.MediaStore(os.path.join(tmp, 'media'))
+            bench_download(results, server)
+            if args.media_store:
+                bench_download(results, server, "download_picture (again, from the media store)")
+            tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
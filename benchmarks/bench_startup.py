@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# startup benchmark: import time, and time from process start to the first API request
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import http.server
+import json
+import os.path
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('tweepy', 'tumblpy', 'lxml', 'wordfilter') if name in sys.modules]
+print(elapsed, ','.join(heavy))
+"""
+
+REQUEST_SCRIPT = """
+import picdescbot.common
+picdescbot.common.MEDIAWIKI_API = {api!r}
+picdescbot.common.get_pictures(1)
+"""
+
+# A MediaWiki response with nothing in it, it's only here to be requested
+EMPTY_QUERY = json.dumps({'batchcomplete': '', 'query': {'pages': {}}}).encode()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.server.first_request is None:
+            self.server.first_request = time.perf_counter()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(EMPTY_QUERY)))
+        self.end_headers()
+        self.wfile.write(EMPTY_QUERY)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(script, cwd):
+    return subprocess.run([sys.executable, '-c', script], cwd=cwd, check=True,
+                          env=dict(os.environ, PYTHONPATH=ROOT),
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def measure_import(module, repeat, cwd):
+    times = []
+    for i in range(repeat):
+        output = run(IMPORT_SCRIPT.format(module=module), cwd).split()
+        times.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ''
+    return statistics.median(times), heavy
+
+
+def measure_first_request(repeat, cwd):
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = 'http://127.0.0.1:{0}/w/api.php'.format(server.server_port)
+    times = []
+    try:
+        for i in range(repeat):
+            server.first_request = None
+            start = time.perf_counter()
+            run(REQUEST_SCRIPT.format(api=api), cwd)
+            times.append(server.first_request - start)
+    finally:
+        server.shutdown()
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark how fast the bot starts')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='Fail if importing picdescbot.common takes longer than this')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for module in ('picdescbot.common', 'bot'):
+            elapsed, heavy = measure_import(module, args.repeat, cwd)
+            print("import {0:<18}: {1:7.1f} ms (heavy modules loaded: {2})".format(
+                module, elapsed * 1000, heavy or 'none'))
+            if module == 'picdescbot.common' and args.max_import_ms is not None:
+                failed = failed or elapsed * 1000 > args.max_import_ms
+        print("time to first request   : {0:7.1f} ms".format(
+            measure_first_request(args.repeat, cwd) * 1000))
+        # Importing shouldn't leave log files behind
+        leftovers = os.listdir(cwd)
+        if leftovers:
+            print("files created on import: {0}".format(', '.join(leftovers)))
+            failed = True
+    if failed:
+        print("Startup regressed!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,85 @@ from __future__ import unicode_literals, absolute_import, print_function
 import argparse
 import configparser
 import os.path
+import picdescbot.cache
+import picdescbot.categories
 import picdescbot.common
+import picdescbot.dumpindex
 import picdescbot.logger
-import picdescbot.tumblr
-import picdescbot.twitter
+import picdescbot.mediastore
+import picdescbot.metrics
+import picdescbot.multi
+import picdescbot.posting
+import picdescbot.providers
+import picdescbot.ratelimit
+import picdescbot.renditions
+import picdescbot.resultqueue
+import picdescbot.review
+import picdescbot.scheduler
+import picdescbot.seen
 import sys
-import tweepy
+
+
+def open_queue(config):
+    "Open the queue of vetted pictures, as configured in the [queue] section"
+    if not config.has_section('queue'):
+        return picdescbot.resultqueue.ResultQueue()
+    section = config['queue']
+    return picdescbot.resultqueue.ResultQueue(
+        section.get('path', picdescbot.resultqueue.DEFAULT_PATH),
+        low=section.getint('low', 5),
+        high=section.getint('high', 20),
+        max_age=section.getint('max_age', 7*24*3600))
+
+
+def open_seen_index(config):
+    "Open the index of pictures we've already seen, as configured in the [seen] section"
+    if not config.has_section('seen'):
+        return picdescbot.seen.SeenIndex()
+    section = config['seen']
+    return picdescbot.seen.SeenIndex(
+        section.get('path', picdescbot.seen.DEFAULT_PATH),
+        capacity=section.getint('capacity', 1000000))
+
+
+def open_describe_cache(config):
+    "Open the cache of Computer Vision results, as configured in the [cache] section"
+    if not config.has_section('cache'):
+        return picdescbot.cache.DescribeCache()
+    section = config['cache']
+    return picdescbot.cache.DescribeCache(
+        section.get('path', picdescbot.cache.DEFAULT_PATH),
+        max_entries=section.getint('max_entries', 10000),
+        ttl=section.getint('ttl', 30*24*3600))
+
+
+def open_category_graph(config):
+    "Open the cache of parent categories, if there's a [categories] section"
+    if not config.has_section('categories'):
+        return None
+    section = config['categories']
+    return picdescbot.categories.CategoryGraph(
+        section.get('path', picdescbot.categories.DEFAULT_PATH),
+        max_depth=section.getint('max_depth', 2),
+        ttl=section.getint('ttl', 30*24*3600))
+
+
+def open_candidate_index(config):
+    "Open the index of candidate pictures, if there's a [dumpindex] section"
+    if not config.has_section('dumpindex'):
+        return None
+    return picdescbot.dumpindex.CandidateIndex(
+        config['dumpindex'].get('path', picdescbot.dumpindex.DEFAULT_PATH))
+
+
+def open_media_store(config):
+    "Open the store of downloaded pictures, if there's a [mediastore] section"
+    if not config.has_section('mediastore'):
+        return None
+    section = config['mediastore']
+    return picdescbot.mediastore.MediaStore(
+        section.get('path', picdescbot.mediastore.DEFAULT_PATH),
+        max_bytes=section.getint('max_bytes', 1024*1024*1024))
 
 
 def main():
@@ -31,15 +104,46 @@ def main():
     parser.add_argument('--disable-tag-blacklist', action="store_true")
     parser.add_argument('--wikimedia-filename', nargs='?', type=str,
                         default=None, help='Describe the specified picture from wikimedia, instead of a random one')
+    parser.add_argument('--batch-size', type=int,
+                        default=picdescbot.common.DEFAULT_BATCH_SIZE,
+                        help='How many random pictures to fetch from wikimedia in each query')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='How many pictures to describe at the same time. More than 1 finds '
+                             'a picture sooner, but the extra ones are paid for too')
+    parser.add_argument('--describe-batch', type=int, default=0,
+                        help='How many pictures to describe in one go (0 to describe them one by one)')
+    parser.add_argument('--prefetch', type=int, default=3,
+                        help='How many pictures to prepare ahead of time in manual mode')
+    parser.add_argument('--fill-queue', action="store_true",
+                        help='Keep the queue of vetted pictures topped up, instead of posting')
+    parser.add_argument('--from-queue', action="store_true",
+                        help='Post a picture from the queue of vetted pictures, if there is one')
+    parser.add_argument('--daemon', action="store_true",
+                        help='Keep running, and post on a schedule')
+    parser.add_argument('--multi', action="store_true",
+                        help='Keep running, and post for every [tenant:...] in the config file on its own schedule')
+    parser.add_argument('--schedule', type=str, default=None,
+                        help='When to post in daemon mode: an interval such as "90m", or a cron expression')
+    parser.add_argument('--profile', action="store_true",
+                        help='Print a breakdown of where the time went after posting')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Write metrics to this file after posting (Prometheus format if it ends with .prom, JSON otherwise)')
     args = parser.parse_args()
+    if (args.daemon or args.multi) and args.manual:
+        print("Manual mode can't be used with --daemon or --multi", file=sys.stderr)
+        return
     config_file = "config.ini"
     if args.config is not None:
         config_file = os.path.expanduser(args.config)
 
     config = configparser.ConfigParser()
     config.read(config_file)
+    # Posters taking pictures from the queue share the log files with the
+    # process filling it, which is the one that rotates them
+    picdescbot.logger.setup(config['logging'] if config.has_section('logging') else None,
+                            rotate=not args.from_queue)
 
-    if not args.tumblr_only:
+    if not args.tumblr_only and not args.fill_queue and not args.multi:
         if (not config.has_section('twitter') or not
                 config.has_option('twitter', 'consumer_key') or not
                 config.has_option('twitter', 'consumer_secret')):
@@ -58,6 +162,7 @@ def main():
         consumer_secret = config['twitter']['consumer_secret']
 
         # twitter auth stuff
+        import tweepy
         auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         if (config.has_option('twitter', 'token') and
                 config.has_option('twitter', 'token_secret')):
@@ -89,46 +194,211 @@ def main():
         apikey = config['mscognitive']['api_key']
         endpoint = config['mscognitive']['endpoint']
 
+    if config.has_section('http'):
+        http = config['http']
+        picdescbot.common.configure_http(http.getfloat('connect_timeout'),
+                                         http.getfloat('read_timeout'),
+                                         http.getint('pool_size'))
+
     # end boring setup stuff
 
     if args.disable_tag_blacklist:
         picdescbot.common.tags_blacklist = {}
+        picdescbot.common.reload_filters()
         args.manual = True  # less filtering means manual mode is mandatory
+        if args.daemon or args.multi:
+            print("--disable-tag-blacklist requires manual mode, which can't be used with --daemon or --multi",
+                  file=sys.stderr)
+            return
+
+    seen = open_seen_index(config)
+    cache = open_describe_cache(config)
+    picdescbot.common.category_graph = open_category_graph(config)
+    picdescbot.common.candidate_index = open_candidate_index(config)
+    picdescbot.common.media_store = open_media_store(config)
+    mscognitive = config['mscognitive']
+    limiter = picdescbot.ratelimit.RateLimiter(
+        mscognitive.getfloat('rate', picdescbot.common.DEFAULT_CV_RATE),
+        burst=mscognitive.getfloat('burst'),
+        path=mscognitive.get('rate_state_file'))
+    rendition = picdescbot.renditions.from_config(mscognitive,
+                                                  picdescbot.common.CV_RENDITION)
+    cvapi = picdescbot.common.CVAPIClient(apikey, endpoint, args.batch_size,
+                                          args.concurrency, seen, cache,
+                                          limiter, rendition,
+                                          describe_batch_size=args.describe_batch)
+    log = picdescbot.logger.get('main')
+    metrics_file = args.metrics_file
+    if metrics_file is None and config.has_section('metrics'):
+        metrics_file = config['metrics'].get('file')
+
+    if args.fill_queue or args.from_queue:
+        queue = open_queue(config)
+    # Good pictures we didn't post go to the queue, but only if it's read
+    # and they were vetted with all the filters
+    queue_leftovers = args.from_queue and not args.disable_tag_blacklist
+
+    if args.fill_queue:
+        log.info("Filling the queue at {0}".format(queue.path))
+        try:
+            prefetch = []
+            if picdescbot.common.media_store is not None:
+                prefetch = picdescbot.providers.upload_renditions(config)
+            picdescbot.resultqueue.run_filler(queue, cvapi, prefetch=prefetch)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    def report():
+        "Write out the metrics, and print where the time went if asked to"
+        if metrics_file is not None:
+            picdescbot.metrics.registry.write(metrics_file)
+        if args.profile:
+            print(picdescbot.common.pipeline.report())
+            print(picdescbot.metrics.profile_report())
+
+    if args.multi:
+        tenants = picdescbot.multi.load_tenants(config)
+        if not tenants:
+            print("There are no [tenant:...] sections in {0}".format(config_file))
+            return
+        lead = 300
+        if config.has_section('daemon'):
+            lead = config['daemon'].getint('lead', lead)
+        picdescbot.multi.run(tenants, picdescbot.multi.Supply(cvapi), seen,
+                             lead, report)
+        return
 
-    cvapi = picdescbot.common.CVAPIClient(apikey, endpoint)
     if args.tumblr_only and not config.has_section('tumblr'):
         print('tumblr is not configured')
         print("You'll neeed the following fields: ")
         print("consumer_key, consumer_secret, token, token_secret, blog_id")
         return
 
-    log = picdescbot.logger.get('main')
-
     providers = []
     if config.has_section('tumblr'):
-        providers.append(picdescbot.tumblr.Client(config['tumblr']))
+        providers.append(picdescbot.providers.load('tumblr', config['tumblr']))
 
     if not args.tumblr_only:
-        providers.append(picdescbot.twitter.Client(config['twitter']))
-
-    post = False
-    while not post:
-        result = cvapi.get_picture_and_description(args.wikimedia_filename)
-        if args.manual:
-            action = None
-            print(result.url)
-            print(result.caption)
-            while action not in ['y', 'n']:
-                action = input("Post this? [y/n]: ")
-            if action == "y":
-                post = True
-        else:
-            post = True
+        providers.append(picdescbot.providers.load('twitter', config['twitter']))
+
+    def prepare():
+        "Find the next picture to post, and get it ready for the providers"
+        with picdescbot.metrics.span('prepare'):
+            result = None
+            if args.from_queue:
+                result = queue.pop()
+                if result is None:
+                    log.warning("The queue is empty, looking for a picture instead")
+            if result is None:
+                result = cvapi.get_picture_and_description(args.wikimedia_filename)
+            picdescbot.posting.prefetch(providers, result)
+            return result
+
+    def post(result):
+        with picdescbot.metrics.span('post', title=result.title):
+            send(result)
+
+    def post_and_report(result):
+        try:
+            post(result)
+        finally:
+            report()
+
+    def send(result):
+        outcomes = picdescbot.posting.post(providers, result)
+        for outcome in outcomes:
+            if outcome.error is None:
+                log.info("Sent {0}: {1} ({2}) in {3:.1f}s".format(
+                    outcome.provider, outcome.status_id, result.caption,
+                    outcome.elapsed))
+            else:
+                log.error("Failed to send to {0}: {1}".format(outcome.provider,
+                                                              outcome.error))
+        if all(outcome.error is not None for outcome in outcomes):
+            raise Exception("Posting failed on all providers")
+        if result.title is not None:
+            seen.record(result.title, picdescbot.seen.POSTED)
+        log.info("Describe cache: {hits} hits, {misses} misses".format(**cache.stats()))
+        if picdescbot.common.media_store is not None:
+            log.info("Media store: {hits} hits, {misses} misses".format(
+                **picdescbot.common.media_store.stats()))
+        log.info("Filter stages:\n" + picdescbot.common.pipeline.report())
+
+    def review():
+        """Show pictures to the operator until one is approved for posting
+        right now, and return it. Pictures approved for later go to the queue.
+        The next pictures are prepared while the operator looks at this one."""
+        prefetcher = None
+        if args.wikimedia_filename is None:
+            prefetcher = picdescbot.review.Prefetcher(prepare, args.prefetch)
+        later = None
+        try:
+            while True:
+                result = prefetcher.get() if prefetcher is not None else prepare()
+                action = None
+                print(result.url)
+                print(result.caption)
+                while action not in ['y', 'n', 'l', 'q']:
+                    action = input("Post this? [y]es/[n]o/[l]ater/[q]uit: ")
+                if action == "y":
+                    return result
+                elif action == "l":
+                    later = later or open_queue(config)
+                    later.push(result)
+                    print("Queued for later ({0} waiting)".format(len(later)))
+                elif action == "n" and result.title is not None:
+                    seen.record(result.title, picdescbot.seen.REJECTED, 'rejected in review')
+                elif action == "q":
+                    return None
+        finally:
+            if prefetcher is not None:
+                # They were described and marked as such already, put them
+                # back so they aren't lost
+                leftovers = prefetcher.close()
+                if queue_leftovers:
+                    for leftover in leftovers:
+                        queue.push(leftover)
+                else:
+                    cvapi.described.extend(leftovers)
+
+    if args.daemon:
+        schedule = args.schedule
+        lead = 300
+        if config.has_section('daemon'):
+            schedule = schedule or config['daemon'].get('schedule')
+            lead = config['daemon'].getint('lead', lead)
+        daemon = picdescbot.scheduler.Daemon(
+            picdescbot.scheduler.parse_schedule(schedule or '1h'),
+            prepare, post_and_report, lead)
+        daemon.run()
+        return
 
-    for provider in providers:
-        status_id = provider.send(result)
-        log.info("Sent {0}: {1} ({2})".format(provider.name, status_id,
-                                              result.caption))
+    try:
+        with picdescbot.metrics.span('run'):
+            if args.manual:
+                result = review()
+            else:
+                result = prepare()
+            if result is not None:
+                post(result)
+    finally:
+        report()
+        if cvapi.described and queue_leftovers:
+            # Good pictures left over from a batch, save them for next time
+            while cvapi.described:
+                queue.push(cvapi.described.popleft())
+            log.info("Queued leftover pictures, {0} waiting".format(len(queue)))
+        elif cvapi.described:
+            # Nothing would read them from the queue, or they weren't vetted
+            # by all the filters. Let them be picked again instead, with the
+            # describe cache that doesn't cost another Computer Vision call.
+            count = len(cvapi.described)
+            while cvapi.described:
+                result = cvapi.described.popleft()
+                if result.title is not None:
+                    seen.forget(result.title)
+            log.info("Dropped {0} leftover pictures".format(count))
 
 if __name__ == "__main__":
     main()
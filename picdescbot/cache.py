@@ -0,0 +1,87 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements a persistent cache for Computer Vision API results
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import json
+import sqlite3
+import threading
+import time
+from . import logger
+
+log = logger.get("cache")
+
+DEFAULT_PATH = "describe_cache.db"
+
+
+class DescribeCache(object):
+    """ A size-bounded LRU cache for `CVAPIClient.describe_picture` results,
+    stored in SQLite so it survives between runs.
+
+    Keys are image URLs. Every response from the API is cached, including the
+    ones without a caption, so we never pay twice for the same picture.
+    Entries expire `ttl` seconds after they were added.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=10000, ttl=30*24*3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS describe_cache ("
+                        "key TEXT PRIMARY KEY, "
+                        "result TEXT NOT NULL, "
+                        "added REAL NOT NULL, "
+                        "last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS describe_cache_last_used "
+                        "ON describe_cache (last_used)")
+        self.db.commit()
+
+    def get(self, key):
+        "Returns the cached result for key, or None"
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT result, added FROM describe_cache WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is not None and row[1] < now - self.ttl:
+                self.db.execute("DELETE FROM describe_cache WHERE key = ?", (key,))
+                row = None
+            elif row is not None:
+                self.db.execute("UPDATE describe_cache SET last_used = ? WHERE key = ?",
+                                (now, key))
+            self.db.commit()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, result):
+        "Cache a result, evicting the least recently used entries if the cache is full"
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO describe_cache "
+                            "(key, result, added, last_used) VALUES (?, ?, ?, ?)",
+                            (key, json.dumps(result), now, now))
+            self.db.execute("DELETE FROM describe_cache WHERE key IN ("
+                            "SELECT key FROM describe_cache "
+                            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                            (self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        "Returns a dict with the hit and miss counters"
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,137 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements a cache of the Wikimedia Commons category hierarchy
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import json
+import sqlite3
+import threading
+import time
+from . import common
+from . import logger
+
+log = logger.get("categories")
+
+DEFAULT_PATH = "categories.db"
+
+
+class CategoryGraph(object):
+    """ The parent categories of Commons categories, stored in SQLite so it
+    survives between runs.
+
+    Parents are fetched in batches with prop=categories, and kept for `ttl`
+    seconds. Hidden (maintenance) categories are ignored. Whether a category
+    has a blacklisted ancestor, up to `max_depth` levels up, is memoized, so
+    checking a category we've seen before is a dictionary lookup.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_depth=2, ttl=30*24*3600):
+        self.path = path
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.parents = {}  # category => (parents, fetched)
+        self._memo = {}  # (category, depth) => blacklisted ancestor or None
+        self._memo_matcher = None
+        self._memo_started = time.time()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS category_parents ("
+                        "category TEXT PRIMARY KEY, "
+                        "parents TEXT NOT NULL, "
+                        "fetched REAL NOT NULL)")
+        self.db.commit()
+
+    def _known(self, category, now):
+        "Returns the parents of a category if we have them and they're fresh"
+        entry = self.parents.get(category)
+        if entry is None:
+            row = self.db.execute("SELECT parents, fetched FROM category_parents WHERE category = ?",
+                                  (category,)).fetchone()
+            if row is None:
+                return None
+            entry = self.parents[category] = (json.loads(row[0]), row[1])
+        if entry[1] < now - self.ttl:
+            return None
+        return entry[0]
+
+    def _fetch(self, categories):
+        "Fetch the parents of categories from MediaWiki, in as few queries as possible"
+        categories = sorted(categories)
+        now = time.time()
+        for i in range(0, len(categories), common.TITLES_PER_QUERY):
+            batch = categories[i:i + common.TITLES_PER_QUERY]
+            pages = common._query({"prop": "categories",
+                                   "titles": '|'.join(batch),
+                                   "cllimit": "max",
+                                   "clshow": "!hidden"})
+            found = {}
+            for page in pages.values():
+                found[page['title']] = [parent['title'] for parent in page.get('categories', [])]
+            for category in batch:
+                # Missing categories have no parents as far as we care
+                self.parents[category] = (found.get(category, []), now)
+            self.db.executemany("INSERT OR REPLACE INTO category_parents "
+                                "(category, parents, fetched) VALUES (?, ?, ?)",
+                                [(category, json.dumps(self.parents[category][0]), now)
+                                 for category in batch])
+            self.db.commit()
+        log.debug("Fetched parents of {0} categories".format(len(categories)))
+
+    def prefetch(self, categories, depth=None):
+        """Make sure we know the ancestors of categories up to `depth` levels
+        up, fetching all the missing ones of each level in one go."""
+        if depth is None:
+            depth = self.max_depth
+        now = time.time()
+        with self.lock:
+            level = set(categories)
+            for remaining in range(depth, 0, -1):
+                level = {category for category in level
+                         if (category, remaining) not in self._memo}
+                missing = [category for category in level
+                           if self._known(category, now) is None]
+                if missing:
+                    self._fetch(missing)
+                level = {parent for category in level
+                         for parent in self._known(category, now) or []}
+
+    def find_blacklisted(self, categories, matcher):
+        """Check the ancestors of categories against a `Matcher`.
+        Returns a (category, ancestor) tuple for the first category with a
+        blacklisted ancestor, or None if they're all fine."""
+        with self.lock:
+            if (matcher is not self._memo_matcher or
+                    self._memo_started < time.time() - self.ttl):
+                # The blacklist or the graph changed, start over
+                self._memo = {}
+                self._memo_matcher = matcher
+                self._memo_started = time.time()
+            self.prefetch(categories)
+            for category in categories:
+                ancestor = self._blacklisted_ancestor(category, self.max_depth, matcher)
+                if ancestor is not None:
+                    return category, ancestor
+        return None
+
+    def _blacklisted_ancestor(self, category, depth, matcher):
+        key = (category, depth)
+        if key in self._memo:
+            return self._memo[key]
+        ancestor = None
+        if depth > 0:
+            for parent in self._known(category, time.time()) or []:
+                if matcher.search(parent) is not None:
+                    ancestor = parent
+                else:
+                    ancestor = self._blacklisted_ancestor(parent, depth - 1, matcher)
+                if ancestor is not None:
+                    break
+        self._memo[key] = ancestor
+        return ancestor
+
+    def close(self):
+        with self.lock:
+            self.db.close()
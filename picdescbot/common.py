@@ -5,13 +5,26 @@
 
 from __future__ import unicode_literals, absolute_import, print_function
 
-from wordfilter import Wordfilter
+import collections
+import concurrent.futures
+import hashlib
+import io
 import json
 import re
 import requests
+import requests.adapters
+import tempfile
+import threading
 import time
-import lxml.html
+from . import filters
 from . import logger
+from . import matcher
+from . import metrics
+from . import ratelimit
+from . import renditions
+from . import retry
+from . import seen as seen_index
+from .matcher import Matcher
 from io import BytesIO
 
 log = logger.get("common")
@@ -20,11 +33,96 @@ MEDIAWIKI_API = "https://commons.wikimedia.org/w/api.php"
 
 HEADERS = {"User-Agent":  "picdescbot, http://github.com/elad661/picdescbot"}
 
+# Connect and read timeouts (in seconds) for every HTTP request we make
+TIMEOUT = (10, 60)
+
+# How many keep-alive connections to keep open to each host
+POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_http(connect_timeout=None, read_timeout=None, pool_size=None):
+    """Change the HTTP settings. Must be called before the first request to
+    affect the pool size."""
+    global TIMEOUT, POOL_SIZE
+    TIMEOUT = (connect_timeout or TIMEOUT[0], read_timeout or TIMEOUT[1])
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+
+
+def get_session():
+    """Get the HTTP session shared by everything in the bot. It keeps
+    connections to MediaWiki, the Computer Vision API and upload.wikimedia.org
+    alive, so the TCP and TLS handshakes are done once per process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+                                                    pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+# Pictures bigger than this aren't downloaded at all
+MAX_PICTURE_SIZE = 50 * 1024 * 1024
+
+# Downloaded pictures are kept in memory up to this size, and spooled to a
+# temporary file on disk if they're bigger
+SPOOL_SIZE = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# How many Computer Vision API calls to make per second, at most. The rate
+# limiter adapts to the actual limits of the subscription.
+DEFAULT_CV_RATE = 10
+
+# How many random files to ask for in a single query when looking for
+# candidates. Most of them get rejected, so asking for many at once saves
+# a lot of round trips.
+DEFAULT_BATCH_SIZE = 20
+
+# How many titles MediaWiki lets us ask about in a single query
+TITLES_PER_QUERY = 50
+
+# Categories and global usage are paged through until we've seen this many
+# of them for a file. Files with more than that are rejected, vetting them
+# would take too many requests.
+MAX_LINKS = 2000
+
+# How long finding a picture for one post may take, in seconds, including
+# all the retries
+DEFAULT_DEADLINE = 15*60
+
+# The picture size the Computer Vision API gets. Its limits are 50x50 pixels
+# and 4MB, and bigger pictures don't get better descriptions, only slower.
+CV_RENDITION = renditions.Rendition(1024, 4*1024*1024, min_size=50)
+
 supported_formats = re.compile('\.(png|jpe?g|gif)$', re.I)
-word_filter = Wordfilter()
 
-# I really don't want the bot to show this kind of imagery!
-word_filter.add_words(['nazi', 'hitler', 'reich'])
+# The Wordfilter is built on first use, see get_word_filter()
+_word_filter = None
+
+
+def get_word_filter():
+    "Get the shared Wordfilter, creating it if needed"
+    global _word_filter
+    if _word_filter is None:
+        from wordfilter import Wordfilter
+        _word_filter = Wordfilter()
+        # I really don't want the bot to show this kind of imagery!
+        _word_filter.add_words(['nazi', 'hitler', 'reich'])
+    return _word_filter
+
+
+def __getattr__(name):
+    # Keep `common.word_filter` working without building it at import time
+    if name == 'word_filter':
+        return get_word_filter()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 # I can't trust Microsoft's algorithm to not be racist, so I should probably
 # make the bot avoid posting images with the following words in them.
@@ -101,221 +199,760 @@ def gender_neutralize(phrase):
             neutralized.append(word)
     neutralized = ' '.join(neutralized)
     if neutralized != phrase:
-        log.info('Gender neutralized: "{0}" => "{1}"'.format(phrase, neutralized))
+        log.info('Gender neutralized: "{0}" => "{1}"'.format(phrase, neutralized),
+                 extra={'caption': phrase, 'neutralized': neutralized})
     return neutralized
 
 
 tags_blacklist = {'text', 'screenshot', 'military', 'church'}
 
+# Compiled versions of the blacklists above, one per kind of field we check.
+# They're built on first use, call reload_filters() after changing the lists.
+_filters = None
+
+
+def get_filters():
+    "Get the compiled blacklist matchers, building them if needed"
+    global _filters
+    if _filters is None:
+        badwords = get_word_filter().blacklist
+        _filters = {
+            # File names, picture titles and restrictions
+            'text': Matcher().add('badword', badwords),
+            'description': Matcher().add('badword', badwords)
+                                    .add('phrase', blacklisted_phrases),
+            'categories': Matcher().add('category', category_blacklist),
+            'usage': Matcher().add('badword', badwords)
+                              .add('category', category_blacklist),
+            # Captions generated by CVAPI
+            'caption': Matcher().add('phrase', ['a suit and tie'])
+                                .add('badword', badwords)
+                                .add('extra', extra_filter, matcher.WORD),
+            'tags': Matcher().add('tag', tags_blacklist, matcher.EXACT)
+        }
+    return _filters
+
+
+def reload_filters():
+    "Recompile the blacklist matchers after the blacklists were modified"
+    global _filters
+    _filters = None
+
 
 def tag_blacklisted(tags):
-    for tag in tags:
-        if tag in tags_blacklist:
-            return True
-    return False
+    return get_filters()['tags'].search_many(tags) is not None
 
 
 def is_blacklisted(caption):
     """ Check caption for forbidden words"""
-    if "a suit and tie" in caption:
-        return True
-    if word_filter.blacklisted(caption):
-        return True
-    for word in caption.split():
-        if word in extra_filter:
-            return True
-    return False
+    return get_filters()['caption'].search(caption) is not None
 
 
 def remove_html_tags(text):
     """ Remove all HTML tags (and properties) from a string """
+    import lxml.html  # only needed here, and slow to import
     return ' '.join(lxml.html.fromstring(text).itertext())
 
 
-def log_discarded(url, reason, description=None):
+def log_discarded(url, reason, description=None, stage=None):
     line = "Discarded {0} because of {1}".format(url, reason)
     if description is not None:
         line += ' - "{0}"'.format(description)
-    log.warning(line)
+    log.warning(line, extra={'url': url, 'reason': reason, 'stage': stage,
+                             'description': description})
 
 
-def get_picture(filename=None):
-    """Get a picture from Wikimedia Commons. A random picture will be returned if filename is not specified
-    Returns None when the result is bad"""
-    params = {"action": "query",
-              "prop": "imageinfo|categories|globalusage",
-              "iiprop": "url|size|extmetadata|mediatype",
-              "iiurlheight": "1080",
-              "format": "json"}
-    if filename is None:
-        params['generator'] = 'random'
-        params['grnnamespace'] = '6'
-    else:
-        params['titles'] = 'File:%s' % filename
-
-    response = requests.get(MEDIAWIKI_API,
-                            params=params,
-                            headers=HEADERS).json()
-    page = list(response['query']['pages'].values())[0]  # This API is ugly
-    imageinfo = page['imageinfo'][0]
-    url = imageinfo['url']
-    extra_metadata = imageinfo['extmetadata']
+def _query(params, deadline=None):
+    """Run a MediaWiki query, following prop continuations until the batch is
+    complete. Returns the merged pages dict."""
+    params = dict(params, action="query", format="json")
+    pages = {}
+    while True:
+        response = _request(params, deadline)
+        for pageid, page in response.get('query', {}).get('pages', {}).items():
+            merged = pages.setdefault(pageid, {})
+            for key, value in page.items():
+                if isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged[key] = value
+        if 'batchcomplete' in response or 'continue' not in response:
+            return pages
+        params.update(response['continue'])
+
+
+def _request(params, deadline=None):
+    "A single MediaWiki API request, retried as `retry.upstreams` says"
+    upstream = retry.upstreams['mediawiki']
+    attempt = 0
+    while True:
+        upstream.before_request(deadline, 'querying MediaWiki')
+        attempt += 1
+        recorded = False
+        try:
+            try:
+                with metrics.span('mediawiki'), metrics.request_seconds.time(api='mediawiki'):
+                    response = get_session().get(MEDIAWIKI_API, params=params,
+                                                 timeout=TIMEOUT)
+                    response.raise_for_status()
+                    data = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                log.error("Error when querying MediaWiki: {0}".format(e))
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code < 500:
+                    upstream.breaker.record_success()  # It's up, it just said no
+                else:
+                    upstream.breaker.record_failure()
+                recorded = True
+                if not upstream.should_retry(attempt, deadline):
+                    raise
+                continue
+            upstream.breaker.record_success()
+            recorded = True
+            return data
+        finally:
+            if not recorded:
+                upstream.breaker.release()
+
+
+# All the checks a picture has to pass, see `picdescbot.filters`.
+# Costs are rough relative estimates, cheaper stages run first.
+pipeline = filters.Pipeline()
 
+
+@pipeline.stage('missing', cost=0, quiet=True)
+def _check_missing(candidate):
+    if candidate.imageinfo is None:  # missing or deleted file
+        return 'missing file'
+
+
+@pipeline.stage('mediatype', cost=1, quiet=True)
+def _check_mediatype(candidate):
     # check that the file is actually a picture
-    if imageinfo['mediatype'] != "BITMAP":
-        return None
+    if candidate.imageinfo['mediatype'] != "BITMAP":
+        return 'not a bitmap'
+
 
+@pipeline.stage('size', cost=1, quiet=True)
+def _check_size(candidate):
     # Make sure the picture is big enough
-    if imageinfo['width'] <= 50 or imageinfo['height'] <= 50:
-        return None
+    if candidate.imageinfo['width'] <= 50 or candidate.imageinfo['height'] <= 50:
+        return 'too small'
 
+
+@pipeline.stage('format', cost=2, quiet=True)
+def _check_format(candidate):
     # Make sure the format is supported
-    if not supported_formats.search(url):
-        return None
+    if not supported_formats.search(candidate.url):
+        return 'unsupported format'
 
-    # We got a picture, now let's verify we can use it.
-    if word_filter.blacklisted(page['title']):  # Check file name for bad words
-        log_discarded(url, 'badword in page title: "{0}"'.format(page['title']))
-        return None
+
+@pipeline.stage('title', cost=3)
+def _check_title(candidate):
+    # Check file name for bad words
+    title = candidate.page['title']
+    if get_filters()['text'].search(title):
+        return 'badword in page title: "{0}"'.format(title)
+
+
+@pipeline.stage('object_name', cost=3)
+def _check_object_name(candidate):
     # Check picture title for bad words
-    if word_filter.blacklisted(extra_metadata['ObjectName']['value']):
-        log_discarded(url, 'badword in picture title: "{0}"'.format(extra_metadata['ObjectName']['value']))
-        return None
+    object_name = candidate.imageinfo['extmetadata']['ObjectName']['value']
+    if get_filters()['text'].search(object_name):
+        return 'badword in picture title: "{0}"'.format(object_name)
+
+
+@pipeline.stage('restrictions', cost=3)
+def _check_restrictions(candidate):
     # Check restrictions for more bad words
-    if word_filter.blacklisted(extra_metadata['Restrictions']['value']):
-        log_discarded(url, 'badword in restrictions: "{0}"'.format(extra_metadata['Restrictions']['value']))
-        return None
+    restrictions = candidate.imageinfo['extmetadata']['Restrictions']['value']
+    if get_filters()['text'].search(restrictions):
+        return 'badword in restrictions: "{0}"'.format(restrictions)
 
-    # Check file description for bad words
-    if 'ImageDescription' in extra_metadata:
-        cleaned_description = remove_html_tags(extra_metadata['ImageDescription']['value'])
-        if word_filter.blacklisted(cleaned_description):
-            log_discarded(url, 'badword in image description: "{0}"'.format(cleaned_description))
-            return None
 
-        for phrase in blacklisted_phrases:
-            if phrase in cleaned_description.lower().strip():
-                log_discarded(url, 'blacklisted phrase "{0}" found in description "{1}"'.format(phrase, cleaned_description))
-                return None
+@pipeline.stage('categories', cost=5, needs=filters.LINKS)
+def _check_categories(candidate):
+    categories = [category['title'] for category in candidate.page.get('categories', [])]
+    hit = get_filters()['categories'].search_many(categories)
+    if hit is not None:
+        return 'blacklisted category "{0}"'.format(hit[0])
+
 
+@pipeline.stage('extra_categories', cost=5)
+def _check_extra_categories(candidate):
     # The mediawiki API is awful, there's another list of categories which
     # is not the same as the one requested by asking for "categories".
     # Fortunately it's still in the API response, under extmetadata.
+    extra_categories = candidate.imageinfo['extmetadata']['Categories']['value']
+    match = get_filters()['categories'].search(extra_categories)
+    if match is not None:
+        return 'blacklisted category "{0}" (in extra)'.format(match.pattern)
 
-    extra_categories = extra_metadata['Categories']['value'].lower()
 
-    for blacklisted_category in category_blacklist:
-        for category in page['categories']:
-            if blacklisted_category in category['title'].lower():
-                log_discarded(url, 'blacklisted category "{0}"'.format(category['title']))
-                return None
+@pipeline.stage('globalusage', cost=8, needs=filters.LINKS)
+def _check_globalusage(candidate):
+    # if the picture is used in any wikipage with unwanted themes, we probably
+    # don't want to use it.
+    usage = [wikipage['title'] for wikipage in candidate.page.get('globalusage', [])]
+    hit = get_filters()['usage'].search_many(usage)
+    if hit is not None:
+        return 'page usage "{0}"'.format(hit[0])
 
-        if blacklisted_category in extra_categories:
-            log_discarded(url, 'blacklisted category "{0}" (in extra)'.format(blacklisted_category))
-            return None
 
-    # TODO check parent categories for each category in metadata,
-    # and compare them against the blacklist too. This will require
-    # extra API calls
+@pipeline.stage('description', cost=20)
+def _check_description(candidate):
+    # Check file description for bad words and phrases. This one is last
+    # because parsing the HTML is slower than everything else.
+    extra_metadata = candidate.imageinfo['extmetadata']
+    if 'ImageDescription' not in extra_metadata:
+        return None
+    cleaned_description = remove_html_tags(extra_metadata['ImageDescription']['value'])
+    match = get_filters()['description'].search(cleaned_description)
+    if match is not None and match.rule == 'phrase':
+        return 'blacklisted phrase "{0}" found in description "{1}"'.format(match.pattern, cleaned_description)
+    elif match is not None:
+        return 'badword in image description: "{0}"'.format(cleaned_description)
 
-    # if the picture is used in any wikipage with unwanted themes, we probably
-    # don't want to use it.
-    for wikipage in page['globalusage']:
-        if word_filter.blacklisted(wikipage['title'].lower()):
-            log_discarded(url, 'page usage "{0}"'.format(wikipage['title']))
-            return None
-        for blacklisted_category in category_blacklist:
-            if blacklisted_category in wikipage['title']:  # substring matching
-                log_discarded(url, 'page usage "{0}"'.format(wikipage['title']))
-                return None
-    return imageinfo
+
+# The Commons category hierarchy, see `picdescbot.categories`. Parent
+# categories are only checked when there is one.
+category_graph = None
+
+
+@pipeline.stage('parent_categories', cost=30, needs=filters.LINKS)
+def _check_parent_categories(candidate):
+    if category_graph is None:
+        return None
+    categories = [category['title'] for category in candidate.page.get('categories', [])]
+    hit = category_graph.find_blacklisted(categories, get_filters()['categories'])
+    if hit is not None:
+        return 'blacklisted parent category "{1}" (of "{0}")'.format(*hit)
+
+
+@pipeline.stage('adult', cost=1, needs=filters.DESCRIPTION)
+def _check_adult(candidate):
+    adult = candidate.description['adult']
+    if adult['isAdultContent'] or adult['isRacyContent']:  # no nudity and such
+        return 'adult content'
+
+
+@pipeline.stage('caption', cost=1, needs=filters.DESCRIPTION)
+def _check_caption(candidate):
+    if candidate.caption is None:
+        return 'no caption'
+
+
+@pipeline.stage('tags', cost=2, needs=filters.DESCRIPTION)
+def _check_tags(candidate):
+    if tag_blacklisted(candidate.tags):
+        return 'tag blacklist (tags: {0})'.format(', '.join(candidate.tags))
+
+
+@pipeline.stage('caption_blacklist', cost=3, needs=filters.DESCRIPTION)
+def _check_caption_blacklist(candidate):
+    if candidate.caption is not None and is_blacklisted(candidate.caption):
+        return 'caption blacklist'
+
+
+def _check_page(page, phase=filters.METADATA, imageinfo=None):
+    """Check a single page from the MediaWiki API.
+    Returns the reason for rejecting it, or None if it's usable"""
+    candidate = filters.Candidate(page, imageinfo)
+    rejection = pipeline.run(candidate, phase)
+    if rejection is None:
+        return None
+    stage, reason = rejection
+    _rejected(candidate.url, stage.name, reason, stage.quiet)
+    return reason
+
+
+def _rejected(url, stage, reason, quiet=False):
+    metrics.candidates_rejected.inc(stage=stage)
+    if not quiet:
+        log_discarded(url, reason, stage=stage)
+
+
+def _check_links(pages, deadline=None):
+    """Page through the categories and global usage of pages that passed the
+    metadata checks, checking every batch of them as it arrives. A file is
+    dropped from the query as soon as it's rejected, so a bad file that is
+    used all over the place costs one request, not dozens.
+    Returns a dict of title => reason for the rejected pages."""
+    params = {"action": "query",
+              "format": "json",
+              "prop": "categories|globalusage",
+              "cllimit": "max",
+              "gulimit": "max"}
+    rejected = {}
+    links = collections.Counter()
+    pending = set(pages)
+    while pending:
+        params['titles'] = '|'.join(sorted(pending))
+        response = _request(params, deadline)
+        results = response.get('query', {}).get('pages', {}).values()
+        if category_graph is not None:
+            # Fetch the parents of all the categories we just got at once
+            category_graph.prefetch({category['title'] for page in results
+                                     for category in page.get('categories', [])})
+        for page in results:
+            title = page.get('title')
+            if title not in pending:
+                continue
+            # The lists only have what's new in this response, but every
+            # check rejects on a single entry, so that's enough
+            imageinfo = pages[title]['imageinfo'][0]
+            reason = _check_page(page, filters.LINKS, imageinfo)
+            links[title] += len(page.get('categories', [])) + len(page.get('globalusage', []))
+            if reason is None and links[title] > MAX_LINKS:
+                reason = 'more than {0} categories and usages'.format(MAX_LINKS)
+                _rejected(imageinfo['url'], 'links', reason)
+            if reason is not None:
+                rejected[title] = reason
+                pending.discard(title)
+        # Continuing with fewer titles is fine, continuation is by position
+        if 'batchcomplete' in response or 'continue' not in response:
+            break
+        params.update(response['continue'])
+    return rejected
+
+
+def _vet_pages(pages, seen=None, deadline=None):
+    """Check pages from the MediaWiki API, first their metadata, then their
+    categories and global usage. Returns the imageinfo of the usable ones.
+    Rejections are recorded in the `seen` index, if there is one."""
+    vetted = {}
+    rejected = {}
+    for page in pages:
+        reason = _check_page(page)
+        if reason is None:
+            vetted[page['title']] = page
+        elif 'title' in page:
+            rejected[page['title']] = reason
+    titles = list(vetted)
+    for i in range(0, len(titles), TITLES_PER_QUERY):
+        batch = titles[i:i + TITLES_PER_QUERY]
+        rejected.update(_check_links({title: vetted[title] for title in batch}, deadline))
+
+    pictures = []
+    for page in pages:
+        title = page.get('title')
+        if title in rejected:
+            if seen is not None:
+                seen.record(title, seen_index.REJECTED, rejected[title])
+        elif title in vetted:
+            imageinfo = page['imageinfo'][0]
+            imageinfo['title'] = title
+            pictures.append(imageinfo)
+    return pictures
+
+
+# Pictures to pick from instead of asking MediaWiki for random ones, see
+# `picdescbot.dumpindex`. They're still checked live, in case they changed.
+candidate_index = None
+
+
+def _sample_titles(count, seen=None):
+    "Pick pictures from the candidate index, leaving out the ones we've seen"
+    titles = []
+    for title in candidate_index.sample(min(count, TITLES_PER_QUERY)):
+        metrics.candidates_fetched.inc()
+        if seen is not None and title in seen:
+            log.info("Skipping {0}, already seen".format(title))
+            metrics.candidates_rejected.inc(stage='seen')
+        else:
+            titles.append(title)
+    return titles
+
+
+def get_pictures(count=DEFAULT_BATCH_SIZE, seen=None, deadline=None):
+    """Get up to `count` random pictures from Wikimedia Commons in one query.
+    Returns a list with the imageinfo of every candidate that passed vetting,
+    which may be empty if all of them were bad. Pictures that are already in
+    the `seen` index are skipped without vetting them again."""
+    params = {"prop": "imageinfo",
+              "iiprop": "url|size|extmetadata|mediatype",
+              "iiurlheight": "1080"}
+    if candidate_index is not None and len(candidate_index) > 0:
+        titles = _sample_titles(count, seen)
+        if not titles:
+            return []
+        params["titles"] = '|'.join(titles)
+        return _vet_pages(list(_query(params, deadline).values()), seen, deadline)
+
+    params.update({"generator": "random",
+                   "grnnamespace": "6",
+                   "grnlimit": str(count)})
+    pages = []
+    for page in _query(params, deadline).values():
+        metrics.candidates_fetched.inc()
+        if seen is not None and page.get('title') in seen:
+            log.info("Skipping {0}, already seen".format(page['title']))
+            metrics.candidates_rejected.inc(stage='seen')
+            continue
+        pages.append(page)
+    return _vet_pages(pages, seen, deadline)
+
+
+def get_picture(filename=None, seen=None, deadline=None):
+    """Get a picture from Wikimedia Commons. A random picture will be returned if filename is not specified
+    Returns None when the result is bad"""
+    if filename is None:
+        pictures = get_pictures(1, seen, deadline)
+        return pictures[0] if pictures else None
+
+    params = {"prop": "imageinfo",
+              "iiprop": "url|size|extmetadata|mediatype",
+              "iiurlheight": "1080",
+              "titles": 'File:%s' % filename}
+    pages = list(_query(params, deadline).values())  # This API is ugly
+    pictures = _vet_pages(pages[:1], deadline=deadline)
+    return pictures[0] if pictures else None
+
+
+# The outcome of describing one picture in a batch. Either `result` is set,
+# in the format of the Computer Vision API, or `error` is.
+Description = collections.namedtuple('Description', ['result', 'error'])
+
+
+class DescriptionBackend(object):
+    """ Something that describes pictures.
+
+    `describe` takes the URL of a picture or its bytes, and returns a dict
+    in the format of the Computer Vision API: captions and tags under
+    'description', and the adult flags under 'adult'. It returns None if it
+    gave up because `cancelled` was set, and raises on errors.
+    `describe_batch` describes many pictures, `concurrency` at a time.
+    """
+    concurrency = 1
+
+    def describe(self, picture, cancelled=None):
+        raise NotImplementedError()
+
+    def describe_batch(self, pictures, cancelled=None):
+        """Describe a batch of pictures (URLs or bytes). Returns a list of
+        `Description`s in the same order, an error in one of them doesn't
+        affect the others."""
+        def describe_one(picture):
+            try:
+                result = self.describe(picture, cancelled)
+            except Exception as e:
+                return Description(None, e)
+            if result is None:
+                return Description(None, Exception("No description"))
+            return Description(result, None)
+
+        if not pictures:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(min(len(pictures),
+                                                       max(1, self.concurrency))) as executor:
+            return list(executor.map(describe_one, pictures))
 
 
-class CVAPIClient(object):
-    "Microsoft Cognitive Services Client"
-    def __init__(self, apikey, endpoint):
+class CVAPIClient(DescriptionBackend):
+    """ Microsoft Cognitive Services Client.
+
+    Also finds pictures and gets them described, by itself or by another
+    `backend`, see `get_picture_and_description`. """
+    def __init__(self, apikey, endpoint, batch_size=DEFAULT_BATCH_SIZE,
+                 concurrency=1, seen=None, cache=None, limiter=None,
+                 rendition=CV_RENDITION, backend=None, describe_batch_size=0):
         self.apikey = apikey
         self.endpoint = endpoint + '/analyze'
+        self.batch_size = batch_size
+        # How many pictures to describe at the same time
+        self.concurrency = concurrency
+        # Index of pictures we already looked at, see `picdescbot.seen`
+        self.seen = seen
+        # Cache for describe_picture results, see `picdescbot.cache`
+        self.cache = cache
+        # Shared rate limiter, see `picdescbot.ratelimit`
+        self.limiter = limiter or ratelimit.RateLimiter(DEFAULT_CV_RATE)
+        # The picture size to describe, see `picdescbot.renditions`
+        self.rendition = rendition
+        # What describes the pictures, this client unless there's another one
+        self.backend = backend or self
+        # How many pictures to send to the backend at once, 0 for one by one
+        self.describe_batch_size = describe_batch_size
+        # Pictures that passed all the filters, but weren't needed yet
+        self.described = collections.deque()
+        # Vetted random pictures waiting to be described
+        self.candidates = collections.deque()
+
+    def next_candidate(self, deadline=None):
+        "Get the next vetted random picture, fetching a new batch when we run out"
+        while not self.candidates:
+            if deadline is not None:
+                deadline.check('finding a candidate')
+            pictures = get_pictures(self.batch_size, self.seen, deadline)
+            if not pictures:
+                # The whole batch was bad, let's wait a bit to be polite to the API server
+                retry.wait('mediawiki', 1, deadline)
+            self.candidates.extend(pictures)
+        return self.candidates.popleft()
+
+    def describe_picture(self, picture, cancelled=None):
+        """Get description for a picture using Microsoft Cognitive Services.
+        `picture` is a URL, or the bytes of the picture.
+        Gives up and returns None if the `cancelled` event is set."""
+        if isinstance(picture, bytes):
+            key = 'sha256:' + hashlib.sha256(picture).hexdigest()
+            body = {'data': picture}
+            content_type = 'application/octet-stream'
+        else:
+            key = picture
+            body = {'json': {'url': picture}}
+            content_type = 'application/json'
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                log.info("Using cached description for {0}".format(key))
+                return cached
 
-    def describe_picture(self, url):
-        "Get description for a picture using Microsoft Cognitive Services"
         params = {'visualFeatures': 'Description,Adult'}
-        json = {'url': url}
-        headers = {'Content-Type': 'application/json',
+        headers = {'Content-Type': content_type,
                    'Ocp-Apim-Subscription-Key': self.apikey}
 
+        upstream = retry.upstreams['cv']
         result = None
-        retries = 0
+        attempt = 0
 
-        while retries < 15 and not result:
-            response = requests.post(self.endpoint, json=json, params=params,
-                                     headers=headers)
-            if response.status_code == 429:
-                log.error("Error from mscognitive: %s" % (response.json()))
-                if retries < 15:
-                    time.sleep(2)
-                    retries += 1
+        while result is None:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            upstream.before_request()
+            # The breaker has to hear how this went, whatever happens. It
+            # might be waiting for this request to tell if the service is back.
+            recorded = False
+            try:
+                # Wait for our turn, this is shared with other threads and bots
+                start = time.time()
+                if not self.limiter.acquire(cancelled):
+                    return None
+                metrics.wait_seconds.inc(time.time() - start, api='cv')
+                attempt += 1
+                try:
+                    with metrics.request_seconds.time(api='cv'):
+                        response = get_session().post(self.endpoint, params=params,
+                                                      headers=headers, timeout=TIMEOUT,
+                                                      **body)
+                except requests.exceptions.RequestException as e:
+                    log.error("Error when contacting mscognitive: %s" % e)
+                    upstream.breaker.record_failure()
+                    recorded = True
+                    if not upstream.should_retry(attempt, cancelled):
+                        return None
+                    continue
+
+                # Anything but a server error means the service is up
+                if response.status_code >= 500:
+                    upstream.breaker.record_failure()
                 else:
-                    log.error('failed after retrying!')
+                    upstream.breaker.record_success()
+                recorded = True
 
-            elif response.status_code == 200 or response.status_code == 201:
-                result = response.json() if response.content else None
-            else:
-                log.error("Error code: %d" % (response.status_code))
-                log.error("url: %s" % url)
-                try:
-                    log.error(response.json())
-                except:
-                    log.error(response.text)
-                retries += 1
-                sleep = 20 + retries*4
-                log.info("attempt: {0}, sleeping for {1}".format(retries, sleep))
-                time.sleep(sleep)
+                delay = self.limiter.update(response)
+                if response.status_code == 429:
+                    # The limiter makes everyone wait as long as the server asked
+                    log.error("Error from mscognitive: %s" % (response.text))
+                    log.info("Rate limited, waiting {0:.1f}s".format(delay))
+                    if attempt >= upstream.attempts:
+                        log.error('failed after retrying!')
+                        return None
+                    metrics.retries.inc(api='cv')
 
+                elif (response.status_code == 200 or response.status_code == 201) and response.content:
+                    result = response.json()
+                    metrics.candidates_described.inc()
+                else:
+                    log.error("Error code: %d" % (response.status_code))
+                    log.error("url: %s" % key)
+                    try:
+                        log.error(response.json())
+                    except ValueError:
+                        log.error(response.text)
+                    if 400 <= response.status_code < 500 and response.status_code != 408:
+                        # Something is wrong with the picture or the request
+                        # (too big, bad URL...), asking again won't help
+                        return None
+                    if not upstream.should_retry(attempt, cancelled):
+                        return None
+            finally:
+                if not recorded:
+                    upstream.breaker.release()
+
+        if result is not None and self.cache is not None:
+            self.cache.put(key, result)
         return result
 
-    def get_picture_and_description(self, filename=None, max_retries=20):
-        "Get a picture and a description. Retries until a usable result is produced or max_retries is reached."
-        pic = None
+    describe = describe_picture
+
+    def describe_candidate(self, pic, cancelled=None):
+        """Describe a vetted picture and check the description.
+        Returns a `Result`, or None if the picture is no good"""
+        url = renditions.select(pic, self.rendition)
+
+        with metrics.span('describe'):
+            result = self.backend.describe(url, cancelled)
+        if result is None:
+            return None
+        return self.check_description(pic, url, result)
+
+    def check_description(self, pic, url, result):
+        """Check the description of a vetted picture.
+        Returns a `Result`, or None if the picture is no good"""
+        candidate = filters.Candidate(imageinfo=pic)
+        candidate.description = result
+        # The stages only look at these, so they can run in any order
+        captions = result['description']['captions']
+        if captions:
+            candidate.caption = gender_neutralize(captions[0]['text'])
+        candidate.tags = result['description']['tags']
+        rejection = pipeline.run(candidate, filters.DESCRIPTION)
+        if rejection is not None:
+            stage, reason = rejection
+            metrics.candidates_rejected.inc(stage=stage.name)
+            log_discarded(url, reason, candidate.caption, stage.name)
+            self.record_seen(pic, seen_index.REJECTED, reason)
+            return None
+
+        self.record_seen(pic, seen_index.DESCRIBED)
+        return Result(candidate.caption, candidate.tags, url,
+                      pic['descriptionshorturl'], pic.get('title'),
+                      renditions.picture_info(pic))
+
+    def _describe_in_span(self, pic, cancelled, parent):
+        "describe_candidate for worker threads, traced under the caller's span"
+        with metrics.span('candidate', parent, title=pic.get('title')):
+            return self.describe_candidate(pic, cancelled)
+
+    def record_seen(self, pic, outcome, reason=None):
+        if self.seen is not None and 'title' in pic:
+            self.seen.record(pic['title'], outcome, reason)
+
+    def get_picture_and_description(self, filename=None, max_retries=20,
+                                    timeout=DEFAULT_DEADLINE):
+        """Get a picture and a description. Retries until a usable result is
+        produced, or gives up after max_retries pictures or `timeout` seconds,
+        whichever comes first."""
+        if filename is None and self.described:
+            return self.described.popleft()
+
+        deadline = retry.Deadline(timeout)
+        start = time.time()
+        try:
+            if filename is None and self.describe_batch_size > 0:
+                return self.find_picture_in_batches(max_retries, deadline)
+            if filename is None and self.concurrency > 1:
+                return self.find_picture_concurrently(max_retries, deadline)
+            return self.find_picture(filename, max_retries, deadline)
+        finally:
+            log.info("Looked for a picture for {0:.1f}s, {1:.1f}s of it waiting".format(
+                time.time() - start, deadline.waited))
+
+    def find_picture(self, filename=None, max_retries=20, deadline=None):
+        "Find and describe pictures one by one, until one passes all the filters"
         retries = 0
         while retries <= max_retries:  # retry max 20 times, until we get something good
-            while pic is None:
-                pic = get_picture(filename)
+            if deadline is not None:
+                deadline.check('finding a picture')
+            if filename is None:
+                pic = self.next_candidate(deadline)
+            else:
+                pic = get_picture(filename, deadline=deadline)
                 if pic is None:
-                    # We got a bad picture, let's wait a bit to be polite to the API server
-                    time.sleep(1)
-            url = pic['url']
-            # Use a scaled-down image if the original is too big
-            if pic['size'] > 3000000 or pic['width'] > 8192 or pic['height'] > 8192:
-                url = pic['thumburl']
-
-            result = self.describe_picture(url)
+                    # Asking again won't make it any better
+                    raise Exception("{0} can't be used".format(filename))
 
+            with metrics.span('candidate', title=pic.get('title')):
+                result = self.describe_candidate(pic, deadline)
             if result is not None:
-                description = result['description']
-                adult = result['adult']
-                if not adult['isAdultContent'] and not adult['isRacyContent']:  # no nudity and such
-                    if len(description['captions']) > 0:
-                        caption = description['captions'][0]['text']
-                        caption = gender_neutralize(caption)
-                        if not is_blacklisted(caption):
-                            if not tag_blacklisted(description['tags']):
-                                return Result(caption,
-                                              description['tags'], url,
-                                              pic['descriptionshorturl'])
-                            else:
-                                log_discarded(url, "tag blacklist", caption)
-                                log.warning('tags: %s' % description['tags'])
-                        else:
-                            log_discarded(url, "caption blacklist", caption)
-                    else:
-                        log.warning("No caption for url: {0}".format(url))
-                else:
-                    log_discarded(url, "adult content", description['captions'])
+                return result
+            if filename is not None:
+                raise Exception("No good description for {0}".format(filename))
+
             retries += 1
             log.warning("Not good, retrying...")
-            pic = None
-            time.sleep(3)  # sleep to be polite to the API servers
+            # sleep to be polite to the API servers
+            retry.wait('cv', 3, deadline)
+
+        raise Exception("Maximum retries exceeded, no good picture")
+
+    def find_picture_concurrently(self, max_retries=20, deadline=None):
+        """Like get_picture_and_description, but describes up to
+        `self.concurrency` random pictures at the same time, and returns the
+        first one that passes all the filters. Work that is still outstanding
+        by then is cancelled. Other good pictures, including ones that were
+        already being described when we stopped, are kept for next time."""
+        attempts = 0
+        pending = set()
+        found = None
+        cancelled = retry.Deadline(parent=deadline)
+        executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        try:
+            while found is None and (attempts <= max_retries or pending):
+                while attempts <= max_retries and len(pending) < self.concurrency:
+                    pending.add(executor.submit(self._describe_in_span,
+                                                self.next_candidate(cancelled),
+                                                cancelled, metrics.current_span()))
+                    attempts += 1
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=cancelled.remaining(),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is None:
+                        log.warning("Not good, retrying...")
+                    elif found is None:
+                        found = result
+                    else:
+                        self.described.append(result)
+                if found is None:
+                    cancelled.check('finding a picture')
+        finally:
+            # Don't wait for the describe calls that are still running, they
+            # will notice they were cancelled and return on their own. The
+            # ones that already got a description finish anyway.
+            cancelled.set()
+            for future in pending:
+                future.add_done_callback(self._keep_described)
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if found is not None:
+            return found
+        raise Exception("Maximum retries exceeded, no good picture")
+
+    def _keep_described(self, future):
+        "Keep the result of a describe call nobody waited for, if it's good"
+        if future.cancelled() or future.exception() is not None:
+            return
+        if future.result() is not None:
+            self.described.append(future.result())
+
+    def find_picture_in_batches(self, max_retries=20, deadline=None):
+        """Like get_picture_and_description, but sends `self.describe_batch_size`
+        vetted pictures to the backend at once. Returns the first one that
+        passes all the filters, and keeps the other good ones for next time."""
+        attempts = 0
+        while attempts <= max_retries:
+            if deadline is not None:
+                deadline.check('finding a picture')
+            pics = [self.next_candidate(deadline)
+                    for i in range(min(self.describe_batch_size, max_retries + 1 - attempts))]
+            attempts += len(pics)
+            urls = [renditions.select(pic, self.rendition) for pic in pics]
+            with metrics.span('describe_batch', size=len(pics)):
+                descriptions = self.backend.describe_batch(urls, deadline)
+            for pic, url, description in zip(pics, urls, descriptions):
+                if description.error is not None:
+                    log.error("Describing {0} failed: {1}".format(url, description.error))
+                    continue
+                result = self.check_description(pic, url, description.result)
+                if result is not None:
+                    self.described.append(result)
+            if self.described:
+                return self.described.popleft()
+            log.warning("Not good, retrying...")
 
         raise Exception("Maximum retries exceeded, no good picture")
 
@@ -332,35 +969,249 @@ class NonClosingBytesIO(BytesIO):
             return super().close()
 
 
+class NonClosingSpooledFile(tempfile.SpooledTemporaryFile):
+    """ Like NonClosingBytesIO, but spills over to a temporary file on disk
+    once it grows bigger than `max_size` """
+
+    def close(self, really=False):
+        """ Close the file, but only if you're really sure """
+        if really:
+            return super().close()
+
+
+class NonClosingFile(io.FileIO):
+    """ Like NonClosingBytesIO, but reads a file on disk, such as a picture
+    in the media store """
+
+    def close(self, really=False):
+        """ Close the file, but only if you're really sure """
+        if really:
+            return super().close()
+
+
+# Downloaded pictures are kept here when there is one, see
+# `picdescbot.mediastore`
+media_store = None
+
+
+class SharedPicture(object):
+    """ A downloaded picture that several readers can use at the same time,
+    each with its own position. Readers are created by `open()`. """
+
+    def __init__(self, data):
+        self.data = data
+        self.lock = threading.Lock()
+        data.seek(0, io.SEEK_END)
+        self.size = data.tell()
+
+    def open(self):
+        return PictureReader(self)
+
+    def read_at(self, position, size):
+        with self.lock:
+            self.data.seek(position)
+            return self.data.read(size)
+
+    def close(self):
+        self.data.close(really=True)
+
+
+class PictureReader(io.RawIOBase):
+    """ A file object for reading a `SharedPicture`. Like NonClosingBytesIO,
+    it has to be closed with close(really=True). """
+
+    def __init__(self, picture):
+        self.picture = picture
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.picture.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.picture.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self, really=False):
+        """ Close the reader, but only if you're really sure """
+        if really:
+            return super().close()
+
+
 class Result(object):
-    "Represents a picture and its description"
-    def __init__(self, caption, tags, url, source_url):
+    """ Represents a picture and its description. `url` is the picture that
+    was described, and `picture` has the size of the original and the
+    thumbnail URL template, for picking other renditions of it. """
+    def __init__(self, caption, tags, url, source_url, title=None, picture=None):
         self.caption = caption
         self.tags = tags
         self.url = url
         self.source_url = source_url
+        self.title = title  # The file's page title on Wikimedia Commons
+        self.picture = picture
+        self._pictures = {}  # URL => SharedPicture
+        self._picture_lock = threading.Lock()
 
-    def download_picture(self):
-        "Returns a BytesIO object for an image URL"
-        retries = 0
-        picture = None
-        log.info("downloading " + self.url)
-        while retries <= 20:
-            if retries > 0:
-                log.info('Trying again...')
+    def to_dict(self):
+        "Returns the result as a dict that can be serialized to JSON"
+        return {'caption': self.caption,
+                'tags': self.tags,
+                'url': self.url,
+                'source_url': self.source_url,
+                'title': self.title,
+                'picture': self.picture}
 
-            try:
-                response = requests.get(self.url, headers=HEADERS)
-            except requests.exceptions.RequestException as e:
-                log.exception(e)
-                response = None
-
-            if response is not None and response.status_code == 200:
-                picture = NonClosingBytesIO(response.content)
-                return picture
-            else:
-                log.error("Fetching picture failed: " + response.status_code)
-                retries += 1
-                time.sleep(3)
+    @classmethod
+    def from_dict(cls, data):
+        "Create a result from the output of `to_dict`"
+        return cls(**data)
+
+    def url_for(self, rendition=None):
+        """The URL of the picture in the size that suits a `Rendition`, see
+        `picdescbot.renditions`. Without one, it's the described picture."""
+        if rendition is None or self.picture is None:
+            return self.url
+        return renditions.select(self.picture, rendition)
+
+    def download_picture(self, rendition=None):
+        """Returns a file object with the picture, in the size that suits
+        `rendition`. Each size is only downloaded once, and every call returns
+        a new reader for the same data, so several providers can use the
+        picture at the same time. With a media store, the picture is read
+        from there, and downloaded into it if it isn't there yet."""
+        url = self.url_for(rendition)
+        if media_store is not None:
+            return media_store.fetch(url, lambda picture: self._store(url, picture),
+                                     NonClosingFile)
+        with self._picture_lock:
+            if url not in self._pictures:
+                with metrics.span('download', url=url):
+                    self._pictures[url] = SharedPicture(self._download(url))
+            return self._pictures[url].open()
+
+    def prefetch_pictures(self, renditions=(None,)):
+        """Download the picture in the sizes that suit `renditions` into the
+        media store, so posting doesn't have to wait for it later"""
+        if media_store is None:
+            return
+        for rendition in renditions:
+            url = self.url_for(rendition)
+            if url not in media_store:
+                media_store.add(url, lambda picture: self._store(url, picture))
+
+    def _store(self, url, picture):
+        with metrics.span('download', url=url):
+            self._download(url, picture)
+
+    def release_picture(self):
+        "Free the downloaded pictures, if there are any"
+        with self._picture_lock:
+            for picture in self._pictures.values():
+                picture.close()
+            self._pictures = {}
+
+    def _download(self, url, picture=None):
+        """Download the picture into the `picture` file object. Without one,
+        it's kept in memory for small pictures and spooled to a temporary
+        file for big ones. Returns the file object.
+        Interrupted downloads are resumed where they stopped."""
+        upstream = retry.upstreams['download']
+        attempt = 0
+        spooled = picture is None
+        if spooled:
+            picture = NonClosingSpooledFile(max_size=SPOOL_SIZE)
+        log.info("downloading " + url)
+        try:
+            while True:
+                if attempt > 0:
+                    log.info('Trying again...')
+                upstream.before_request()
+                attempt += 1
+
+                recorded = False
+                try:
+                    try:
+                        with metrics.request_seconds.time(api='download'):
+                            complete = self._download_to(picture, url)
+                    except requests.exceptions.RequestException as e:
+                        log.exception(e)
+                        complete = False
+                    except Exception:
+                        # The server answered, we didn't like it (too big...)
+                        upstream.breaker.record_success()
+                        recorded = True
+                        raise
+                    if complete:
+                        upstream.breaker.record_success()
+                        recorded = True
+                        picture.seek(0)
+                        return picture
+                    upstream.breaker.record_failure()
+                    recorded = True
+                finally:
+                    if not recorded:
+                        upstream.breaker.release()
+                if not upstream.should_retry(attempt):
+                    break
+        except Exception:
+            if spooled:
+                picture.close(really=True)
+            raise
+        if spooled:
+            picture.close(really=True)
         log.error("Maximum retries exceeded when downloading a picture")
         raise Exception("Maximum retries exceeded when downloading a picture")
+
+    def _download_to(self, picture, url):
+        """Stream the picture into a file object, continuing from its current
+        position with a Range request. Returns True when it's complete."""
+        headers = {}
+        offset = picture.tell()
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+        response = get_session().get(url, headers=headers, stream=True,
+                                     timeout=TIMEOUT)
+        with response:
+            if response.status_code == 200 and offset > 0:
+                # The server doesn't support ranges, start over
+                log.info("Can't resume download, restarting")
+                picture.seek(0)
+                picture.truncate()
+            elif response.status_code == 416:
+                # Whatever we have is broken somehow, start over next time
+                picture.seek(0)
+                picture.truncate()
+                return False
+            elif response.status_code not in (200, 206):
+                log.error("Fetching picture failed: {0}".format(response.status_code))
+                return False
+
+            expected = response.headers.get('Content-Length')
+            if expected is not None:
+                expected = picture.tell() + int(expected)
+                if expected > MAX_PICTURE_SIZE:
+                    raise Exception("Picture is too big ({0} bytes)".format(expected))
+
+            for chunk in response.iter_content(CHUNK_SIZE):
+                picture.write(chunk)
+                if picture.tell() > MAX_PICTURE_SIZE:
+                    raise Exception("Picture is too big (more than {0} bytes)".format(MAX_PICTURE_SIZE))
+        if expected is not None and picture.tell() < expected:
+            log.error("Download interrupted after {0} of {1} bytes".format(picture.tell(), expected))
+            return False
+        return True
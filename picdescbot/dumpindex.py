@@ -0,0 +1,349 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements an index of candidate pictures, built offline from Wikimedia Commons database dumps
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import array
+import bisect
+import bz2
+import functools
+import gzip
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+from . import common
+from . import filters
+from . import logger
+
+log = logger.get("dumpindex")
+
+DEFAULT_PATH = "candidates.idx"
+
+# The index is a header, `count` + 1 offsets into the titles, and the titles
+# themselves, as they appear in the dumps (UTF-8, no namespace, underscores
+# instead of spaces). Title i is blob[offsets[i]:offsets[i + 1]].
+MAGIC = b'PDBIDX01'
+HEADER = struct.Struct('<8sQ')  # magic, count
+OFFSET = struct.Struct('<Q')
+OFFSET_PAIR = struct.Struct('<QQ')
+
+# The filters that only need what's in the image table. Everything else
+# is checked live, once a picture is picked from the index.
+STATIC_STAGES = ('mediatype', 'size', 'format', 'title')
+
+FILE_NAMESPACE = b'6'
+
+# How many rows to go through between progress messages
+PROGRESS_EVERY = 1000000
+
+# How many values are sorted in memory at once, see `_sort_unique`. They
+# are Python ints while they're sorted, so this takes about 40MB.
+SORT_CHUNK = 1000000
+
+# SQL dumps have a CREATE TABLE statement with a column per line, followed
+# by INSERT statements of many rows each, one statement per line.
+_COLUMN = re.compile(rb"^\s+`(\w+)`")
+_TOKEN = re.compile(rb"'((?:[^'\\]|\\.)*)'|(NULL)|([(),])|([^,()']+)", re.S)
+_ESCAPE = re.compile(rb"\\(.)", re.S)
+_ESCAPES = {b'0': b'\0', b'n': b'\n', b'r': b'\r', b't': b'\t', b'Z': b'\x1a'}
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _unescape(value):
+    if b'\\' not in value:
+        return value
+    return _ESCAPE.sub(lambda match: _ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def _rows(line):
+    "Parse the rows of an INSERT statement. Values are bytes, or None for NULL."
+    row = None
+    for match in _TOKEN.finditer(line, line.index(b' VALUES ') + 8):
+        string, null, punctuation, bare = match.groups()
+        if punctuation == b'(':
+            row = []
+        elif punctuation == b')':
+            yield row
+            row = None
+        elif row is None or punctuation is not None:
+            continue
+        elif string is not None:
+            row.append(_unescape(string))
+        elif null is not None:
+            row.append(None)
+        else:
+            row.append(bare.strip())
+
+
+def read_table(path, columns):
+    """Stream the rows of a table from a MySQL dump, like the ones on
+    dumps.wikimedia.org, one line at a time. Yields a tuple with the values
+    of `columns` for every row."""
+    names = []
+    indexes = None
+    with _open(path) as f:
+        for line in f:
+            if line.startswith(b'INSERT INTO'):
+                if indexes is None:
+                    missing = [column for column in columns if column.encode('ascii') not in names]
+                    if missing:
+                        raise Exception("{0} has no {1} column".format(path, ', '.join(missing)))
+                    indexes = [names.index(column.encode('ascii')) for column in columns]
+                for row in _rows(line):
+                    yield tuple(row[i] for i in indexes)
+            elif line.startswith(b'CREATE TABLE'):
+                names = []
+            elif indexes is None:
+                match = _COLUMN.match(line)
+                if match is not None:
+                    names.append(match.group(1))
+
+
+def _hash(title):
+    "A 64 bit hash of a title, for remembering lots of them in little memory"
+    return int.from_bytes(hashlib.blake2b(title, digest_size=8).digest(), 'little', signed=True)
+
+
+def _contains(values, value):
+    "Is `value` in a sorted array?"
+    i = bisect.bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+def _spill(chunk):
+    "Write a chunk of values to a temporary file, sorted and without duplicates"
+    run = tempfile.TemporaryFile()
+    array.array('q', sorted(set(chunk))).tofile(run)
+    run.seek(0)
+    return run
+
+
+def _read_run(run, count=65536):
+    while True:
+        block = array.array('q')
+        try:
+            block.fromfile(run, count)
+        except EOFError:
+            # fromfile still reads whatever was left
+            yield from block
+            return
+        yield from block
+
+
+def _sort_unique(values, chunk_size=SORT_CHUNK):
+    """Sort 64 bit ints, and remove duplicates. Returns an array, 8 bytes
+    per value. Values are sorted `chunk_size` at a time, spilled to
+    temporary files, and merged, so there are never more than `chunk_size`
+    of them as Python objects."""
+    runs = []
+    chunk = array.array('q')
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= chunk_size:
+            runs.append(_spill(chunk))
+            chunk = array.array('q')
+    if chunk:
+        runs.append(_spill(chunk))
+    result = array.array('q')
+    for value in heapq.merge(*[_read_run(run) for run in runs]):
+        if not result or result[-1] != value:
+            result.append(value)
+    for run in runs:
+        run.close()
+    return result
+
+
+def _progress(what, count):
+    if count % PROGRESS_EVERY == 0:
+        log.info("{0}: {1} rows".format(what, count))
+
+
+def blacklisted_files(categorylinks, matcher, cache_size=100000):
+    """Page ids of the files in blacklisted categories, as a sorted array.
+    Only the blacklisted ones are kept, 8 bytes each."""
+    @functools.lru_cache(maxsize=cache_size)
+    def blacklisted(category):
+        title = 'Category:' + category.decode('utf-8', 'replace').replace('_', ' ')
+        return matcher.search(title) is not None
+
+    def blacklisted_ids():
+        count = 0
+        for page_id, category, link_type in read_table(categorylinks,
+                                                       ('cl_from', 'cl_to', 'cl_type')):
+            count += 1
+            _progress(categorylinks, count)
+            if link_type == b'file' and blacklisted(category):
+                yield int(page_id)
+
+    ids = _sort_unique(blacklisted_ids())
+    log.info("{0} files are in blacklisted categories".format(len(ids)))
+    return ids
+
+
+def blacklisted_titles(page, ids):
+    "Hashes of the titles of the files with these page ids, as a sorted array"
+    def hashes():
+        count = 0
+        for page_id, namespace, title in read_table(page, ('page_id', 'page_namespace',
+                                                           'page_title')):
+            count += 1
+            _progress(page, count)
+            if namespace == FILE_NAMESPACE and _contains(ids, int(page_id)):
+                yield _hash(title)
+
+    return _sort_unique(hashes())
+
+
+class IndexWriter(object):
+    """ Writes an index one title at a time. Offsets and titles go to
+    temporary files until `close`, so memory use doesn't depend on how many
+    titles there are. The index replaces `path` atomically. """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        self.offsets = tempfile.TemporaryFile(dir=directory)
+        self.blob = tempfile.TemporaryFile(dir=directory)
+        self.count = 0
+        self.size = 0
+        self.offsets.write(OFFSET.pack(0))
+
+    def add(self, title):
+        self.blob.write(title)
+        self.size += len(title)
+        self.count += 1
+        self.offsets.write(OFFSET.pack(self.size))
+
+    def close(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.count))
+            for part in (self.offsets, self.blob):
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+                part.close()
+        os.replace(temporary, self.path)
+
+
+def build(path, image, page=None, categorylinks=None):
+    """Build an index of the pictures in an image table dump that pass the
+    static filters. With the page and categorylinks dumps, pictures in
+    blacklisted categories are left out too. Returns how many made it."""
+    bad_titles = array.array('q')
+    if categorylinks is not None and page is not None:
+        ids = blacklisted_files(categorylinks, common.get_filters()['categories'])
+        bad_titles = blacklisted_titles(page, ids)
+        del ids
+
+    stages = [stage for stage in common.pipeline.stages if stage.name in STATIC_STAGES]
+    rejections = dict.fromkeys([stage.name for stage in stages] + ['categories'], 0)
+    writer = IndexWriter(path)
+    count = 0
+    for name, width, height, media_type in read_table(image, ('img_name', 'img_width',
+                                                              'img_height', 'img_media_type')):
+        count += 1
+        _progress(image, count)
+        title = name.decode('utf-8', 'replace').replace('_', ' ')
+        candidate = filters.Candidate({'title': 'File:' + title},
+                                      {'url': title,
+                                       'mediatype': (media_type or b'').decode('ascii', 'replace'),
+                                       'width': int(width or 0),
+                                       'height': int(height or 0)})
+        for stage in stages:
+            if stage.check(candidate) is not None:
+                rejections[stage.name] += 1
+                break
+        else:
+            if bad_titles and _contains(bad_titles, _hash(name)):
+                rejections['categories'] += 1
+            else:
+                writer.add(name)
+    writer.close()
+    log.info("Indexed {0} of {1} pictures, rejected: {2}".format(
+        writer.count, count, ', '.join('{0} {1}'.format(value, key)
+                                       for key, value in sorted(rejections.items()))))
+    return writer.count
+
+
+class CandidateIndex(object):
+    """ A memory-mapped index built by `build`. Picking a picture reads two
+    offsets and a title, so the index can be much bigger than memory. """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise Exception("{0} isn't a candidate index".format(path))
+        self.blob = HEADER.size + OFFSET.size * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        "The page title of picture number `i`"
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start, end = OFFSET_PAIR.unpack_from(self.map, HEADER.size + OFFSET.size * i)
+        name = self.map[self.blob + start:self.blob + end].decode('utf-8', 'replace')
+        return 'File:' + name.replace('_', ' ')
+
+    def sample(self, count, rng=random):
+        "Pick up to `count` different pictures, uniformly at random"
+        if self.count == 0:
+            return []
+        picks = {rng.randrange(self.count) for i in range(count)}
+        return [self[i] for i in sorted(picks)]
+
+    def close(self):
+        self.map.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an index of candidate pictures from Commons dumps')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build_parser = subparsers.add_parser('build', help='Build an index from SQL dumps')
+    build_parser.add_argument('--image', required=True,
+                              help='Dump of the image table (commonswiki-*-image.sql.gz)')
+    build_parser.add_argument('--page', help='Dump of the page table')
+    build_parser.add_argument('--categorylinks', help='Dump of the categorylinks table')
+    build_parser.add_argument('--output', default=DEFAULT_PATH)
+    sample_parser = subparsers.add_parser('sample', help='Print random pictures from an index')
+    sample_parser.add_argument('path', nargs='?', default=DEFAULT_PATH)
+    sample_parser.add_argument('--count', type=int, default=10)
+    args = parser.parse_args()
+    logger.setup()
+
+    if args.command == 'build':
+        if (args.page is None) != (args.categorylinks is None):
+            parser.error("--page and --categorylinks go together")
+        build(args.output, args.image, args.page, args.categorylinks)
+        return
+
+    index = CandidateIndex(args.path)
+    print("{0} pictures".format(len(index)))
+    for title in index.sample(args.count):
+        print(title)
+    index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements the pipeline of filters that decides if a picture is usable
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import threading
+import time
+
+# The data a stage needs. Stages run in phases, as the data becomes available:
+METADATA = 'metadata'  # the page from the MediaWiki API, free to check
+LINKS = 'links'  # categories and global usage, fetched page by page
+DESCRIPTION = 'description'  # the Computer Vision result, which costs money
+PHASES = [METADATA, LINKS, DESCRIPTION]
+
+
+class Candidate(object):
+    "A picture going through the pipeline, and everything we know about it"
+    def __init__(self, page=None, imageinfo=None):
+        self.page = page
+        self.imageinfo = imageinfo
+        if imageinfo is None and page is not None and 'imageinfo' in page:
+            self.imageinfo = page['imageinfo'][0]
+        self.url = self.imageinfo['url'] if self.imageinfo else None
+        self.description = None  # Computer Vision API result
+        self.caption = None
+        self.tags = []
+
+
+class Stage(object):
+    """ A single check. `check` gets a `Candidate`, and returns the reason to
+    reject it, or None if it's fine. `cost` is a rough relative estimate of
+    how expensive the check is, cheap stages run first. Quiet stages reject
+    lots of boring stuff, so their rejections aren't logged. """
+
+    def __init__(self, name, check, cost, needs=METADATA, quiet=False):
+        self.name = name
+        self.check = check
+        self.cost = cost
+        self.needs = needs
+        self.quiet = quiet
+        self.calls = 0
+        self.rejections = 0
+        self.time = 0.0
+
+
+class Pipeline(object):
+    """ An ordered collection of `Stage`s.
+
+    Stages are sorted by cost, and the first rejection stops the run, so a
+    picture never costs more than the cheapest check that can reject it.
+    Every stage counts how often it ran, how often it rejected, and how much
+    time it took, see `stats()`.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def add(self, stage):
+        self.stages.append(stage)
+        # sorted() is stable, so stages with the same cost keep their order
+        self.stages = sorted(self.stages, key=lambda stage: (PHASES.index(stage.needs),
+                                                             stage.cost))
+        return stage
+
+    def stage(self, name, cost, needs=METADATA, quiet=False):
+        "Decorator for adding a check function as a stage"
+        def decorator(check):
+            self.add(Stage(name, check, cost, needs, quiet))
+            return check
+        return decorator
+
+    def run(self, candidate, phase=METADATA):
+        """Run all the stages of a phase on a candidate, cheapest first.
+        Returns a (stage, reason) tuple for the first rejection, or None."""
+        for stage in self.stages:
+            if stage.needs != phase:
+                continue
+            start = time.perf_counter()
+            reason = stage.check(candidate)
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stage.calls += 1
+                stage.time += elapsed
+                if reason is not None:
+                    stage.rejections += 1
+            if reason is not None:
+                return stage, reason
+        return None
+
+    def stats(self):
+        "Returns a list of per-stage counters, in the order the stages run"
+        with self.lock:
+            return [{'stage': stage.name,
+                     'needs': stage.needs,
+                     'cost': stage.cost,
+                     'calls': stage.calls,
+                     'rejections': stage.rejections,
+                     'time': stage.time} for stage in self.stages]
+
+    def report(self):
+        "A human-readable table of the stage counters"
+        lines = ["{0:<20} {1:<12} {2:>7} {3:>9} {4:>10}".format(
+            'stage', 'needs', 'calls', 'rejected', 'time (ms)')]
+        for stat in self.stats():
+            lines.append("{stage:<20} {needs:<12} {calls:>7} {rejections:>9} {ms:>10.2f}".format(
+                ms=stat['time'] * 1000, **stat))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            for stage in self.stages:
+                stage.calls = stage.rejections = 0
+                stage.time = 0.0
@@ -2,28 +2,136 @@
 # picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
 # this file contains logging related functionality
 # Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+import atexit
+import datetime
+import gzip
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 setup_done = False
+listener = None
 
 fomatstr = '%(asctime)s : %(name)s: %(levelname)s: %(message)s'
 datefmt = "%Y-%m-%d %H:%M:%S"
 
-logging.basicConfig(level=logging.INFO,
-                    format=fomatstr,
-                    datefmt=datefmt,
-                    filename="all.log")
-
 formatter = logging.Formatter(fomatstr, datefmt=datefmt)
 
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+# Attributes every LogRecord has, anything else was passed with `extra`
+_standard_attributes = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__)
+_standard_attributes.update(['message', 'asctime'])
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats records as JSON lines, one object per record.
+    Fields passed with `extra` (such as url, reason and stage) become
+    fields of the object, so the log can be analysed by machines. """
+
+    def format(self, record):
+        data = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in _standard_attributes and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _file_handler(filename, config, rotate=True):
+    """Create a handler for a log file, rotated by size or by time as
+    configured. Rotated files are gzipped unless `compress` is off.
+
+    Only one process may rotate a log file, or they race and lose records.
+    With `rotate = external` (such as logrotate), or in processes that
+    don't own the rotation (`rotate` is False), the file is reopened
+    whenever someone else rotated it instead."""
+    mode = config.get('rotate', 'size')
+    backups = int(config.get('backup_count', 5))
+    if not rotate or mode == 'external':
+        return logging.handlers.WatchedFileHandler(filename)
+    if mode == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=config.get('when', 'midnight'), backupCount=backups)
+    elif mode == 'size':
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=int(config.get('max_bytes', 10*1024*1024)),
+            backupCount=backups)
+    else:
+        return logging.FileHandler(filename)
+    if str(config.get('compress', 'yes')).lower() in ('yes', 'true', 'on', '1'):
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+def _parse_levels(text):
+    "Parse per-subsystem levels, like 'common:DEBUG, tumblr:WARNING'"
+    levels = {}
+    for item in text.split(','):
+        if item.strip():
+            name, level = item.split(':')
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(config=None, rotate=True):
+    """Set up logging to the console, all.log and filtered.log.
+    Only the first call does anything.
+
+    Records are put on a queue and written by a background thread, so
+    logging never blocks the code that logs. filtered.log is written as
+    JSON lines. `config` is the optional [logging] config section, see
+    `_file_handler` for the rotation options; `level` sets the overall
+    level and `levels` the level of each subsystem. When several processes
+    write the same files, only one of them should `rotate` them."""
+    global setup_done, listener
+    if setup_done:
+        return
+    setup_done = True
+    if config is None:
+        config = {}
+
+    all_log = _file_handler(config.get('all_log', "all.log"), config, rotate)
+    if str(config.get('json', 'no')).lower() in ('yes', 'true', 'on', '1'):
+        all_log.setFormatter(JSONFormatter())
+    else:
+        all_log.setFormatter(formatter)
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(formatter)
+
+    filtered = _file_handler(config.get('filtered_log', "filtered.log"), config, rotate)
+    filtered.setLevel(logging.WARNING)
+    filtered.setFormatter(JSONFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger('')
+    root.setLevel(config.get('level', 'INFO').upper())
+    root.addHandler(logging.handlers.QueueHandler(records))
+    for name, level in _parse_levels(config.get('levels', '')).items():
+        get(name).setLevel(level)
 
-filtered = logging.FileHandler("filtered.log")
-filtered.setLevel(logging.WARNING)
-filtered.setFormatter(formatter)
-logging.getLogger('').addHandler(filtered)
+    listener = logging.handlers.QueueListener(records, all_log, console, filtered,
+                                              respect_handler_level=True)
+    listener.start()
+    # Write out whatever is still in the queue when we exit
+    atexit.register(listener.stop)
 
 
 def get(name):
@@ -0,0 +1,108 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements matching text against many blacklists at once
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import collections
+import re
+
+# How a pattern is matched against the text:
+SUBSTRING = 'substring'  # anywhere in the text, like Wordfilter does
+WORD = 'word'  # as a whole whitespace-separated word
+EXACT = 'exact'  # the whole text must be the pattern
+
+Match = collections.namedtuple('Match', ['rule', 'pattern'])
+
+
+def _trie_regex(patterns):
+    """ Build a regular expression matching any of the patterns, factored by
+    common prefixes. Python's re module tries every alternative of a flat
+    alternation at each position, a trie-shaped regex is much faster. """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        optional = '' in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        regex = '(?:' + '|'.join(branches) + ')'
+        return regex + '?' if optional else regex
+    return build(trie)
+
+
+class Matcher(object):
+    """ Matches text against several named lists of patterns in one pass.
+
+    All the patterns are compiled into a single regular expression, so
+    scanning a field costs one regex search instead of a loop over every
+    blacklist entry. Matching is case-insensitive. `search` reports which rule
+    matched, so callers can still explain why something was discarded.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        self._patterns = {SUBSTRING: [], WORD: [], EXACT: []}
+        self._regex = None
+
+    def add(self, rule, patterns, mode=SUBSTRING):
+        "Add a named list of patterns"
+        for pattern in patterns:
+            pattern = pattern.lower()
+            # The same text can be in several modes, each is matched on its
+            # own. Within a mode, the first rule that added it wins.
+            if not pattern or (pattern, mode) in self._rules:
+                continue
+            self._rules[pattern, mode] = Match(rule, pattern)
+            self._patterns[mode].append(pattern)
+        self._regex = None
+        return self
+
+    @property
+    def regex(self):
+        if self._regex is None:
+            # Each mode is a named group, so we know which one matched
+            alternatives = []
+            if self._patterns[SUBSTRING]:
+                alternatives.append(r'(?P<{0}>{1})'.format(
+                    SUBSTRING, _trie_regex(self._patterns[SUBSTRING])))
+            if self._patterns[WORD]:
+                alternatives.append(r'(?<!\S)(?P<{0}>{1})(?!\S)'.format(
+                    WORD, _trie_regex(self._patterns[WORD])))
+            if self._patterns[EXACT]:
+                alternatives.append(r'^(?P<{0}>{1})$'.format(
+                    EXACT, _trie_regex(self._patterns[EXACT])))
+            if not alternatives:
+                alternatives.append(r'(?!)')  # never matches
+            self._regex = re.compile('|'.join(alternatives), re.MULTILINE)
+        return self._regex
+
+    def search(self, text):
+        "Returns a `Match` for the first blacklisted pattern in text, or None"
+        found = self.regex.search(text.lower())
+        if found is None:
+            return None
+        return self._match(found)
+
+    def search_many(self, texts):
+        """ Scan several short texts (such as category names) in one pass.
+        Returns a (text, Match) tuple for the first hit, or None """
+        texts = [text.replace('\n', ' ') for text in texts]
+        joined = '\n'.join(texts).lower()
+        found = self.regex.search(joined)
+        if found is None:
+            return None
+        index = joined.count('\n', 0, found.start())
+        return texts[index], self._match(found)
+
+    def _match(self, found):
+        return self._rules[found.group(found.lastgroup), found.lastgroup]
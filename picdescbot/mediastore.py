@@ -0,0 +1,198 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements an on-disk store for downloaded pictures
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from . import logger
+
+log = logger.get("mediastore")
+
+DEFAULT_PATH = "media"
+
+INDEX_FILE = "index.db"
+OBJECTS_DIR = "objects"
+TMP_DIR = "tmp"
+
+# Temporary files older than this were left behind by a crash
+STALE_TMP = 3600
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _open_binary(path):
+    return io.open(path, 'rb')
+
+
+class MediaStore(object):
+    """ Downloaded pictures, kept on disk between runs.
+
+    Pictures are stored once per content, under their SHA-256, and an index
+    in SQLite maps URLs to them. Downloads go to a temporary file that is
+    renamed into place once it's complete, so a picture in the store is
+    never partial. When the store grows beyond `max_bytes`, the least
+    recently used pictures are removed.
+
+    Several processes can share a store, such as a queue filler and a bot
+    posting from the queue.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=1024*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.objects = os.path.join(path, OBJECTS_DIR)
+        self.tmp = os.path.join(path, TMP_DIR)
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+        self._clean_tmp()
+        self.db = sqlite3.connect(os.path.join(path, INDEX_FILE), timeout=60,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                        "sha256 TEXT PRIMARY KEY, "
+                        "size INTEGER NOT NULL, "
+                        "last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS objects_last_used "
+                        "ON objects (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls ("
+                        "url TEXT PRIMARY KEY, "
+                        "sha256 TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256)")
+        self.db.commit()
+
+    def _clean_tmp(self):
+        for name in os.listdir(self.tmp):
+            path = os.path.join(self.tmp, name)
+            try:
+                if os.path.getmtime(path) < time.time() - STALE_TMP:
+                    os.unlink(path)
+            except OSError:
+                pass  # Someone else cleaned it up
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def open(self, url, opener=_open_binary):
+        """Returns the stored picture for `url` as a file opened with
+        `opener(path)`, or None if it isn't stored"""
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM urls WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                f = opener(self._object_path(row[0]))
+            except FileNotFoundError:
+                # Evicted by another process, or deleted by hand
+                self._forget(row[0])
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE objects SET last_used = ? WHERE sha256 = ?",
+                            (time.time(), row[0]))
+            self.db.commit()
+            return f
+
+    def __contains__(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM urls WHERE url = ?", (url,)).fetchone()
+        return row is not None and os.path.exists(self._object_path(row[0]))
+
+    def add(self, url, download):
+        """Store the picture at `url`. `download` is called with a file to
+        write it into. Returns its SHA-256."""
+        fd, temporary = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                download(f)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = _sha256(temporary)
+            size = os.path.getsize(temporary)
+            path = self._object_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.lock:
+                # Renaming is atomic, and if the same picture is already
+                # there under another URL, it's replaced by an identical copy
+                os.replace(temporary, path)
+                self.db.execute("INSERT OR REPLACE INTO objects (sha256, size, last_used) "
+                                "VALUES (?, ?, ?)", (digest, size, time.time()))
+                self.db.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)",
+                                (url, digest))
+                self._evict(keep=digest)
+                self.db.commit()
+        except Exception:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        return digest
+
+    def fetch(self, url, download, opener=_open_binary):
+        """Like `open`, but stores the picture first if it isn't there yet,
+        see `add`"""
+        f = self.open(url, opener)
+        if f is not None:
+            self.hits += 1
+            return f
+        self.misses += 1
+        self.add(url, download)
+        f = self.open(url, opener)
+        if f is None:
+            raise Exception("{0} was evicted from the media store right away".format(url))
+        return f
+
+    def size(self):
+        "How many bytes the stored pictures take"
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def _evict(self, keep=None):
+        "Remove the least recently used pictures, until the store fits in max_bytes"
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for digest, size in self.db.execute("SELECT sha256, size FROM objects "
+                                            "ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.unlink(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+            self._forget(digest)
+            total -= size
+            log.debug("Evicted {0} ({1} bytes)".format(digest, size))
+
+    def _forget(self, digest):
+        self.db.execute("DELETE FROM urls WHERE sha256 = ?", (digest,))
+        self.db.execute("DELETE FROM objects WHERE sha256 = ?", (digest,))
+
+    def stats(self):
+        "Returns a dict with the hit and miss counters"
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
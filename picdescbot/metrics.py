@@ -0,0 +1,266 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements metrics and tracing for the bot
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Counter(object):
+    "A value that only goes up, one per set of labels"
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] += amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value}
+                    for key, value in sorted(self.values.items())]
+
+    def prometheus(self):
+        with self.lock:
+            return ['{0}{1} {2}'.format(self.name, _format_labels(key), value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Histogram(object):
+    "Counts observations in buckets, one set of buckets per set of labels"
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels => [bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        "Observe how long the block took"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key),
+                     'count': sum(counts[:-1]),
+                     'sum': counts[-1],
+                     'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                         itertools.accumulate(counts[:-1])))}
+                    for key, counts in sorted(self.values.items())]
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = list(itertools.accumulate(counts[:-1]))
+                for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], cumulative):
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        self.name, _format_labels(key, [('le', bound)]), count))
+                lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(key), counts[-1]))
+                lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(key), cumulative[-1]))
+        return lines
+
+
+class Registry(object):
+    "All the metrics, and the most recent traces"
+    def __init__(self, max_traces=20):
+        self.metrics = collections.OrderedDict()
+        self.traces = collections.deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def to_prometheus(self):
+        "All the metrics in the Prometheus text exposition format"
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        "All the metrics and recent traces, as a JSON-serializable dict"
+        with self.lock:
+            traces = [span.to_dict() for span in self.traces]
+        return {'time': time.time(),
+                'metrics': {name: {'type': metric.kind, 'help': metric.help,
+                                   'values': metric.snapshot()}
+                            for name, metric in self.metrics.items()},
+                'traces': traces}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def write(self, path):
+        "Write a snapshot to a file, in Prometheus format if it ends with .prom"
+        data = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+
+class Span(object):
+    "A timed step of a trace, with its child steps"
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        if parent is not None:
+            with _children_lock:
+                parent.children.append(self)
+
+    def to_dict(self):
+        with _children_lock:
+            children = list(self.children)
+        return {'name': self.name, 'start': self.start,
+                'duration': self.duration, 'error': self.error,
+                'attributes': self.attributes,
+                'children': [child.to_dict() for child in children]}
+
+    def format(self, indent=0):
+        "A human-readable tree of this span and its children"
+        duration = '...' if self.duration is None else '{0:.3f}s'.format(self.duration)
+        attributes = ' '.join('{0}={1}'.format(k, v) for k, v in sorted(self.attributes.items()))
+        if self.error is not None:
+            attributes += ' error={0}'.format(self.error)
+        lines = ['{0}{1:<{2}} {3:>9} {4}'.format('  ' * indent, self.name, 30 - 2 * indent,
+                                                  duration, attributes).rstrip()]
+        with _children_lock:
+            children = list(self.children)
+        for child in children:
+            lines.append(child.format(indent + 1))
+        return '\n'.join(lines)
+
+
+_children_lock = threading.Lock()
+_local = threading.local()
+
+
+def current_span():
+    "The innermost span of the current thread, if any"
+    return getattr(_local, 'span', None)
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Time a step of the current trace. The parent is the current thread's
+    innermost span, pass it explicitly when starting work in other threads.
+    Spans without a parent start a new trace."""
+    if parent is None:
+        parent = current_span()
+    current = Span(name, parent, **attributes)
+    previous = current_span()
+    _local.span = current
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _local.span = previous
+        if parent is None:
+            with registry.lock:
+                registry.traces.append(current)
+
+
+registry = Registry()
+
+candidates_fetched = registry.counter('picdescbot_candidates_fetched_total',
+                                      'Candidate pictures fetched from MediaWiki')
+candidates_rejected = registry.counter('picdescbot_candidates_rejected_total',
+                                       'Candidate pictures rejected, by filter stage')
+candidates_described = registry.counter('picdescbot_candidates_described_total',
+                                        'Pictures described by the Computer Vision API')
+retries = registry.counter('picdescbot_retries_total',
+                           'Retried requests, by API')
+request_seconds = registry.histogram('picdescbot_request_seconds',
+                                     'Latency of requests to MediaWiki, Computer Vision and downloads, by API')
+wait_seconds = registry.counter('picdescbot_wait_seconds_total',
+                                'Time spent waiting for rate limits and before retries, by API')
+send_seconds = registry.histogram('picdescbot_send_seconds',
+                                  'Time to post to a provider, including its retries')
+
+
+def profile_report():
+    "A per-stage time breakdown, for --profile"
+    lines = ['Time per API:']
+    for histogram in (request_seconds, send_seconds):
+        for value in histogram.snapshot():
+            label = ','.join('{0}={1}'.format(k, v) for k, v in sorted(value['labels'].items()))
+            lines.append('  {0:<24} {1:>5} calls {2:>9.3f}s total {3:>8.3f}s avg'.format(
+                label, value['count'], value['sum'],
+                value['sum'] / value['count'] if value['count'] else 0))
+    for value in wait_seconds.snapshot():
+        lines.append('  waiting for {0:<12} {1:>21.3f}s total'.format(
+            value['labels'].get('api', ''), value['value']))
+    with registry.lock:
+        trace = registry.traces[-1] if registry.traces else None
+    if trace is not None:
+        lines.append('Last trace:')
+        lines.append(trace.format(1))
+    return '\n'.join(lines)
@@ -0,0 +1,236 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements running several bot accounts in one process
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import collections
+import configparser
+import os.path
+import signal
+import threading
+import time
+from . import logger
+from . import matcher
+from . import metrics
+from . import posting
+from . import providers
+from . import scheduler
+from . import seen as seen_index
+from .matcher import Matcher
+
+log = logger.get("multi")
+
+# Tenants are configured in sections like this:
+#
+#   [tenant:picdescbot]
+#   providers = twitter:picdescbot, tumblr:picdescbot
+#   schedule = 1h
+#   blacklist = clock, tower
+#
+#   [twitter:picdescbot]
+#   consumer_key = ...
+#
+# `providers` names the sections with the provider settings, the provider
+# is the part before the colon. Instead of `providers`, `config` can point
+# to the config file of a single bot, and its [twitter] and [tumblr]
+# sections are used.
+TENANT_PREFIX = 'tenant:'
+
+
+class Tenant(object):
+    """ One bot account (or several accounts posting the same thing).
+    It has its own providers, schedule, extra blacklist, and history of
+    what it posted. Everything else is shared. """
+
+    def __init__(self, name, clients, schedule, blacklist=(), history=None):
+        self.name = name
+        self.providers = clients
+        self.schedule = schedule
+        self.history = history
+        self.filter = None
+        if blacklist:
+            self.filter = Matcher().add('tenant', blacklist, matcher.WORD)
+
+    def accepts(self, result):
+        "Does this tenant want to post this picture?"
+        if self.history is not None and result.title in self.history:
+            return False
+        if self.filter is not None and (self.filter.search(result.caption) or
+                                        self.filter.search_many(result.tags)):
+            return False
+        return True
+
+    def record_posted(self, result):
+        if self.history is not None and result.title is not None:
+            self.history.record(result.title, seen_index.POSTED)
+
+
+class Supply(object):
+    """ Described pictures, shared by all the tenants.
+
+    A picture a tenant doesn't want is kept for the others, up to `size`
+    pictures for `max_age` seconds, so no tenant pays for finding pictures
+    another tenant would have found anyway. Kept pictures aren't marked as
+    described in the seen index until a tenant takes them, so they can be
+    found again if they're dropped, or if we stop before that. """
+
+    def __init__(self, cvapi, size=50, max_age=24*3600, max_tries=20):
+        self.cvapi = cvapi
+        self.size = size
+        self.max_age = max_age
+        self.max_tries = max_tries
+        self.spare = collections.deque()  # (added, result)
+        self.lock = threading.Lock()
+        # CVAPIClient isn't meant to be used by several threads at once
+        self.fetch_lock = threading.Lock()
+
+    def _take_spare(self, tenant):
+        with self.lock:
+            while self.spare and self.spare[0][0] < time.time() - self.max_age:
+                self.spare.popleft()
+            for item in self.spare:
+                if tenant.accepts(item[1]):
+                    self.spare.remove(item)
+                    self._mark(item[1], seen_index.DESCRIBED)
+                    return item[1]
+        return None
+
+    def _keep(self, result):
+        with self.lock:
+            self.spare.append((time.time(), result))
+            while len(self.spare) > self.size:
+                self.spare.popleft()
+            self._mark(result, None)
+
+    def _mark(self, result, outcome):
+        "Record what happened to a picture in the seen index, or forget it"
+        seen = self.cvapi.seen
+        if seen is None or result.title is None:
+            return
+        if outcome is None:
+            seen.forget(result.title)
+        else:
+            seen.record(result.title, outcome)
+
+    def get(self, tenant):
+        "Returns a picture for a tenant, reusing pictures other tenants didn't want"
+        for attempt in range(self.max_tries):
+            result = self._take_spare(tenant)
+            if result is not None:
+                return result
+            with self.fetch_lock:
+                # Someone might have left something while we were waiting
+                result = self._take_spare(tenant)
+                if result is None:
+                    result = self.cvapi.get_picture_and_description()
+            if tenant.accepts(result):
+                return result
+            log.info("{0} doesn't want {1}, keeping it for the others".format(
+                tenant.name, result.title))
+            self._keep(result)
+        raise Exception("No picture {0} wants after {1} tries".format(tenant.name,
+                                                                       self.max_tries))
+
+
+def _provider_sections(config, section):
+    "Returns a list of (provider, config section) for a tenant"
+    if 'config' in section:
+        path = os.path.expanduser(section['config'])
+        other = configparser.ConfigParser()
+        if not other.read(path):
+            raise Exception("Can't read {0}".format(path))
+        return [(name, other[name]) for name in providers.PROVIDERS if other.has_section(name)]
+    sections = []
+    for item in section.get('providers', '').split(','):
+        item = item.strip()
+        if item:
+            sections.append((item.split(':')[0], config[item]))
+    return sections
+
+
+def load_tenants(config, default_schedule='1h'):
+    "Create the tenants configured in [tenant:...] sections"
+    tenants = []
+    for section_name in config.sections():
+        if not section_name.startswith(TENANT_PREFIX):
+            continue
+        name = section_name[len(TENANT_PREFIX):]
+        section = config[section_name]
+        clients = [providers.load(provider, provider_config)
+                   for provider, provider_config in _provider_sections(config, section)]
+        if not clients:
+            raise Exception("Tenant {0} has no providers".format(name))
+        blacklist = [word.strip() for word in section.get('blacklist', '').split(',')
+                     if word.strip()]
+        history = seen_index.SeenIndex(section.get('history', 'history-{0}.db'.format(name)),
+                                       capacity=section.getint('history_capacity', 100000))
+        tenants.append(Tenant(name, clients,
+                              scheduler.parse_schedule(section.get('schedule', default_schedule)),
+                              blacklist, history))
+    return tenants
+
+
+def prepare(tenant, supply):
+    "Get a picture for a tenant, and get it ready for its providers"
+    result = supply.get(tenant)
+    posting.prefetch(tenant.providers, result)
+    return result
+
+
+def run(tenants, supply, seen=None, lead=300, on_post=None):
+    """Post for every tenant on its own schedule, until we get a signal to
+    stop. `on_post` is called after every post."""
+    stop = threading.Event()
+    daemons = []
+    for tenant in tenants:
+        daemons.append(scheduler.Daemon(tenant.schedule,
+                                        lambda tenant=tenant: prepare(tenant, supply),
+                                        lambda result, tenant=tenant: post(tenant, result, seen, on_post),
+                                        lead, stop))
+
+    def handle_signal(signum, frame):
+        log.info("Got signal {0}, shutting down".format(signum))
+        stop.set()
+
+    handlers = {}
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        handlers[signum] = signal.signal(signum, handle_signal)
+    try:
+        threads = [threading.Thread(target=daemon.run, args=(False,),
+                                    name='tenant-' + tenant.name)
+                   for tenant, daemon in zip(tenants, daemons)]
+        for thread in threads:
+            thread.start()
+        # Wake up now and then, signals are only delivered between waits
+        while not stop.wait(1):
+            pass
+        for thread in threads:
+            thread.join()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+def post(tenant, result, seen=None, on_post=None):
+    "Post a result for a tenant, and remember it was posted"
+    try:
+        with metrics.span('post', tenant=tenant.name, title=result.title):
+            outcomes = posting.post(tenant.providers, result)
+        for outcome in outcomes:
+            if outcome.error is None:
+                log.info("[{0}] Sent {1}: {2} ({3}) in {4:.1f}s".format(
+                    tenant.name, outcome.provider, outcome.status_id,
+                    result.caption, outcome.elapsed))
+            else:
+                log.error("[{0}] Failed to send to {1}: {2}".format(
+                    tenant.name, outcome.provider, outcome.error))
+        if all(outcome.error is not None for outcome in outcomes):
+            raise Exception("Posting failed on all providers of {0}".format(tenant.name))
+        tenant.record_posted(result)
+        if seen is not None and result.title is not None:
+            seen.record(result.title, seen_index.POSTED)
+    finally:
+        if on_post is not None:
+            on_post()
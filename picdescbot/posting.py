@@ -0,0 +1,86 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements posting a result to all the providers at once
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import collections
+import concurrent.futures
+import time
+from . import logger
+from . import metrics
+
+log = logger.get("posting")
+
+# What happened when posting to a provider. `status_id` is set on success,
+# `error` on failure.
+Outcome = collections.namedtuple('Outcome', ['provider', 'status_id', 'error',
+                                             'elapsed'])
+
+DEFAULT_TIMEOUT = 300
+
+# How a provider posts: how many times it tries, how long it waits between
+# attempts, and how long the whole thing may take (see `post`)
+Policy = collections.namedtuple('Policy', ['retries', 'retry_delay', 'timeout'])
+
+
+def load_policy(config):
+    "Read a provider's `Policy` from its config section"
+    return Policy(int(config.get('retries', 3)),
+                  float(config.get('retry_delay', 5)),
+                  float(config.get('timeout', DEFAULT_TIMEOUT)))
+
+
+def _send(provider, result, parent):
+    start = time.time()
+    with metrics.span('send', parent, provider=provider.name), \
+            metrics.send_seconds.time(provider=provider.name):
+        status_id = provider.send(result)
+    return status_id, time.time() - start
+
+
+def prefetch(providers, result):
+    """Get the picture into the media store in the sizes the providers
+    upload, so posting doesn't wait for the download. Failing is fine,
+    the picture is downloaded when posting then."""
+    try:
+        result.prefetch_pictures([provider.rendition for provider in providers
+                                  if getattr(provider, 'uploads', False)])
+    except Exception as e:
+        log.error("Prefetching {0} failed: {1}".format(result.url, e))
+
+
+def post(providers, result):
+    """Post a result to all the providers at the same time.
+
+    Each provider retries on its own, and gets its own `timeout` (in seconds).
+    Each size of the picture is downloaded once and shared by all the
+    providers that need it. Returns a list of `Outcome`s, one per provider, in the same order."""
+    start = time.time()
+    executor = concurrent.futures.ThreadPoolExecutor(max(1, len(providers)))
+    parent = metrics.current_span()
+    futures = [executor.submit(_send, provider, result, parent)
+               for provider in providers]
+    outcomes = []
+    timed_out = False
+    for provider, future in zip(providers, futures):
+        deadline = start + getattr(provider, 'timeout', DEFAULT_TIMEOUT)
+        try:
+            status_id, elapsed = future.result(timeout=max(0, deadline - time.time()))
+            outcomes.append(Outcome(provider.name, status_id, None, elapsed))
+        except concurrent.futures.TimeoutError:
+            timed_out = True
+            log.error("Posting to {0} timed out".format(provider.name))
+            outcomes.append(Outcome(provider.name, None, "timed out",
+                                    time.time() - start))
+        except Exception as e:
+            log.exception(e)
+            outcomes.append(Outcome(provider.name, None, str(e) or repr(e),
+                                    time.time() - start))
+    # Don't wait for providers that timed out, they're on their own now
+    executor.shutdown(wait=False)
+    if not timed_out:
+        # Nobody is reading the picture anymore
+        result.release_picture()
+    return outcomes
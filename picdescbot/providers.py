@@ -0,0 +1,33 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file keeps track of the services the bot can post to
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import importlib
+from . import renditions
+
+# Provider name (which is also its config section) => module with its Client.
+# Modules are only imported when the provider is actually used, so a
+# tumblr-only bot never pays for importing tweepy, and vice versa.
+PROVIDERS = {'tumblr': 'picdescbot.tumblr',
+             'twitter': 'picdescbot.twitter'}
+
+
+def load(name, config):
+    "Create a client for the named provider, importing it on first use"
+    module = importlib.import_module(PROVIDERS[name])
+    return module.Client(config)
+
+
+def upload_renditions(config):
+    """The picture sizes that the providers configured in `config` upload
+    themselves, see `picdescbot.renditions`. No clients are created."""
+    sizes = []
+    for name, module_name in sorted(PROVIDERS.items()):
+        if config.has_section(name):
+            module = importlib.import_module(module_name)
+            if module.Client.uploads:
+                sizes.append(renditions.from_config(config[name], module.RENDITION))
+    return sizes
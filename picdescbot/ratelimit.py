@@ -0,0 +1,153 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements rate limiting for the APIs we use
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import contextlib
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from . import logger
+
+try:
+    import fcntl
+except ImportError:  # not on a unix, so no sharing between processes
+    fcntl = None
+
+log = logger.get("ratelimit")
+
+# Headers some APIs use to tell us how much quota is left, and when it resets
+REMAINING_HEADERS = ['X-RateLimit-Remaining', 'RateLimit-Remaining']
+RESET_HEADERS = ['X-RateLimit-Reset', 'RateLimit-Reset']
+
+
+def backoff(attempt, base=1, cap=60):
+    "Exponential backoff with full jitter, in seconds"
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    "Parse a Retry-After header (seconds or an HTTP date) into seconds from now"
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """ An adaptive token bucket.
+
+    Callers take a token before every request. The bucket refills at `rate`
+    tokens per second, up to `burst` tokens. When the server says we're going
+    too fast (a 429, or a quota header saying nothing is left), everyone
+    waits until the time the server asked for, and the rate is halved. It
+    then creeps back up towards the configured rate with every success.
+
+    The state is shared between threads, and between processes too if a
+    `path` is given (on unix), so several bot instances using the same
+    subscription key stay under one limit.
+    """
+
+    def __init__(self, rate, burst=None, path=None, min_rate=None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.burst = burst or max(1, rate)
+        self.path = path if fcntl is not None else None
+        self.lock = threading.Lock()
+        self.local_state = self._initial_state()
+
+    def _initial_state(self):
+        return {'tokens': self.burst, 'updated': time.time(),
+                'blocked_until': 0, 'rate': self.max_rate}
+
+    @contextlib.contextmanager
+    def _state(self):
+        "Lock the shared state, and save it when done"
+        with self.lock:
+            if self.path is None:
+                yield self.local_state
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:  # new or corrupt file
+                        state = self._initial_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, cancelled=None):
+        """Wait for a token. Returns False if the `cancelled` event was set
+        while waiting, True otherwise."""
+        while True:
+            with self._state() as state:
+                now = time.time()
+                state['tokens'] = min(self.burst, state['tokens'] +
+                                      (now - state['updated']) * state['rate'])
+                state['updated'] = now
+                if state['blocked_until'] > now:
+                    wait = state['blocked_until'] - now
+                elif state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return True
+                else:
+                    wait = (1 - state['tokens']) / state['rate']
+            # A bit of jitter, so waiting callers don't all wake up together
+            wait += random.uniform(0, min(wait, 1) / 4)
+            if cancelled is not None:
+                if cancelled.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def update(self, response):
+        """Adjust to a response from the server. Returns how long the server
+        asked us to wait, if it did."""
+        delay = None
+        if response.status_code == 429:
+            delay = parse_retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = backoff(2)
+        else:
+            remaining = _first_header(response.headers, REMAINING_HEADERS)
+            if remaining is not None and remaining.strip() == '0':
+                reset = _first_header(response.headers, RESET_HEADERS)
+                delay = parse_retry_after(reset) if reset else None
+                if delay is not None and delay > 10 ** 6:  # an epoch timestamp
+                    delay = max(0.0, float(reset) - time.time())
+
+        with self._state() as state:
+            if response.status_code == 429:
+                state['rate'] = max(self.min_rate, state['rate'] / 2)
+                log.warning("Rate limited, slowing down to {0:.2f} requests/s".format(state['rate']))
+            else:
+                state['rate'] = min(self.max_rate, state['rate'] + self.max_rate / 20)
+            if delay:
+                state['blocked_until'] = max(state['blocked_until'], time.time() + delay)
+                state['tokens'] = 0
+        return delay
+
+
+def _first_header(headers, names):
+    for name in names:
+        if name in headers:
+            return headers[name]
+    return None
@@ -0,0 +1,88 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements picking the right size of a picture for everyone who needs it
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import math
+import re
+
+# Thumbnail widths Wikimedia pre-renders and caches. Anything else has to be
+# scaled on demand, which is slower for us and more work for them, so we
+# round up to one of these when it's at most STANDARD_SLACK times bigger.
+STANDARD_WIDTHS = (120, 250, 330, 500, 960, 1280, 1920, 3840)
+STANDARD_SLACK = 1.25
+
+# The width in a thumbnail URL, like .../thumb/a/ab/Foo.jpg/1080px-Foo.jpg
+_thumb_width = re.compile(r'/(\d+)px-([^/]+)$')
+
+# The parts of an imageinfo we need for picking a rendition later
+PICTURE_KEYS = ('url', 'thumburl', 'width', 'height', 'size')
+
+
+class Rendition(object):
+    """ What a consumer of pictures needs. `size` is the longest edge (in
+    pixels) that's big enough, `max_bytes` the biggest file it accepts, and
+    `min_size` the shortest edge it accepts. """
+
+    def __init__(self, size, max_bytes, min_size=0):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+
+    def __repr__(self):
+        return 'Rendition({0}, {1}, {2})'.format(self.size, self.max_bytes, self.min_size)
+
+
+def from_config(config, default):
+    "A rendition with the rendition_size and rendition_bytes from a config section"
+    return Rendition(int(config.get('rendition_size', default.size)),
+                     int(config.get('rendition_bytes', default.max_bytes)),
+                     default.min_size)
+
+
+def picture_info(imageinfo):
+    "Keep only what `select` needs from an imageinfo"
+    return {key: imageinfo[key] for key in PICTURE_KEYS if key in imageinfo}
+
+
+def thumbnail_url(info, width):
+    "Build the URL of a thumbnail from the template MediaWiki gave us"
+    return _thumb_width.sub(lambda match: '/{0}px-{1}'.format(width, match.group(2)),
+                            info['thumburl'])
+
+
+def select(info, rendition):
+    """Returns the URL of the smallest rendition of a picture that meets the
+    needs of a consumer, which is the original if it's small enough already.
+    Thumbnail sizes are estimated from the original, and snapped to the
+    widths Wikimedia has cached when possible."""
+    width, height = info['width'], info['height']
+    longest = max(width, height)
+    if longest <= rendition.size and info['size'] <= rendition.max_bytes:
+        return info['url']
+    if not info.get('thumburl') or not _thumb_width.search(info['thumburl']):
+        return info['url']
+
+    scale = min(1.0, rendition.size / longest)
+    if min(width, height) * scale < rendition.min_size:
+        # Very long and narrow, make the short edge big enough
+        scale = min(1.0, rendition.min_size / min(width, height))
+    # Assume the file size is proportional to the number of pixels
+    limited = info['size'] * scale ** 2 > rendition.max_bytes
+    if limited:
+        scale = math.sqrt(rendition.max_bytes / info['size'])
+    wanted = width * scale
+
+    if limited:
+        # Round down, so we don't go over the limit
+        widths = [w for w in STANDARD_WIDTHS if w <= wanted]
+        thumb_width = widths[-1] if widths else int(wanted)
+    else:
+        widths = [w for w in STANDARD_WIDTHS
+                  if wanted <= w <= wanted * STANDARD_SLACK and w < width]
+        thumb_width = widths[0] if widths else int(math.ceil(wanted))
+    if thumb_width >= width:
+        return info['url']
+    return thumbnail_url(info, max(1, thumb_width))
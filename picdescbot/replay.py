@@ -0,0 +1,434 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements recording API responses, and replaying them from a local server
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import collections
+import configparser
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from . import common
+from . import logger
+
+log = logger.get("replay")
+
+# Where the real pictures live, replayed pictures are served by us instead
+UPLOAD_URL = "https://upload.wikimedia.org/"
+
+# Fixtures are a directory with:
+#   mediawiki.jsonl - {"params": ..., "response": ...} for every MediaWiki query
+#   cv.json - picture file name => Computer Vision API result, or
+#             "sha256:..." for pictures that were sent as bytes
+#   images.json - picture URL path => file name in images/
+MEDIAWIKI_FILE = 'mediawiki.jsonl'
+CV_FILE = 'cv.json'
+IMAGES_FILE = 'images.json'
+IMAGES_DIR = 'images'
+
+# Parameters that don't change what a MediaWiki query returns
+IGNORED_PARAMS = ('action', 'format')
+
+# How many usages MediaWiki returns for gulimit=max
+USAGE_LIMIT = 500
+
+
+def _filename(url):
+    return urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1]
+
+
+def _content_key(data):
+    "The key of a picture sent as bytes, like `CVAPIClient.describe_picture` uses"
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def _same_query(recorded, params):
+    return ({key: value for key, value in recorded.items() if key not in IGNORED_PARAMS} ==
+            {key: value for key, value in params.items() if key not in IGNORED_PARAMS})
+
+
+class Fixtures(object):
+    "Recorded responses, see the comment above for the layout on disk"
+    def __init__(self, path):
+        self.path = path
+        self.mediawiki = []
+        self.cv = {}
+        self.images = {}
+        self._by_hash = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        fixtures = cls(path)
+        with open(os.path.join(path, MEDIAWIKI_FILE)) as f:
+            fixtures.mediawiki = [json.loads(line) for line in f if line.strip()]
+        with open(os.path.join(path, CV_FILE)) as f:
+            fixtures.cv = json.load(f)
+        with open(os.path.join(path, IMAGES_FILE)) as f:
+            fixtures.images = json.load(f)
+        return fixtures
+
+    def add_image(self, url, data):
+        path = urllib.parse.urlsplit(url).path
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16] + os.path.splitext(path)[1]
+        os.makedirs(os.path.join(self.path, IMAGES_DIR), exist_ok=True)
+        with open(os.path.join(self.path, IMAGES_DIR, name), 'wb') as f:
+            f.write(data)
+        self.images[path] = name
+
+    def read_image(self, path):
+        name = self.images.get(path)
+        if name is None:
+            return None
+        with open(os.path.join(self.path, IMAGES_DIR, name), 'rb') as f:
+            return f.read()
+
+    def describe_key(self, data):
+        """The key of the recorded result for a picture sent as bytes: its
+        hash if it was recorded that way, otherwise the file name of a
+        recorded picture with the same content, or None"""
+        key = _content_key(data)
+        if key in self.cv:
+            return key
+        with self.lock:
+            if self._by_hash is None:
+                self._by_hash = {}
+                for path in self.images:
+                    self._by_hash[_content_key(self.read_image(path))] = path.rsplit('/', 1)[-1]
+        return self._by_hash.get(key)
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, MEDIAWIKI_FILE), 'w') as f:
+            for entry in self.mediawiki:
+                f.write(json.dumps(entry) + '\n')
+        with open(os.path.join(self.path, CV_FILE), 'w') as f:
+            json.dump(self.cv, f, indent=2)
+        with open(os.path.join(self.path, IMAGES_FILE), 'w') as f:
+            json.dump(self.images, f, indent=2)
+
+
+class Recorder(object):
+    """ Records the responses of a requests session into fixtures.
+    MediaWiki queries, Computer Vision results and downloaded pictures are
+    recorded, everything else is ignored. """
+
+    def __init__(self, path):
+        self.fixtures = Fixtures(path)
+        self.lock = threading.Lock()
+
+    def attach(self, session):
+        session.hooks['response'].append(self._record)
+
+    def detach(self, session):
+        session.hooks['response'].remove(self._record)
+
+    def _record(self, response, *args, **kwargs):
+        request = response.request
+        if response.status_code != 200:
+            return
+        with self.lock:
+            if request.url.startswith(common.MEDIAWIKI_API):
+                query = urllib.parse.urlsplit(request.url).query
+                self.fixtures.mediawiki.append({'params': dict(urllib.parse.parse_qsl(query)),
+                                                'response': response.json()})
+            elif request.method == 'POST':
+                if request.headers.get('Content-Type') == 'application/octet-stream':
+                    key = _content_key(request.body)
+                else:
+                    key = _filename(json.loads(request.body)['url'])
+                self.fixtures.cv[key] = response.json()
+            elif request.url.startswith(UPLOAD_URL):
+                # Reading the content here is fine, requests still lets
+                # the caller iterate over it afterwards
+                self.fixtures.add_image(request.url, response.content)
+
+    def save(self):
+        with self.lock:
+            self.fixtures.save()
+
+
+class FixtureBackend(common.DescriptionBackend):
+    """ Describes pictures with recorded Computer Vision results, without
+    any network. A stand-in for the real API in tests and benchmarks, see
+    `picdescbot.common.DescriptionBackend`. Every call takes `latency`
+    seconds. """
+
+    def __init__(self, fixtures, concurrency=4, latency=0):
+        self.fixtures = fixtures
+        self.concurrency = concurrency
+        self.latency = latency
+
+    def describe(self, picture, cancelled=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(picture, bytes):
+            filename = self.fixtures.describe_key(picture)
+        else:
+            filename = _filename(picture)
+        result = self.fixtures.cv.get(filename)
+        if result is None and filename is not None:
+            result = self.fixtures.cv.get(re.sub(r'^\d+px-', '', filename))
+        if result is None:
+            raise Exception("No recorded description for {0}".format(filename))
+        return result
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/w/api.php':
+            self.server.replay.reply(self, 'mediawiki',
+                                     dict(urllib.parse.parse_qsl(url.query)))
+        elif url.path.startswith('/upload/'):
+            self.server.replay.reply(self, 'image', url.path[len('/upload'):])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type') == 'application/octet-stream':
+            key = self.server.replay.fixtures.describe_key(body)
+        else:
+            key = _filename(json.loads(body)['url'])
+        self.server.replay.reply(self, 'cv', key)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(object):
+    """ A local stand-in for MediaWiki, the Computer Vision API and the
+    picture server, which replays recorded fixtures.
+
+    Every response is delayed by `latency` seconds. Every
+    `rate_limit_every`th request gets a 429 with a `retry_after` header,
+    and a `failure_rate` fraction of the requests fail with a 503.
+    Call counts per API are kept in `calls`. """
+
+    def __init__(self, fixtures, latency=0, rate_limit_every=0, retry_after=1,
+                 failure_rate=0, seed=0, port=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.requests = itertools.count(1)
+        self.random_queries = itertools.cycle(
+            [entry for entry in fixtures.mediawiki if 'titles' not in entry['params']]
+            or [None])
+        # Every page in the fixtures, for answering queries that weren't recorded
+        self.pages = {}
+        for entry in fixtures.mediawiki:
+            for page in entry['response'].get('query', {}).get('pages', {}).values():
+                if 'title' in page:
+                    self.pages[page['title']] = page
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.replay = self
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.api_url = self.url + '/w/api.php'
+        self.cv_endpoint = self.url + '/vision/v1.0'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def install(self):
+        "Point picdescbot.common at this server. Returns the CV endpoint to use."
+        common.MEDIAWIKI_API = self.api_url
+        return self.cv_endpoint
+
+    def reply(self, handler, api, key):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[api] += 1
+            count = next(self.requests)
+            rate_limited = self.rate_limit_every and count % self.rate_limit_every == 0
+            failed = not rate_limited and self.random.random() < self.failure_rate
+            if rate_limited:
+                self.calls['429'] += 1
+            elif failed:
+                self.calls['failed'] += 1
+        if rate_limited:
+            return self._send(handler, 429, b'{"error": "rate limited"}',
+                              {'Retry-After': str(self.retry_after)})
+        if failed:
+            return self._send(handler, 503, b'{"error": "unavailable"}')
+
+        if api == 'mediawiki':
+            body = self._mediawiki(key)
+        elif api == 'cv':
+            body = self._cv(key)
+        else:
+            return self._image(handler, key)
+        if body is None:
+            return self._send(handler, 404, b'{}')
+        self._send(handler, 200, body, {'Content-Type': 'application/json'})
+
+    def _mediawiki(self, params):
+        entry = None
+        if 'titles' in params:
+            entry = next((entry for entry in self.fixtures.mediawiki
+                          if _same_query(entry['params'], params)), None)
+            if entry is None:
+                entry = {'response': self._titles(params)}
+        else:
+            with self.lock:
+                entry = next(self.random_queries)
+        if entry is None:
+            return None
+        # Pictures are downloaded from us too
+        return json.dumps(entry['response']).replace(
+            UPLOAD_URL, self.url + '/upload/').encode('utf-8')
+
+    def _titles(self, params):
+        """Answer a query about some titles from the pages in the fixtures,
+        paging through the global usage like MediaWiki does"""
+        props = params.get('prop', '').split('|')
+        limit = params.get('gulimit', 'max')
+        limit = USAGE_LIMIT if limit == 'max' else int(limit)
+        start_title, start = None, 0
+        if 'gucontinue' in params:
+            start_title, start = params['gucontinue'].rsplit('|', 1)
+            start = int(start)
+        pages = {}
+        more = None
+        for i, title in enumerate(sorted(params['titles'].split('|'))):
+            page = self.pages.get(title)
+            if page is None:
+                pages[str(-1 - i)] = {'ns': 6, 'title': title, 'missing': ''}
+                continue
+            result = {key: page[key] for key in ('pageid', 'ns', 'title')}
+            pages[str(page['pageid'])] = result
+            if 'imageinfo' in props:
+                result['imageinfo'] = page['imageinfo']
+            if 'globalusage' not in props:
+                continue
+            if more is not None or (start_title is not None and title < start_title):
+                # Done already, or left for the next request
+                continue
+            if start_title is None or title > start_title:
+                result['categories'] = page.get('categories', [])
+                offset = 0
+            else:
+                offset = start
+            usage = page.get('globalusage', [])[offset:offset + limit]
+            result['globalusage'] = usage
+            limit -= len(usage)
+            if offset + len(usage) < len(page.get('globalusage', [])):
+                more = '{0}|{1}'.format(title, offset + len(usage))
+        response = {'query': {'pages': pages}}
+        if more is None:
+            response['batchcomplete'] = ''
+        else:
+            response['continue'] = {'gucontinue': more, 'continue': '||'}
+        return response
+
+    def _cv(self, filename):
+        if filename is None:
+            return None
+        result = self.fixtures.cv.get(filename)
+        if result is None:
+            # A different thumbnail of a recorded picture
+            result = self.fixtures.cv.get(re.sub(r'^\d+px-', '', filename))
+        return json.dumps(result).encode('utf-8') if result is not None else None
+
+    def _image(self, handler, path):
+        data = self.fixtures.read_image(path)
+        if data is None:
+            return self._send(handler, 404, b'')
+        content_range = handler.headers.get('Range')
+        if content_range is not None and content_range.startswith('bytes='):
+            start = int(content_range[len('bytes='):].split('-')[0])
+            if start >= len(data):
+                return self._send(handler, 416, b'')
+            return self._send(handler, 206, data[start:], {
+                'Content-Range': 'bytes {0}-{1}/{2}'.format(start, len(data) - 1, len(data))})
+        self._send(handler, 200, data)
+
+    def _send(self, handler, status, body, headers=None):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def record(path, config, count):
+    "Describe and download `count` random pictures, recording everything"
+    recorder = Recorder(path)
+    recorder.attach(common.get_session())
+    cvapi = common.CVAPIClient(config['mscognitive']['api_key'],
+                               config['mscognitive']['endpoint'])
+    try:
+        for i in range(count):
+            result = cvapi.get_picture_and_description()
+            result.download_picture().close(really=True)
+            result.release_picture()
+            log.info("Recorded {0}/{1}: {2}".format(i + 1, count, result.caption))
+    finally:
+        recorder.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record API responses, or replay them')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    record_parser = subparsers.add_parser('record', help='Record fixtures from the live APIs')
+    record_parser.add_argument('path')
+    record_parser.add_argument('--config', default='config.ini')
+    record_parser.add_argument('--count', type=int, default=10,
+                               help='How many usable pictures to record')
+    serve_parser = subparsers.add_parser('serve', help='Replay fixtures from a local server')
+    serve_parser.add_argument('path')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--latency', type=float, default=0)
+    serve_parser.add_argument('--rate-limit-every', type=int, default=0)
+    serve_parser.add_argument('--failure-rate', type=float, default=0)
+    args = parser.parse_args()
+    logger.setup()
+
+    if args.command == 'record':
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        record(args.path, config, args.count)
+        return
+
+    server = ReplayServer(Fixtures.load(args.path), args.latency,
+                          args.rate_limit_every, failure_rate=args.failure_rate,
+                          port=args.port)
+    print("MediaWiki API: {0}".format(server.api_url))
+    print("Computer Vision endpoint: {0}".format(server.cv_endpoint))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements a persistent queue of pictures that are ready to be posted
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import json
+import sqlite3
+import threading
+import time
+from . import common
+from . import logger
+
+log = logger.get("resultqueue")
+
+DEFAULT_PATH = "queue.db"
+
+
+class ResultQueue(object):
+    """ A persistent FIFO of fully vetted `Result`s, stored in SQLite.
+
+    A filler process keeps it between the `low` and `high` watermarks, and
+    any number of posting processes can pop from it at the same time.
+    Results older than `max_age` seconds are thrown away, so the bot doesn't
+    post stuff that was vetted with an outdated blacklist.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, low=5, high=20, max_age=7*24*3600):
+        self.path = path
+        self.low = low
+        self.high = high
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Transactions are managed explicitly, see pop()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        with self.lock:
+            # WAL lets the posters read while the filler is writing
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "added REAL NOT NULL, "
+                            "data TEXT NOT NULL)")
+
+    def __len__(self):
+        with self.lock:
+            cursor = self.db.execute("SELECT COUNT(*) FROM results WHERE added >= ?",
+                                     (time.time() - self.max_age,))
+            return cursor.fetchone()[0]
+
+    def push(self, result):
+        "Add a `Result` to the end of the queue"
+        with self.lock:
+            self.db.execute("INSERT INTO results (added, data) VALUES (?, ?)",
+                            (time.time(), json.dumps(result.to_dict())))
+
+    def pop(self):
+        "Remove and return the oldest fresh `Result`, or None if the queue is empty"
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock right away, so two posters
+            # can't select the same row.
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire()
+                row = self.db.execute("SELECT id, data FROM results "
+                                      "ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    self.db.execute("DELETE FROM results WHERE id = ?", (row[0],))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return common.Result.from_dict(json.loads(row[1]))
+
+    def expire(self):
+        "Throw away stale results. Returns how many were removed."
+        with self.lock:
+            return self._expire()
+
+    def _expire(self):
+        cursor = self.db.execute("DELETE FROM results WHERE added < ?",
+                                 (time.time() - self.max_age,))
+        if cursor.rowcount > 0:
+            log.info("Expired {0} stale results".format(cursor.rowcount))
+        return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def fill(queue, cvapi, stop=None, prefetch=()):
+    """Add results to the queue until it reaches the high watermark.
+    Their pictures are downloaded into the media store in the sizes in
+    `prefetch` first, see `picdescbot.renditions`."""
+    depth = len(queue)
+    while depth < queue.high and not (stop is not None and stop.is_set()):
+        result = cvapi.get_picture_and_description()
+        if prefetch:
+            try:
+                result.prefetch_pictures(prefetch)
+            except Exception as e:
+                log.error("Prefetching {0} failed: {1}".format(result.url, e))
+        queue.push(result)
+        depth = len(queue)
+        log.info("Queued {0} ({1}/{2})".format(result.url, depth, queue.high))
+
+
+def run_filler(queue, cvapi, interval=60, stop=None, prefetch=()):
+    """Keep the queue topped up, until the `stop` event is set.
+    The queue is refilled whenever it drops below the low watermark."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        queue.expire()
+        if len(queue) < queue.low:
+            try:
+                fill(queue, cvapi, stop, prefetch)
+            except Exception as e:
+                log.exception(e)
+        stop.wait(interval)
@@ -0,0 +1,246 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements retry policies, deadlines, retry budgets and circuit breakers
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import collections
+import threading
+import time
+from . import logger
+from . import metrics
+from . import ratelimit
+
+log = logger.get("retry")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Deadline(object):
+    """ A point in time by which some work has to be done, which can also be
+    cancelled early. It quacks like a `threading.Event`, so it can be passed
+    anywhere a `cancelled` event is expected: it's set once the time is up,
+    it's cancelled, or its `parent` is set.
+
+    Time spent in `wait` is added up in `waited`, for the parent too. """
+
+    def __init__(self, seconds=None, parent=None):
+        self.expires = time.time() + seconds if seconds is not None else None
+        self.parent = parent
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def remaining(self):
+        "Seconds left, or None if there's no time limit"
+        remaining = None if self.expires is None else self.expires - time.time()
+        if self.parent is not None and self.parent.remaining() is not None:
+            if remaining is None or self.parent.remaining() < remaining:
+                remaining = self.parent.remaining()
+        return None if remaining is None else max(0.0, remaining)
+
+    def is_set(self):
+        return (self.event.is_set() or
+                (self.expires is not None and time.time() >= self.expires) or
+                (self.parent is not None and self.parent.is_set()))
+
+    def set(self):
+        "Cancel whatever is running under this deadline"
+        self.event.set()
+
+    def check(self, what="work"):
+        "Raise DeadlineExceeded if we're out of time"
+        if self.is_set():
+            raise DeadlineExceeded("Deadline exceeded before {0} was done".format(what))
+
+    def wait(self, timeout):
+        """Sleep for `timeout` seconds, unless the time runs out or we're
+        cancelled first. Returns True if that happened."""
+        start = time.time()
+        end = start + timeout
+        while not self.is_set():
+            left = min(end - time.time(), self.expires_in())
+            if left <= 0:
+                break
+            # Wake up now and then to check on the parent
+            self.event.wait(min(left, 1))
+        self._add_waited(time.time() - start)
+        return self.is_set()
+
+    def expires_in(self):
+        remaining = self.remaining()
+        return float('inf') if remaining is None else remaining
+
+    def _add_waited(self, seconds):
+        with self.lock:
+            self.waited += seconds
+        if self.parent is not None:
+            self.parent._add_waited(seconds)
+
+
+class RetryBudget(object):
+    """ Limits retries to a fraction of the requests to an upstream, so
+    retries don't pile up and make things worse while it's struggling.
+
+    Over the last `window` seconds, retries may be at most `ratio` of the
+    requests, plus `minimum` retries that are always allowed. """
+
+    def __init__(self, ratio=0.2, minimum=10, window=60):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.lock = threading.Lock()
+        self.requests = collections.deque()
+        self.retries = collections.deque()
+
+    def _expire(self, now):
+        for times in (self.requests, self.retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def record_request(self):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            self.requests.append(now)
+
+    def can_retry(self):
+        "Take a retry out of the budget. Returns False if there's none left."
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if len(self.retries) >= self.minimum + self.ratio * len(self.requests):
+                return False
+            self.retries.append(now)
+            return True
+
+
+class CircuitBreaker(object):
+    """ Fails fast while an upstream is down.
+
+    After `threshold` failures in a row the circuit opens, and requests fail
+    right away with CircuitOpen. After `reset_timeout` seconds a single
+    request is let through to check on the upstream: if it succeeds, the
+    circuit closes again, if it fails it stays open for another while. If
+    that request never tells how it went, another one is let through after
+    `reset_timeout` seconds.
+
+    Every request let through must end with `record_success`,
+    `record_failure` or `release`. Any answer that isn't a server error is
+    a success, the upstream is up even if it didn't like the request. """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=5, reset_timeout=60):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.probing = 0  # When the request checking on the upstream started
+
+    def before_request(self):
+        "Raise CircuitOpen if requests shouldn't be made right now"
+        with self.lock:
+            now = time.time()
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and now - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = now
+                log.info("Checking if {0} is back".format(self.name))
+                return
+            if self.state == self.HALF_OPEN and now - self.probing >= self.reset_timeout:
+                self.probing = now
+                log.warning("No news about {0}, checking again".format(self.name))
+                return
+            raise CircuitOpen("{0} is down, not trying for now".format(self.name))
+
+    def release(self):
+        """Give up on a request without learning anything about the
+        upstream, such as when it's cancelled before it's sent. If it was
+        checking on the upstream, the next request does that instead."""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                log.info("{0} is back".format(self.name))
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    log.error("{0} failed {1} times, giving it {2}s".format(
+                        self.name, self.failures, self.reset_timeout))
+                self.state = self.OPEN
+                self.opened = time.time()
+
+
+class Upstream(object):
+    """ How we retry requests to one upstream: up to `attempts` attempts
+    with jittered exponential backoff (from `base` up to `cap` seconds),
+    within a shared retry budget and behind a circuit breaker. """
+
+    def __init__(self, name, attempts=5, base=1, cap=60, budget=None, breaker=None):
+        self.name = name
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker(name)
+
+    def before_request(self, deadline=None, what=None):
+        "Check the deadline and the circuit breaker before making a request"
+        if deadline is not None:
+            deadline.check(what or self.name)
+        self.breaker.before_request()
+        self.budget.record_request()
+
+    def should_retry(self, attempt, deadline=None):
+        """Should attempt number `attempt` (counting from 1) be retried?
+        If so, waits for the backoff first."""
+        if attempt >= self.attempts:
+            log.error("{0}: giving up after {1} attempts".format(self.name, attempt))
+            return False
+        if not self.budget.can_retry():
+            log.error("{0}: out of retry budget".format(self.name))
+            return False
+        metrics.retries.inc(api=self.name)
+        return not wait(self.name, ratelimit.backoff(attempt, self.base, self.cap), deadline)
+
+
+def wait(api, seconds, cancelled=None):
+    """Sleep, but wake up early if `cancelled` gets set (or a deadline
+    expires). The time is counted as waiting for `api`.
+    Returns True if we were cancelled."""
+    start = time.time()
+    if cancelled is None:
+        time.sleep(seconds)
+        interrupted = False
+    else:
+        interrupted = cancelled.wait(seconds)
+    metrics.wait_seconds.inc(time.time() - start, api=api)
+    return bool(interrupted)
+
+
+# Retry settings for the APIs we use
+upstreams = {'mediawiki': Upstream('mediawiki', attempts=4, base=1, cap=30),
+             'cv': Upstream('cv', attempts=15, base=5, cap=120),
+             'download': Upstream('download', attempts=10, base=1, cap=30)}
@@ -0,0 +1,73 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements preparing pictures in the background while a human reviews them
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import queue
+import threading
+from . import logger
+
+log = logger.get("review")
+
+
+class Prefetcher(object):
+    """ Calls `produce` in a background thread to keep up to `depth` results
+    ready, so whoever calls `get` doesn't have to wait for them.
+
+    In manual mode, this finds and describes the next pictures while the
+    operator is still looking at the current one. Errors from `produce` are
+    raised by `get`, in order.
+    """
+
+    def __init__(self, produce, depth=3):
+        self.produce = produce
+        self.results = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='prefetcher',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                item = (self.produce(), None)
+            except Exception as e:
+                log.exception(e)
+                item = (None, e)
+            # Wait for room even if we were stopped meanwhile, `close`
+            # makes room and takes what's left
+            self.results.put(item)
+
+    def get(self):
+        "Returns the next result, waiting for it if it's not ready yet"
+        result, error = self.results.get()
+        if error is not None:
+            raise error
+        return result
+
+    def ready(self):
+        "How many results are ready right now"
+        return self.results.qsize()
+
+    def close(self):
+        """Stop the background thread, waiting for it to finish the result
+        it's preparing, if any. Returns the results that were prepared but
+        never handed out."""
+        self.stopped.set()
+        leftovers = []
+        while self.thread.is_alive():
+            leftovers.extend(self._drain())
+            self.thread.join(0.1)
+        return leftovers + self._drain()
+
+    def _drain(self):
+        results = []
+        while True:
+            try:
+                result, error = self.results.get_nowait()
+            except queue.Empty:
+                return results
+            if result is not None:
+                results.append(result)
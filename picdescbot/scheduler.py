@@ -0,0 +1,182 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements the scheduler for running the bot as a long-running daemon
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import datetime
+import math
+import signal
+import threading
+import time
+from . import logger
+
+log = logger.get("scheduler")
+
+
+class Interval(object):
+    """Every `seconds` seconds. Slots are aligned to multiples of the interval
+    since the epoch, so restarting the daemon doesn't shift the schedule."""
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("Interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, when):
+        "Returns the timestamp of the first slot after `when`"
+        return (math.floor(when / self.seconds) + 1) * self.seconds
+
+
+def _parse_field(field, low, high):
+    "Parse a single cron field into a set of allowed values"
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError("Invalid cron field: {0}".format(field))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron(object):
+    """A standard five field cron expression:
+    minute, hour, day of month, month and day of week (0 or 7 is sunday).
+    Times are in the local timezone."""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("A cron expression needs 5 fields: {0}".format(expression))
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_field(fields[4], 0, 7)}
+        # Like cron, if both day fields are restricted either one can match
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, when):
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        "Returns the timestamp of the first slot after `when`"
+        when = datetime.datetime.fromtimestamp(when).replace(second=0, microsecond=0)
+        when += datetime.timedelta(minutes=1)
+        limit = when + datetime.timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months:
+                # skip to the start of the next month
+                when = (when.replace(day=1) + datetime.timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return when.timestamp()
+        raise ValueError("Cron expression never matches: {0}".format(self.expression))
+
+
+def parse_schedule(text):
+    """Parse a schedule: either a number of seconds (optionally followed by
+    s, m or h), or a cron expression"""
+    text = text.strip()
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if text[-1:] in units and text[:-1].replace('.', '', 1).isdigit():
+        return Interval(float(text[:-1]) * units[text[-1]])
+    if text.replace('.', '', 1).isdigit():
+        return Interval(float(text))
+    return Cron(text)
+
+
+class Daemon(object):
+    """ Posts at every slot of a schedule, until it gets a signal to stop.
+
+    `prepare` is called in a background thread `lead` seconds before each
+    slot to find the next picture, so it can be posted right on time with
+    `post`. Everything set up before (API clients, connection pools) stays
+    warm between posts. Several daemons can share a `stop` event.
+    """
+
+    def __init__(self, schedule, prepare, post, lead=300, stop=None):
+        self.schedule = schedule
+        self.prepare = prepare
+        self.post = post
+        self.lead = lead
+        self.stop = stop or threading.Event()
+
+    def _handle_signal(self, signum, frame):
+        log.info("Got signal {0}, shutting down".format(signum))
+        self.stop.set()
+
+    def _prepare_in_background(self):
+        "Start preparing a post, returns a function that waits for the result"
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = self.prepare()
+            except Exception as e:
+                log.exception(e)
+            finally:
+                done.set()
+
+        # A daemon thread, so a stuck preparation doesn't prevent shutting down
+        threading.Thread(target=run, name="prepare", daemon=True).start()
+
+        def wait():
+            while not done.wait(1):
+                if self.stop.is_set():
+                    return None
+            return outcome.get('result')
+        return wait
+
+    def run(self, handle_signals=True):
+        """Post until stopped. Signals can only be handled by the main
+        thread, daemons running in other threads have to be stopped by
+        setting their `stop` event."""
+        handlers = {}
+        if handle_signals:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                handlers[signum] = signal.signal(signum, self._handle_signal)
+        try:
+            while not self.stop.is_set():
+                slot = self.schedule.next_after(time.time())
+                log.info("Next post at {0}".format(time.ctime(slot)))
+                if self.stop.wait(max(0, slot - self.lead - time.time())):
+                    break
+                wait_for_result = self._prepare_in_background()
+                if self.stop.wait(max(0, slot - time.time())):
+                    break
+                result = wait_for_result()
+                if result is None:
+                    log.error("Nothing to post for the slot at {0}".format(time.ctime(slot)))
+                    continue
+                try:
+                    self.post(result)
+                except Exception as e:
+                    log.exception(e)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        log.info("Daemon stopped")
@@ -0,0 +1,200 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file implements the index of pictures the bot has already seen
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from . import logger
+
+log = logger.get("seen")
+
+DEFAULT_PATH = "seen.db"
+
+# What happened to a picture
+REJECTED = 'rejected'
+DESCRIBED = 'described'
+POSTED = 'posted'
+
+
+class BloomFilter(object):
+    """ A fixed-size bloom filter in a memory-mapped file.
+
+    Loading it is just mapping the file, no matter how many keys are in it.
+    With the default settings it takes about 1.2MB for a million keys, at a
+    1% false positive rate. The header has the capacity it was built for,
+    past that the false positive rate climbs quickly.
+    """
+    MAGIC = b'PDBLOOM2'
+    HEADER = struct.Struct('<8sQQQ')  # magic, number of bits, number of hashes, capacity
+    # Filters from before the capacity was in the header. They only hold
+    # what's in the database, so they're simply built again.
+    OLD_MAGIC = b'PDBLOOM1'
+
+    def __init__(self, path, capacity=1000000, error_rate=0.01):
+        self.path = path
+        self.created = not os.path.exists(path) or self._is_old(path)
+        if self.created:
+            bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            hashes = max(1, int(round(bits / capacity * math.log(2))))
+            size = self.HEADER.size + (bits + 7) // 8
+            temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(temporary, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, bits, hashes, capacity))
+                f.truncate(size)
+            os.replace(temporary, path)
+
+        with open(path, 'r+b') as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic, self.bits, self.hashes, self.capacity = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC:
+            raise ValueError("{0} is not a bloom filter file".format(path))
+
+    def _is_old(self, path):
+        with open(path, 'rb') as f:
+            return f.read(len(self.OLD_MAGIC)) == self.OLD_MAGIC
+
+    def replaced(self):
+        "Was the file replaced with another filter since we opened it?"
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+    def _positions(self, key):
+        # Double hashing: the k positions are derived from two 64-bit hashes
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for i in range(self.hashes):
+            yield self.HEADER.size * 8 + (first + i * second) % self.bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._map[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._map[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+
+
+class SeenIndex(object):
+    """ Remembers what happened to every picture the bot looked at.
+
+    Keys are file titles (such as "File:Example.jpg"). The exact outcomes
+    live in SQLite, and a bloom filter in front of it answers "never seen"
+    for most random candidates without touching the database. The filter is
+    built again, bigger, once there are more keys than it was built for, or
+    when a bigger `capacity` is configured.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, capacity=1000000):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen ("
+                        "key TEXT PRIMARY KEY, "
+                        "outcome TEXT NOT NULL, "
+                        "reason TEXT, "
+                        "updated REAL NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+        # How many keys there are, not counting what other processes add
+        self.count = self.db.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+        self.bloom = BloomFilter(path + '.bloom', self._new_capacity())
+        if self.bloom.created:
+            self._fill_bloom(self.bloom)
+        elif self.bloom.capacity < max(self.capacity, self.count):
+            self._rebuild_bloom()
+
+    def _new_capacity(self):
+        "Room for what's configured, or for twice the keys we have"
+        return max(self.capacity, 2 * self.count)
+
+    def _fill_bloom(self, bloom):
+        "Add the keys already in the database to a new bloom filter"
+        count = 0
+        for (key,) in self.db.execute("SELECT key FROM seen"):
+            bloom.add(key)
+            count += 1
+        bloom.flush()
+        self.count = count
+        if count:
+            log.info("Built bloom filter for {0} keys with {1} keys in it".format(
+                bloom.capacity, count))
+
+    def _rebuild_bloom(self):
+        """Replace the bloom filter with a bigger one. Other processes pick
+        it up the next time they use theirs, see `_current_bloom`."""
+        path = self.bloom.path
+        temporary = '{0}.{1}.new'.format(path, os.getpid())
+        if os.path.exists(temporary):
+            os.unlink(temporary)  # Left behind by a crash
+        bloom = BloomFilter(temporary, self._new_capacity())
+        self._fill_bloom(bloom)
+        os.replace(temporary, path)
+        bloom.path = path
+        # Not closed, other threads might be using it. It goes away with
+        # the last reference to it.
+        self.bloom = bloom
+
+    def _current_bloom(self):
+        if self.bloom.replaced():
+            self.bloom = BloomFilter(self.bloom.path, self.capacity)
+        return self.bloom
+
+    def __contains__(self, key):
+        if key not in self._current_bloom():
+            return False
+        return self.get(key) is not None
+
+    def get(self, key):
+        "Returns an (outcome, reason) tuple for key, or None if it was never seen"
+        if key not in self._current_bloom():
+            return None
+        with self.lock:
+            return self.db.execute("SELECT outcome, reason FROM seen WHERE key = ?",
+                                   (key,)).fetchone()
+
+    def record(self, key, outcome, reason=None):
+        "Record what happened to a picture"
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO seen (key, outcome, reason, updated) "
+                            "VALUES (?, ?, ?, ?)", (key, outcome, reason, time.time()))
+            self.db.commit()
+            bloom = self._current_bloom()
+            if key not in bloom:
+                self.count += 1
+            bloom.add(key)
+            if self.count > bloom.capacity:
+                self._rebuild_bloom()
+
+    def forget(self, key):
+        """Forget a picture, so it can be picked again. It stays in the bloom
+        filter, which only costs a database lookup when it comes up."""
+        with self.lock:
+            self.db.execute("DELETE FROM seen WHERE key = ?", (key,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.bloom.close()
+            self.db.close()
@@ -7,7 +7,12 @@ from tumblpy import Tumblpy
 import tumblpy.exceptions
 import time
 from . import common
+from . import matcher
+from .matcher import Matcher
 from . import logger
+from . import metrics
+from . import posting
+from . import renditions
 
 DEFAULT_PARAMS = {'type': 'photo', 'state': 'queue',
                   'native_inline_images': True}
@@ -26,27 +31,38 @@ TEMPLATE = "<h2><b>{description}</b></h2>" + \
            "<p><i>all text in this post is 100% computer-generated, including tags</i></p>"
 DEFAULT_TAGS = ['picdescbot', 'bot']
 
+# tumblr shows photos at up to 1280 pixels wide, and takes up to 10MB
+RENDITION = renditions.Rendition(1280, 10*1024*1024)
+
 # All kinds of tags that should be filtered from the bot's post
 tag_blacklist = {'woman', 'black', 'white', 'man', 'body', 'large', 'tall',
                  'small', 'young', 'old', 'top', 'boy', 'girl'}
 
 
+_tag_filter = None
+
+
 def filter_tags(tags):
-    filtered = []
-    for tag in tags:
-        if tag not in tag_blacklist and not common.word_filter.blacklisted(tag):
-            filtered.append(tag)
-    return filtered
+    global _tag_filter
+    if _tag_filter is None:
+        _tag_filter = Matcher().add('tag', tag_blacklist, matcher.EXACT) \
+                               .add('badword', common.get_word_filter().blacklist)
+    return [tag for tag in tags if _tag_filter.search(tag) is None]
 
 
 class Client(object):
     name = "tumblr"
+    # tumblr fetches the picture from its URL by itself
+    uploads = False
 
     def __init__(self, config):
         self.client = Tumblpy(config['consumer_key'], config['consumer_secret'],
                               config['token'], config['token_secret'])
         self.blog_id = config['blog_id']
-        self.log = logger.get(__name__)
+        self.log = logger.get("tumblr")
+        self.retries, self.retry_delay, self.timeout = posting.load_policy(config)
+        # The picture size tumblr fetches, see `picdescbot.renditions`
+        self.rendition = renditions.from_config(config, RENDITION)
 
     def send(self, picture):
         "Post a post. `picture` is a `Result` object from `picdescbot.common`"
@@ -57,13 +73,13 @@ class Client(object):
         tags = DEFAULT_TAGS + filter_tags(picture.tags)
 
         params = {'caption': post_text,
-                  'source': picture.url,
+                  'source': picture.url_for(self.rendition),
                   'tags': ','.join(tags)}
         params.update(DEFAULT_PARAMS)
 
         retries = 0
         post = None
-        while retries < 3 and post is None:
+        while retries < self.retries and post is None:
             if retries > 0:
                 self.log.info('retrying...')
             try:
@@ -72,8 +88,9 @@ class Client(object):
             except tumblpy.exceptions.TumblpyError as e:
                 self.log.error("Error when sending tumblr post: %s" % e)
                 retries += 1
-                if retries >= 3:
+                if retries >= self.retries:
                     raise
                 else:
-                    time.sleep(5)
+                    metrics.retries.inc(api=self.name)
+                    time.sleep(self.retry_delay)
         return post['id']
@@ -6,26 +6,38 @@
 import time
 import tweepy
 from . import logger
+from . import metrics
+from . import posting
+from . import renditions
+
+# Twitter takes pictures up to 5MB, and shows them at up to 4096 pixels,
+# but mostly much smaller than that
+RENDITION = renditions.Rendition(2048, 5*1024*1024)
 
 
 class Client(object):
     name = "twitter"
+    # We upload the picture, so it's worth having it on disk ahead of time
+    uploads = True
 
     def __init__(self, config):
         auth = tweepy.OAuthHandler(config['consumer_key'],
                                    config['consumer_secret'])
         auth.set_access_token(config['token'], config['token_secret'])
         self.api = tweepy.API(auth)
-        self.log = logger.get(__name__)
+        self.log = logger.get("twitter")
+        self.retries, self.retry_delay, self.timeout = posting.load_policy(config)
+        # The picture size to upload, see `picdescbot.renditions`
+        self.rendition = renditions.from_config(config, RENDITION)
 
     def send(self, picture):
         "Send a tweet. `picture` is a `Result` object from `picdescbot.common`"
         retries = 0
         status = None
-        filename = picture.url.split('/')[-1]
-        data = picture.download_picture()
+        filename = picture.url_for(self.rendition).split('/')[-1]
+        data = picture.download_picture(self.rendition)
         try:
-            while retries < 3 and not status:
+            while retries < self.retries and not status:
                 if retries > 0:
                     self.log.info('retrying...')
                     data.seek(0)
@@ -37,10 +49,11 @@ class Client(object):
                 except tweepy.TweepError as e:
                     self.log.error("Error when sending tweet: %s" % e)
                     retries += 1
-                    if retries >= 3:
+                    if retries >= self.retries:
                         raise
                     else:
-                        time.sleep(5)
+                        metrics.retries.inc(api=self.name)
+                        time.sleep(self.retry_delay)
         finally:
             data.close(really=True)
         return status.id
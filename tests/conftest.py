@@ -0,0 +1,55 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file has the shared fixtures of the tests
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import os.path
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from picdescbot import common, ratelimit, replay, retry  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def wait_for(condition, timeout=5):
+    "Poll until `condition()` is true, failing the test after `timeout` seconds"
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            pytest.fail("Timed out waiting for {0}".format(condition.__name__))
+        time.sleep(0.01)
+
+
+@pytest.fixture(autouse=True)
+def upstreams(monkeypatch):
+    "Every test starts with closed circuit breakers and a full retry budget"
+    for name, upstream in retry.upstreams.items():
+        monkeypatch.setattr(upstream, 'breaker', retry.CircuitBreaker(name))
+        monkeypatch.setattr(upstream, 'budget', retry.RetryBudget())
+    return retry.upstreams
+
+
+@pytest.fixture
+def fixtures(tmp_path):
+    return synthetic.fixtures(str(tmp_path / 'fixtures'))
+
+
+@pytest.fixture
+def server(fixtures, monkeypatch):
+    "A replay server that picdescbot.common talks to instead of the real APIs"
+    monkeypatch.setattr(common, 'MEDIAWIKI_API', common.MEDIAWIKI_API)
+    with replay.ReplayServer(fixtures) as server:
+        server.install()
+        yield server
+
+
+@pytest.fixture
+def cvapi(server):
+    return common.CVAPIClient('test', server.cv_endpoint,
+                              limiter=ratelimit.RateLimiter(1000))
@@ -0,0 +1,54 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file builds synthetic fixtures for the tests, see `picdescbot.replay`
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import random
+
+from picdescbot import common, renditions, replay
+
+CAPTIONS = ['a boat in the harbour', 'a red train on a bridge', 'a castle on a hill']
+
+
+def page(pageid, rng):
+    "A page from the MediaWiki API, for a picture that passes every filter"
+    name = 'Picture_{0}.jpg'.format(pageid)
+    url = replay.UPLOAD_URL + 'wikipedia/commons/a/ab/' + name
+    return {'pageid': pageid, 'ns': 6, 'title': 'File:' + name.replace('_', ' '),
+            'categories': [{'ns': 14, 'title': 'Category:Boats'}],
+            'globalusage': [{'title': 'Harbour', 'wiki': 'en.wikipedia.org'}],
+            'imageinfo': [{'url': url,
+                           'thumburl': url.replace('/commons/', '/commons/thumb/') + '/1080px-' + name,
+                           'descriptionshorturl': 'https://commons.wikimedia.org/w/index.php?curid={0}'.format(pageid),
+                           'width': rng.randint(800, 4000), 'height': rng.randint(600, 3000),
+                           'size': rng.randint(100000, 2000000), 'mediatype': 'BITMAP',
+                           'extmetadata': {'ObjectName': {'value': name},
+                                           'Restrictions': {'value': ''},
+                                           'Categories': {'value': 'Boats'},
+                                           'ImageDescription': {'value': '<p>A picture</p>'}}}]}
+
+
+def fixtures(path, queries=3, batch_size=10, picture_size=1024, seed=0):
+    """Fixtures with `queries` random queries of `batch_size` good pictures
+    each, a description for every picture, and the picture itself in the
+    size that is described"""
+    rng = random.Random(seed)
+    result = replay.Fixtures(path)
+    pageid = 0
+    for i in range(queries):
+        pages = {}
+        for j in range(batch_size):
+            pageid += 1
+            pages[str(pageid)] = page(pageid, rng)
+            imageinfo = pages[str(pageid)]['imageinfo'][0]
+            result.cv[replay._filename(imageinfo['url'])] = {
+                'description': {'captions': [{'text': rng.choice(CAPTIONS)}], 'tags': ['outdoor']},
+                'adult': {'isAdultContent': False, 'isRacyContent': False}}
+            result.add_image(renditions.select(imageinfo, common.CV_RENDITION),
+                             rng.randbytes(picture_size))
+        result.mediawiki.append({'params': {'generator': 'random', 'grnlimit': str(batch_size)},
+                                 'response': {'batchcomplete': '', 'query': {'pages': pages}}})
+    result.save()
+    return result
@@ -0,0 +1,65 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the cache of Computer Vision results
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import itertools
+
+import pytest
+
+from picdescbot import cache
+
+RESULT = {'description': {'captions': [{'text': 'a boat'}], 'tags': ['boat']}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "Time that moves a second forward every time someone looks"
+    ticks = itertools.count(1000000)
+    monkeypatch.setattr(cache.time, 'time', lambda: next(ticks))
+
+
+def test_get_and_put(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    describe_cache = cache.DescribeCache(path)
+    assert describe_cache.get('a.jpg') is None
+    describe_cache.put('a.jpg', RESULT)
+    assert describe_cache.get('a.jpg') == RESULT
+    assert describe_cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+    describe_cache.close()
+    describe_cache = cache.DescribeCache(path)
+    assert describe_cache.get('a.jpg') == RESULT
+    describe_cache.close()
+
+
+def test_entries_expire(tmp_path, clock):
+    describe_cache = cache.DescribeCache(str(tmp_path / 'cache.db'), ttl=5)
+    describe_cache.put('a.jpg', RESULT)
+    assert describe_cache.get('a.jpg') == RESULT
+    for i in range(5):
+        cache.time.time()
+    assert describe_cache.get('a.jpg') is None
+    describe_cache.close()
+
+
+def test_least_recently_used_are_evicted(tmp_path, clock):
+    describe_cache = cache.DescribeCache(str(tmp_path / 'cache.db'), max_entries=2)
+    describe_cache.put('a.jpg', RESULT)
+    describe_cache.put('b.jpg', RESULT)
+    describe_cache.get('a.jpg')
+    describe_cache.put('c.jpg', RESULT)
+    assert describe_cache.get('b.jpg') is None
+    assert describe_cache.get('a.jpg') == RESULT
+    assert describe_cache.get('c.jpg') == RESULT
+    describe_cache.close()
+
+
+def test_describe_picture_uses_the_cache(tmp_path, cvapi, server):
+    cvapi.cache = cache.DescribeCache(str(tmp_path / 'cache.db'))
+    url = server.url + '/upload/wikipedia/commons/a/ab/Picture_1.jpg'
+    first = cvapi.describe_picture(url)
+    assert cvapi.describe_picture(url) == first
+    assert server.calls['cv'] == 1
+    cvapi.cache.close()
@@ -0,0 +1,70 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the cache of the category hierarchy
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import pytest
+
+from picdescbot import categories, common
+from picdescbot.matcher import Matcher
+
+PARENTS = {'Category:Boats': ['Category:Ships'],
+           'Category:Harbours': ['Category:Ports'],
+           'Category:Ships': ['Category:Nazi ships', 'Category:Vehicles'],
+           'Category:Ports': ['Category:Places']}
+
+MATCHER = Matcher().add('category', ['nazi'])
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    "MediaWiki answering from PARENTS. Returns the list of queries made."
+    made = []
+
+    def query(params, deadline=None):
+        made.append(params['titles'].split('|'))
+        return {str(i): {'title': title,
+                         'categories': [{'title': parent} for parent in PARENTS.get(title, [])]}
+                for i, title in enumerate(made[-1])}
+    monkeypatch.setattr(common, '_query', query)
+    return made
+
+
+def test_blacklisted_ancestors(tmp_path, queries):
+    graph = categories.CategoryGraph(str(tmp_path / 'categories.db'), max_depth=2)
+    assert graph.find_blacklisted(['Category:Harbours', 'Category:Boats'], MATCHER) == (
+        'Category:Boats', 'Category:Nazi ships')
+    # A level at a time, every category of a level in the same query
+    assert queries == [['Category:Boats', 'Category:Harbours'],
+                       ['Category:Ports', 'Category:Ships']]
+    graph.close()
+
+
+def test_only_up_to_max_depth(tmp_path, queries):
+    graph = categories.CategoryGraph(str(tmp_path / 'categories.db'), max_depth=1)
+    assert graph.find_blacklisted(['Category:Boats'], MATCHER) is None
+    graph.close()
+
+
+def test_parents_are_kept_between_runs(tmp_path, queries):
+    path = str(tmp_path / 'categories.db')
+    graph = categories.CategoryGraph(path)
+    graph.find_blacklisted(['Category:Boats'], MATCHER)
+    graph.find_blacklisted(['Category:Boats'], MATCHER)
+    graph.close()
+    graph = categories.CategoryGraph(path)
+    assert graph.find_blacklisted(['Category:Boats'], MATCHER) is not None
+    assert len(queries) == 2
+    graph.close()
+
+
+def test_stale_parents_are_fetched_again(tmp_path, queries, monkeypatch):
+    graph = categories.CategoryGraph(str(tmp_path / 'categories.db'), max_depth=1, ttl=60)
+    graph.prefetch(['Category:Boats'])
+    now = categories.time.time()
+    monkeypatch.setattr(categories.time, 'time', lambda: now + 61)
+    graph.prefetch(['Category:Boats'])
+    assert queries == [['Category:Boats'], ['Category:Boats']]
+    graph.close()
@@ -0,0 +1,32 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests finding and describing pictures, against replayed APIs
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+from conftest import wait_for
+from picdescbot import common, ratelimit, replay
+from picdescbot import seen as seen_index
+
+
+def test_concurrent_search_keeps_every_good_picture(fixtures, monkeypatch):
+    monkeypatch.setattr(common, 'MEDIAWIKI_API', common.MEDIAWIKI_API)
+    with replay.ReplayServer(fixtures, latency=0.02) as server:
+        cvapi = common.CVAPIClient('test', server.install(), concurrency=3,
+                                   limiter=ratelimit.RateLimiter(1000))
+        described = []
+
+        def record_seen(pic, outcome, reason=None):
+            if outcome == seen_index.DESCRIBED:
+                described.append(pic['title'])
+        cvapi.record_seen = record_seen
+        results = [cvapi.get_picture_and_description() for i in range(4)]
+
+        # Describe calls nobody waited for finish in the background, and
+        # every picture that was described is either returned or kept
+        def settled():
+            return len(described) == server.calls['cv'] == len(results) + len(cvapi.described)
+        wait_for(settled)
+    assert len(set(result.title for result in results)) == 4
+    assert server.calls['cv'] > 4
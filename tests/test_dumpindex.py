@@ -0,0 +1,113 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests parsing Commons dumps and the candidate index
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import gzip
+import random
+
+import pytest
+
+from picdescbot import dumpindex
+
+TABLES = {
+    'image': ['img_name', 'img_size', 'img_width', 'img_height', 'img_media_type'],
+    'page': ['page_id', 'page_namespace', 'page_title'],
+    'categorylinks': ['cl_from', 'cl_to', 'cl_sortkey', 'cl_type'],
+}
+
+# page id, name, width, height, media type, category
+FILES = [
+    (1, "A_boat\\'s_harbour.jpg", 1200, 900, 'BITMAP', 'Boats'),
+    (2, 'Castle.png', 800, 600, 'BITMAP', 'Castles'),
+    (3, 'Tiny.jpg', 30, 30, 'BITMAP', 'Boats'),
+    (4, 'Diagram.jpg', 800, 600, 'DRAWING', 'Boats'),
+    (5, 'Manual.pdf', 800, 600, 'BITMAP', 'Boats'),
+    (6, 'Company_logo.png', 800, 600, 'BITMAP', 'Logos_of_companies'),
+    (7, 'Train.jpg', 4000, 3000, 'BITMAP', 'Trains'),
+]
+
+
+def _write_dump(path, table, rows, per_insert=2):
+    "Write a dump like mysqldump does, a few rows per INSERT statement"
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write("CREATE TABLE `{0}` (\n".format(table))
+        f.write(''.join("  `{0}` varbinary(255) NOT NULL,\n".format(column)
+                        for column in TABLES[table]))
+        f.write("  PRIMARY KEY (`{0}`)\n) ENGINE=InnoDB;\n".format(TABLES[table][0]))
+        for i in range(0, len(rows), per_insert):
+            f.write("INSERT INTO `{0}` VALUES {1};\n".format(table, ','.join(rows[i:i + per_insert])))
+    return path
+
+
+@pytest.fixture
+def dumps(tmp_path):
+    return {
+        'image': _write_dump(str(tmp_path / 'image.sql.gz'), 'image', [
+            "('{0}',1000,{1},{2},'{3}')".format(name, width, height, media_type)
+            for page_id, name, width, height, media_type, category in FILES]),
+        'page': _write_dump(str(tmp_path / 'page.sql.gz'), 'page', [
+            "({0},6,'{1}')".format(page_id, name)
+            for page_id, name, width, height, media_type, category in FILES] +
+            # Not a file, but named like one
+            ["(100,0,'Castle.png')"]),
+        'categorylinks': _write_dump(str(tmp_path / 'categorylinks.sql.gz'), 'categorylinks', [
+            "({0},'{1}','KEY','file')".format(page_id, category)
+            for page_id, name, width, height, media_type, category in FILES] +
+            # Neither of these makes Castle.png blacklisted
+            ["(2,'Logos','KEY','page')", "(100,'Logos','KEY','file')"]),
+    }
+
+
+def test_rows_with_escapes_and_quotes():
+    line = (b"INSERT INTO `image` VALUES ('Boat\\'s_harbour.jpg',1200,NULL,'a,(b)'),"
+            b"('Back\\\\slash\\n.png',-2,'',NULL);\n")
+    assert list(dumpindex._rows(line)) == [
+        [b"Boat's_harbour.jpg", b'1200', None, b'a,(b)'],
+        [b'Back\\slash\n.png', b'-2', b'', None]]
+
+
+def test_read_table(dumps):
+    rows = list(dumpindex.read_table(dumps['page'], ('page_title', 'page_id')))
+    assert rows[0] == (b"A_boat's_harbour.jpg", b'1')
+    assert len(rows) == len(FILES) + 1
+    with pytest.raises(Exception):
+        list(dumpindex.read_table(dumps['page'], ('page_len',)))
+
+
+def test_sort_unique():
+    rng = random.Random(0)
+    values = [rng.randrange(-2**63, 2**63) for i in range(1000)] + [7] * 50
+    assert dumpindex._sort_unique(iter(values), chunk_size=64).tolist() == sorted(set(values))
+    assert dumpindex._sort_unique(iter([])).tolist() == []
+
+
+def test_build_and_sample(dumps, tmp_path):
+    path = str(tmp_path / 'candidates.idx')
+    count = dumpindex.build(path, dumps['image'], dumps['page'], dumps['categorylinks'])
+    index = dumpindex.CandidateIndex(path)
+    try:
+        titles = [index[i] for i in range(len(index))]
+        assert count == len(index)
+        # Small, drawings, PDFs and blacklisted categories are left out
+        assert titles == ["File:A boat's harbour.jpg", 'File:Castle.png', 'File:Train.jpg']
+        with pytest.raises(IndexError):
+            index[len(index)]
+        sample = index.sample(10, random.Random(0))
+        assert len(sample) == len(set(sample)) and set(sample) <= set(titles)
+    finally:
+        index.close()
+
+
+def test_build_without_categories(dumps, tmp_path):
+    path = str(tmp_path / 'candidates.idx')
+    assert dumpindex.build(path, dumps['image']) == 4
+
+
+def test_not_an_index(tmp_path):
+    path = tmp_path / 'candidates.idx'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(Exception):
+        dumpindex.CandidateIndex(str(path))
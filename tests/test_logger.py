@@ -0,0 +1,86 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests logging
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+
+from picdescbot import logger
+
+
+def _record(message, **extra):
+    record = logging.LogRecord('common', logging.WARNING, __file__, 1, message, (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_lines_have_the_extra_fields():
+    line = json.loads(logger.JSONFormatter().format(_record('Discarded', url='a.jpg', stage='size')))
+    assert (line['message'], line['level'], line['logger']) == ('Discarded', 'WARNING', 'common')
+    assert (line['url'], line['stage']) == ('a.jpg', 'size')
+
+
+def test_parse_levels():
+    assert logger._parse_levels('common:debug, tumblr:WARNING,') == {
+        'common': 'DEBUG', 'tumblr': 'WARNING'}
+
+
+def test_file_handlers(tmp_path):
+    path = str(tmp_path / 'all.log')
+    kinds = [({}, logging.handlers.RotatingFileHandler),
+             ({'rotate': 'time'}, logging.handlers.TimedRotatingFileHandler),
+             ({'rotate': 'none'}, logging.FileHandler),
+             ({'rotate': 'external'}, logging.handlers.WatchedFileHandler)]
+    for config, kind in kinds:
+        handler = logger._file_handler(path, config)
+        assert type(handler) is kind
+        handler.close()
+    # Someone else owns the rotation
+    handler = logger._file_handler(path, {'rotate': 'size'}, rotate=False)
+    assert type(handler) is logging.handlers.WatchedFileHandler
+    handler.close()
+
+
+def test_processes_that_dont_rotate_follow_the_one_that_does(tmp_path):
+    path = str(tmp_path / 'all.log')
+    owner = logger._file_handler(path, {'max_bytes': '200'})
+    other = logger._file_handler(path, {}, rotate=False)
+    for handler in (owner, other):
+        handler.setFormatter(logger.formatter)
+    for i in range(10):
+        owner.handle(_record('from the owner {0}'.format(i)))
+    assert os.path.exists(path + '.1.gz')
+    other.handle(_record('from the other one'))
+    owner.close()
+    other.close()
+    with open(path) as f:
+        assert 'from the other one' in f.read()
+
+
+def test_setup(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, 'setup_done', False)
+    monkeypatch.setattr(logger, 'listener', None)
+    root = logging.getLogger('')
+    monkeypatch.setattr(root, 'handlers', [])
+    monkeypatch.setattr(root, 'level', root.level)
+    monkeypatch.setattr(logger.get('tumblr'), 'level', logging.NOTSET)
+    logger.setup({'all_log': str(tmp_path / 'all.log'),
+                  'filtered_log': str(tmp_path / 'filtered.log'),
+                  'levels': 'tumblr:ERROR'})
+    logger.get('tumblr').warning("not this")
+    logger.get('common').info("just for all.log")
+    logger.get('common').warning("Discarded", extra={'url': 'a.jpg'})
+    logger.listener.stop()
+    atexit.unregister(logger.listener.stop)
+    with open(str(tmp_path / 'all.log')) as f:
+        everything = f.read()
+    with open(str(tmp_path / 'filtered.log')) as f:
+        filtered = [json.loads(line) for line in f]
+    assert 'just for all.log' in everything and 'not this' not in everything
+    assert [(line['message'], line['url']) for line in filtered] == [('Discarded', 'a.jpg')]
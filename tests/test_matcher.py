@@ -0,0 +1,82 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the compiled blacklist matchers
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import random
+
+from picdescbot import common, matcher
+from picdescbot.matcher import Match, Matcher
+
+WORDS = ['river', 'bridge', 'mountain', 'harbour', 'station', 'museum', 'park',
+         'portrait', 'street', 'village', 'castle', 'lake', 'train', 'ship']
+
+
+def test_modes():
+    m = (Matcher().add('anywhere', ['cat'])
+                  .add('word', ['dog'], matcher.WORD)
+                  .add('whole', ['a bird'], matcher.EXACT))
+    assert m.search('Concatenate') == Match('anywhere', 'cat')
+    assert m.search('hotdog stand') is None
+    assert m.search('a Dog here') == Match('word', 'dog')
+    assert m.search('a bird on a wire') is None
+    assert m.search('A Bird') == Match('whole', 'a bird')
+
+
+def test_search_many_reports_the_text():
+    m = Matcher().add('category', ['flags'])
+    assert m.search_many(['Category:Boats', 'Category:Flags of Europe']) == (
+        'Category:Flags of Europe', Match('category', 'flags'))
+    assert m.search_many(['Category:Boats']) is None
+
+
+def test_same_text_in_several_modes():
+    # An exact or whole-word entry doesn't hide a substring one
+    m = Matcher().add('tag', ['black'], matcher.EXACT).add('badword', ['black'])
+    assert m.search('blackboard') == Match('badword', 'black')
+    m = Matcher().add('extra', ['gun'], matcher.WORD).add('badword', ['gun'])
+    assert m.search('shotgun') == Match('badword', 'gun')
+    assert m.search('a gun').pattern == 'gun'
+
+
+def test_first_rule_wins_within_a_mode():
+    m = Matcher().add('badword', ['nazi']).add('category', ['nazi'])
+    assert m.search('Nazi rally') == Match('badword', 'nazi')
+
+
+def _texts(rng, dirt):
+    "Random texts, a third of them with something blacklisted in the middle"
+    for i in range(300):
+        words = [rng.choice(WORDS) for j in range(rng.randint(1, 8))]
+        if i % 3 == 0:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(dirt))
+        yield ' '.join(words)
+
+
+def test_compiled_filters_agree_with_the_old_checks():
+    rng = random.Random(0)
+    word_filter = common.get_word_filter()
+    filters = common.get_filters()
+    badwords = sorted(word_filter.blacklist)
+    phrases = sorted(common.blacklisted_phrases)
+    categories = common.category_blacklist
+    for text in _texts(rng, badwords):
+        assert (filters['text'].search(text) is not None) == word_filter.blacklisted(text)
+    for text in _texts(rng, badwords + phrases):
+        old = word_filter.blacklisted(text) or any(phrase in text.lower() for phrase in phrases)
+        assert (filters['description'].search(text) is not None) == old
+    for text in _texts(rng, [category.title() for category in categories]):
+        old = any(category in text.lower() for category in categories)
+        assert (filters['categories'].search_many([text]) is not None) == old
+    for text in _texts(rng, badwords + categories):
+        old = (word_filter.blacklisted(text.lower()) or
+               any(category in text for category in categories))
+        assert (filters['usage'].search_many([text]) is not None) == old
+
+
+def test_usage_matching_ignores_case():
+    # The old check only caught blacklisted categories in lower case, so it
+    # let through pages named after them
+    assert common.get_filters()['usage'].search_many(['Racism in the United States'])
@@ -0,0 +1,109 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the on-disk store for downloaded pictures
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import itertools
+import os
+import time
+
+import pytest
+
+from picdescbot import mediastore
+
+
+def _writer(data):
+    return lambda f: f.write(data)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "Every call is a second later, so the least recently used is always clear"
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(mediastore.time, 'time', lambda: float(next(ticks)))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = mediastore.MediaStore(str(tmp_path / 'media'), max_bytes=250)
+    yield store
+    store.close()
+
+
+def _objects(store):
+    return [name for directory in os.listdir(store.objects)
+            for name in os.listdir(os.path.join(store.objects, directory))]
+
+
+def test_same_content_is_stored_once(store):
+    first = store.add('https://example.com/a.jpg', _writer(b'a' * 100))
+    second = store.add('https://example.com/copy-of-a.jpg', _writer(b'a' * 100))
+    assert first == second
+    assert store.size() == 100 and _objects(store) == [first]
+    with store.open('https://example.com/copy-of-a.jpg') as f:
+        assert f.read() == b'a' * 100
+    assert store.open('https://example.com/b.jpg') is None
+
+
+def test_least_recently_used_are_evicted(store, clock):
+    store.add('a', _writer(b'a' * 100))
+    store.add('b', _writer(b'b' * 100))
+    store.open('a').close()
+    store.add('c', _writer(b'c' * 100))
+    assert 'a' in store and 'c' in store and 'b' not in store
+    assert store.size() == 200 and len(_objects(store)) == 2
+
+
+def test_a_picture_bigger_than_the_store_is_kept(store):
+    store.add('a', _writer(b'a' * 100))
+    store.add('big', _writer(b'b' * 1000))
+    assert 'big' in store and 'a' not in store
+
+
+def test_deleted_pictures_are_forgotten(store):
+    digest = store.add('a', _writer(b'a' * 100))
+    os.unlink(store._object_path(digest))
+    assert 'a' not in store
+    assert store.open('a') is None
+    assert store.size() == 0
+
+
+def test_fetch(store):
+    downloads = []
+
+    def download(f):
+        downloads.append(1)
+        f.write(b'picture')
+
+    for i in range(3):
+        with store.fetch('a', download) as f:
+            assert f.read() == b'picture'
+    assert len(downloads) == 1
+    assert store.stats() == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3}
+
+
+def test_failed_downloads_leave_nothing_behind(store):
+    def download(f):
+        f.write(b'half a picture')
+        raise IOError("connection reset")
+
+    with pytest.raises(IOError):
+        store.add('a', download)
+    assert 'a' not in store
+    assert os.listdir(store.tmp) == [] and _objects(store) == []
+
+
+def test_stale_temporary_files_are_removed(tmp_path):
+    path = str(tmp_path / 'media')
+    mediastore.MediaStore(path).close()
+    stale = os.path.join(path, mediastore.TMP_DIR, 'stale')
+    fresh = os.path.join(path, mediastore.TMP_DIR, 'fresh')
+    for name in (stale, fresh):
+        with open(name, 'wb') as f:
+            f.write(b'partial')
+    old = time.time() - mediastore.STALE_TMP - 1
+    os.utime(stale, (old, old))
+    mediastore.MediaStore(path).close()
+    assert os.listdir(os.path.join(path, mediastore.TMP_DIR)) == ['fresh']
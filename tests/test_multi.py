@@ -0,0 +1,65 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests running several bot accounts in one process
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import pytest
+
+from picdescbot import common, multi, seen
+
+
+class FakeClient(object):
+    "Hands out the given captions as pictures, marking them described like CVAPIClient"
+
+    def __init__(self, index, captions):
+        self.seen = index
+        self.captions = list(captions)
+        self.fetched = 0
+
+    def get_picture_and_description(self):
+        caption = self.captions.pop(0)
+        self.fetched += 1
+        title = 'File:{0}.jpg'.format(caption)
+        self.seen.record(title, seen.DESCRIBED)
+        return common.Result(caption, [], 'https://example.com/' + caption,
+                             'https://example.com/wiki/' + title, title=title)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = seen.SeenIndex(str(tmp_path / 'seen.db'), capacity=1000)
+    yield index
+    index.close()
+
+
+def _tenant(name, blacklist=()):
+    return multi.Tenant(name, [], None, blacklist)
+
+
+def test_spares_go_to_other_tenants(index):
+    client = FakeClient(index, ['a dog', 'a cat'])
+    supply = multi.Supply(client)
+    no_dogs, anything = _tenant('no dogs', ['dog']), _tenant('anything')
+    assert supply.get(no_dogs).caption == 'a cat'
+    # Not described as far as anyone else knows, until it's taken
+    assert 'File:a dog.jpg' not in index
+    assert supply.get(anything).caption == 'a dog'
+    assert client.fetched == 2
+    assert index.get('File:a dog.jpg') == (seen.DESCRIBED, None)
+
+
+def test_dropped_spares_can_be_found_again(index):
+    client = FakeClient(index, ['a dog', 'two dogs', 'three dogs', 'a cat'])
+    supply = multi.Supply(client, size=2)
+    assert supply.get(_tenant('no dogs', ['dog', 'dogs'])).caption == 'a cat'
+    assert [result.caption for added, result in supply.spare] == ['two dogs', 'three dogs']
+    assert not any('File:{0}.jpg'.format(caption) in index
+                   for caption in ['a dog', 'two dogs', 'three dogs'])
+
+
+def test_gives_up(index):
+    supply = multi.Supply(FakeClient(index, ['a dog'] * 3), max_tries=3)
+    with pytest.raises(Exception):
+        supply.get(_tenant('no dogs', ['dog']))
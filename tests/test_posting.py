@@ -0,0 +1,81 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests posting to all the providers at once
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import threading
+
+from picdescbot import posting, renditions, tumblr, twitter
+
+CREDENTIALS = {'consumer_key': 'key', 'consumer_secret': 'secret',
+               'token': 'token', 'token_secret': 'token secret', 'blog_id': 'blog'}
+
+
+class Provider(object):
+    def __init__(self, name, send, timeout=5, uploads=False):
+        self.name = name
+        self.send = send
+        self.timeout = timeout
+        self.uploads = uploads
+        self.rendition = renditions.Rendition(1000, 10**6)
+
+
+class Result(object):
+    def __init__(self):
+        self.url = 'https://example.com/a.jpg'
+        self.title = 'File:A.jpg'
+        self.released = 0
+        self.prefetched = None
+
+    def release_picture(self):
+        self.released += 1
+
+    def prefetch_pictures(self, renditions):
+        self.prefetched = renditions
+        raise Exception("The picture server is down")
+
+
+def _fail(result):
+    raise Exception("Nope")
+
+
+def test_load_policy():
+    assert posting.load_policy({}) == posting.Policy(3, 5, posting.DEFAULT_TIMEOUT)
+    assert posting.load_policy({'retries': '5', 'retry_delay': '0.5',
+                                'timeout': '60'}) == posting.Policy(5, 0.5, 60)
+
+
+def test_providers_use_the_policy():
+    config = dict(CREDENTIALS, retries='7', timeout='30')
+    for provider in (twitter.Client(config), tumblr.Client(config)):
+        assert (provider.retries, provider.retry_delay, provider.timeout) == (7, 5, 30)
+
+
+def test_post_to_every_provider():
+    result = Result()
+    outcomes = posting.post([Provider('one', lambda result: 1),
+                             Provider('two', _fail),
+                             Provider('three', lambda result: 3)], result)
+    assert [(outcome.provider, outcome.status_id) for outcome in outcomes] == [
+        ('one', 1), ('two', None), ('three', 3)]
+    assert outcomes[1].error == 'Nope'
+    assert result.released == 1
+
+
+def test_a_provider_that_times_out_is_left_behind():
+    result = Result()
+    release = threading.Event()
+    outcomes = posting.post([Provider('slow', lambda result: release.wait(10), timeout=0.1),
+                             Provider('fast', lambda result: 2)], result)
+    release.set()
+    assert [outcome.error for outcome in outcomes] == ['timed out', None]
+    # The slow one might still be reading the picture
+    assert result.released == 0
+
+
+def test_prefetch_only_for_uploads_and_never_fails():
+    result = Result()
+    posting.prefetch([Provider('uploads', None, uploads=True), Provider('links', None)], result)
+    assert len(result.prefetched) == 1
@@ -0,0 +1,84 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests rate limiting
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import email.utils
+import threading
+import time
+
+from picdescbot import common, ratelimit, replay
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _set_event():
+    event = threading.Event()
+    event.set()
+    return event
+
+
+def test_backoff_is_capped():
+    for attempt in range(20):
+        assert 0 <= ratelimit.backoff(attempt, base=1, cap=30) <= 30
+
+
+def test_parse_retry_after():
+    assert ratelimit.parse_retry_after('12') == 12
+    assert ratelimit.parse_retry_after('-3') == 0
+    assert ratelimit.parse_retry_after(None) is None
+    assert ratelimit.parse_retry_after('soon') is None
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < ratelimit.parse_retry_after(date) <= 60
+
+
+def test_burst_then_wait():
+    limiter = ratelimit.RateLimiter(0.01, burst=3)
+    assert all(limiter.acquire() for i in range(3))
+    # The next token is 100 seconds away
+    assert not limiter.acquire(_set_event())
+
+
+def test_429_blocks_and_slows_down():
+    limiter = ratelimit.RateLimiter(100)
+    assert limiter.update(Response(429, {'Retry-After': '30'})) == 30
+    assert limiter.local_state['rate'] == 50
+    assert not limiter.acquire(_set_event())
+    # Successes bring the rate back up, but not past what's configured
+    for i in range(100):
+        limiter.update(Response(200))
+    assert limiter.local_state['rate'] == 100
+
+
+def test_quota_headers():
+    limiter = ratelimit.RateLimiter(100)
+    assert limiter.update(Response(200, {'X-RateLimit-Remaining': '0',
+                                         'X-RateLimit-Reset': '20'})) == 20
+    assert limiter.update(Response(200, {'X-RateLimit-Remaining': '5',
+                                         'X-RateLimit-Reset': '20'})) is None
+
+
+def test_processes_share_the_limit(tmp_path):
+    path = str(tmp_path / 'rate.json')
+    first = ratelimit.RateLimiter(100, path=path)
+    second = ratelimit.RateLimiter(100, path=path)
+    assert second.acquire(_set_event())
+    first.update(Response(429, {'Retry-After': '60'}))
+    assert not second.acquire(_set_event())
+
+
+def test_describe_picture_waits_out_a_429(fixtures, monkeypatch):
+    monkeypatch.setattr(common, 'MEDIAWIKI_API', common.MEDIAWIKI_API)
+    with replay.ReplayServer(fixtures, rate_limit_every=2, retry_after=0.1) as server:
+        cvapi = common.CVAPIClient('test', server.install(),
+                                   limiter=ratelimit.RateLimiter(1000))
+        url = server.url + '/upload/wikipedia/commons/a/ab/Picture_{0}.jpg'
+        assert cvapi.describe_picture(url.format(1)) is not None
+        assert cvapi.describe_picture(url.format(2)) is not None
+    assert server.calls['429'] == 1 and server.calls['cv'] == 3
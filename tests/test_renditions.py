@@ -0,0 +1,50 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests picking the size of a picture
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+from picdescbot import renditions
+
+URL = 'https://upload.wikimedia.org/wikipedia/commons/a/ab/Boat.jpg'
+THUMB = 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Boat.jpg/{0}px-Boat.jpg'
+
+
+def _info(width, height, size, thumburl=THUMB.format(1080)):
+    return {'url': URL, 'thumburl': thumburl, 'width': width, 'height': height,
+            'size': size, 'mediatype': 'BITMAP'}
+
+
+def test_small_pictures_are_used_as_they_are():
+    assert renditions.select(_info(800, 600, 100000), renditions.Rendition(1024, 10**6)) == URL
+
+
+def test_thumbnails_snap_to_cached_widths():
+    rendition = renditions.Rendition(1024, 10**7)
+    assert renditions.select(_info(4000, 3000, 2 * 10**6), rendition) == THUMB.format(1280)
+    # Nothing cached is close enough
+    rendition = renditions.Rendition(700, 10**7)
+    assert renditions.select(_info(4000, 3000, 2 * 10**6), rendition) == THUMB.format(700)
+
+
+def test_big_files_are_scaled_down_to_fit():
+    rendition = renditions.Rendition(4096, 5 * 10**6)
+    assert renditions.select(_info(4000, 3000, 20 * 10**6), rendition) == THUMB.format(1920)
+
+
+def test_long_narrow_pictures_keep_a_usable_short_edge():
+    rendition = renditions.Rendition(1024, 10**7, min_size=50)
+    assert renditions.select(_info(10000, 100, 10**6), rendition) == THUMB.format(5000)
+
+
+def test_without_a_thumbnail_the_original_is_used():
+    assert renditions.select(_info(4000, 3000, 10**6, thumburl=None),
+                             renditions.Rendition(1024, 10**6)) == URL
+
+
+def test_from_config_and_picture_info():
+    rendition = renditions.from_config({'rendition_size': '640'}, renditions.Rendition(1024, 99, 50))
+    assert (rendition.size, rendition.max_bytes, rendition.min_size) == (640, 99, 50)
+    assert renditions.picture_info(_info(1, 2, 3)) == {'url': URL, 'thumburl': THUMB.format(1080),
+                                                       'width': 1, 'height': 2, 'size': 3}
@@ -0,0 +1,97 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the record/replay harness
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import pytest
+
+from picdescbot import common, replay
+
+
+def _url(number):
+    return replay.UPLOAD_URL + 'wikipedia/commons/a/ab/Picture_{0}.jpg'.format(number)
+
+
+def test_get_picture_and_description(cvapi, server, fixtures):
+    result = cvapi.get_picture_and_description()
+    assert result.title.startswith('File:Picture ')
+    assert result.caption in [captions['description']['captions'][0]['text']
+                              for captions in fixtures.cv.values()]
+    assert server.calls['mediawiki'] >= 1 and server.calls['cv'] == 1
+    picture = result.download_picture()
+    try:
+        assert len(picture.read()) == 1024
+    finally:
+        picture.close(really=True)
+        result.release_picture()
+
+
+def test_unrecorded_titles_are_answered_from_the_pages(server):
+    pic = common.get_picture('Picture 3.jpg')
+    assert pic['title'] == 'File:Picture 3.jpg'
+    assert common.get_picture('Not there.jpg') is None
+
+
+def test_rate_limiting(fixtures):
+    with replay.ReplayServer(fixtures, rate_limit_every=2, retry_after=7) as server:
+        first = common.get_session().get(server.api_url, params={'generator': 'random'})
+        second = common.get_session().get(server.api_url, params={'generator': 'random'})
+    assert first.status_code == 200
+    assert second.status_code == 429 and second.headers['Retry-After'] == '7'
+    assert server.calls['429'] == 1
+
+
+def test_pictures_are_served_in_ranges(server, fixtures):
+    path = next(iter(fixtures.images))
+    data = fixtures.read_image(path)
+    response = common.get_session().get(server.url + '/upload' + path,
+                                        headers={'Range': 'bytes=1000-'})
+    assert response.status_code == 206
+    assert response.content == data[1000:]
+
+
+def test_fixture_backend(fixtures):
+    backend = replay.FixtureBackend(fixtures)
+    assert backend.describe(_url(1)) == fixtures.cv['Picture_1.jpg']
+    # Thumbnails get the description of the original
+    thumbnail = _url(1).replace('/commons/', '/commons/thumb/') + '/640px-Picture_1.jpg'
+    assert backend.describe(thumbnail) == fixtures.cv['Picture_1.jpg']
+    with pytest.raises(Exception):
+        backend.describe(_url(1000))
+    descriptions = backend.describe_batch([_url(2), _url(1000), _url(3)])
+    assert [description.error is None for description in descriptions] == [True, False, True]
+
+
+def test_recorder(cvapi, server, tmp_path):
+    recorder = replay.Recorder(str(tmp_path / 'recorded'))
+    recorder.attach(common.get_session())
+    try:
+        cvapi.describe_picture(server.url + '/upload/wikipedia/commons/a/ab/Picture_2.jpg')
+        common.get_picture('Picture 2.jpg')
+    finally:
+        recorder.detach(common.get_session())
+    recorder.save()
+    recorded = replay.Fixtures.load(str(tmp_path / 'recorded'))
+    assert list(recorded.cv) == ['Picture_2.jpg']
+    assert recorded.mediawiki[0]['params']['titles'] == 'File:Picture 2.jpg'
+
+
+def test_describe_bytes(cvapi, fixtures, server):
+    data = fixtures.read_image(next(iter(fixtures.images)))
+    result = cvapi.describe_picture(data)
+    assert result['description']['captions']
+    assert server.calls['cv'] == 1
+    assert replay.FixtureBackend(fixtures).describe(data) == result
+
+
+def test_record_bytes(cvapi, fixtures, server, tmp_path):
+    recorder = replay.Recorder(str(tmp_path / 'recorded'))
+    recorder.attach(common.get_session())
+    try:
+        data = fixtures.read_image(next(iter(fixtures.images)))
+        cvapi.describe_picture(data)
+    finally:
+        recorder.detach(common.get_session())
+    assert list(recorder.fixtures.cv) == [replay._content_key(data)]
@@ -0,0 +1,83 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the queue of vetted pictures
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import threading
+
+from picdescbot import common, resultqueue
+
+
+def _result(n):
+    return common.Result('a boat {0}'.format(n), ['boat'], 'https://example.com/{0}.jpg'.format(n),
+                         'https://commons.wikimedia.org/{0}'.format(n), 'File:{0}.jpg'.format(n))
+
+
+def test_pop_is_fifo(tmp_path):
+    queue = resultqueue.ResultQueue(str(tmp_path / 'queue.db'))
+    for n in range(3):
+        queue.push(_result(n))
+    assert len(queue) == 3
+    assert [queue.pop().title for n in range(3)] == ['File:0.jpg', 'File:1.jpg', 'File:2.jpg']
+    assert queue.pop() is None
+    queue.close()
+
+
+def test_stale_results_expire(tmp_path, monkeypatch):
+    queue = resultqueue.ResultQueue(str(tmp_path / 'queue.db'), max_age=60)
+    now = resultqueue.time.time()
+    monkeypatch.setattr(resultqueue.time, 'time', lambda: now - 120)
+    queue.push(_result(0))
+    monkeypatch.setattr(resultqueue.time, 'time', lambda: now)
+    queue.push(_result(1))
+    assert len(queue) == 1
+    assert queue.pop().title == 'File:1.jpg'
+    assert queue.pop() is None
+    queue.push(_result(2))
+    monkeypatch.setattr(resultqueue.time, 'time', lambda: now + 61)
+    assert queue.expire() == 1
+    queue.close()
+
+
+def test_results_survive_reopening(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    queue = resultqueue.ResultQueue(path)
+    queue.push(_result(0))
+    queue.close()
+    queue = resultqueue.ResultQueue(path)
+    result = queue.pop()
+    assert (result.caption, result.tags, result.source_url) == (
+        'a boat 0', ['boat'], 'https://commons.wikimedia.org/0')
+    queue.close()
+
+
+def test_posters_never_get_the_same_result(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    queue = resultqueue.ResultQueue(path)
+    for n in range(50):
+        queue.push(_result(n))
+    popped = []
+
+    def poster():
+        mine = resultqueue.ResultQueue(path)
+        result = mine.pop()
+        while result is not None:
+            popped.append(result.title)
+            result = mine.pop()
+        mine.close()
+    threads = [threading.Thread(target=poster) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(popped) == sorted('File:{0}.jpg'.format(n) for n in range(50))
+    queue.close()
+
+
+def test_fill_up_to_the_high_watermark(tmp_path, cvapi):
+    queue = resultqueue.ResultQueue(str(tmp_path / 'queue.db'), low=1, high=3)
+    resultqueue.fill(queue, cvapi)
+    assert len(queue) == 3
+    queue.close()
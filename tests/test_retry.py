@@ -0,0 +1,166 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the retry budgets, deadlines and circuit breakers
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import threading
+import time
+
+import pytest
+
+from picdescbot import common, retry
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry.time, 'time', clock)
+    return clock
+
+
+def _open(breaker):
+    for i in range(breaker.threshold):
+        breaker.before_request()
+        breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = retry.CircuitBreaker('test', threshold=3, reset_timeout=60)
+    breaker.before_request()
+    breaker.record_failure()
+    breaker.record_success()  # Not in a row
+    _open(breaker)
+    with pytest.raises(retry.CircuitOpen):
+        breaker.before_request()
+
+
+def test_half_open_lets_one_request_through(clock):
+    breaker = retry.CircuitBreaker('test', threshold=1, reset_timeout=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.before_request()
+    assert breaker.state == breaker.HALF_OPEN
+    with pytest.raises(retry.CircuitOpen):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    breaker.before_request()
+
+
+def test_failed_check_opens_again(clock):
+    breaker = retry.CircuitBreaker('test', threshold=5, reset_timeout=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    clock.now += 59
+    with pytest.raises(retry.CircuitOpen):
+        breaker.before_request()
+
+
+def test_released_check_lets_another_through(clock):
+    breaker = retry.CircuitBreaker('test', threshold=1, reset_timeout=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.before_request()
+    breaker.release()
+    breaker.before_request()
+    assert breaker.state == breaker.HALF_OPEN
+
+
+def test_forgotten_check_times_out(clock):
+    breaker = retry.CircuitBreaker('test', threshold=1, reset_timeout=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.before_request()  # Never heard from again
+    clock.now += 30
+    with pytest.raises(retry.CircuitOpen):
+        breaker.before_request()
+    clock.now += 30
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+
+
+def test_retry_budget(clock):
+    budget = retry.RetryBudget(ratio=0.5, minimum=2, window=60)
+    assert budget.can_retry() and budget.can_retry()
+    assert not budget.can_retry()
+    for i in range(4):
+        budget.record_request()
+    assert budget.can_retry() and budget.can_retry()
+    assert not budget.can_retry()
+    # Everything is forgotten after the window
+    clock.now += 61
+    assert budget.can_retry() and budget.can_retry()
+    assert not budget.can_retry()
+
+
+def test_deadline():
+    parent = retry.Deadline(1)
+    deadline = retry.Deadline(60, parent)
+    assert 0 < deadline.remaining() <= 1
+    assert retry.Deadline().remaining() is None
+    deadline.check()
+    deadline.set()
+    assert deadline.is_set() and not parent.is_set()
+    with pytest.raises(retry.DeadlineExceeded):
+        deadline.check()
+    parent.set()
+    with pytest.raises(retry.DeadlineExceeded):
+        retry.Deadline(60, parent).check()
+
+
+def test_deadline_wait():
+    parent = retry.Deadline()
+    deadline = retry.Deadline(60, parent)
+    assert not deadline.wait(0.05)
+    timer = threading.Timer(0.05, deadline.set)
+    timer.start()
+    start = time.time()
+    assert deadline.wait(30)
+    assert time.time() - start < 5
+    timer.join()
+    assert deadline.waited >= 0.09
+    assert parent.waited == deadline.waited
+
+
+def test_client_errors_close_the_circuit(cvapi, server, upstreams):
+    breaker = upstreams['cv'].breaker
+    _open(breaker)
+    breaker.opened -= breaker.reset_timeout
+    # Nothing was recorded for this picture, so the server says 404
+    assert cvapi.describe_picture(b'not a picture') is None
+    assert server.calls['cv'] == 1
+    assert breaker.state == breaker.CLOSED
+    assert cvapi.describe_picture(server.url + '/upload/wikipedia/commons/a/ab/Picture_1.jpg')
+
+
+class Closed(object):
+    "A rate limiter that never lets anyone through, as if cancelled while waiting"
+
+    def acquire(self, cancelled=None):
+        return False
+
+
+def test_cancelled_check_is_released(server, upstreams):
+    cvapi = common.CVAPIClient('test', server.cv_endpoint, limiter=Closed())
+    breaker = upstreams['cv'].breaker
+    _open(breaker)
+    breaker.opened -= breaker.reset_timeout
+    assert cvapi.describe_picture(b'not a picture') is None
+    assert server.calls['cv'] == 0
+    breaker.before_request()
+    assert breaker.state == breaker.HALF_OPEN
@@ -0,0 +1,73 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests preparing pictures in the background
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import itertools
+import threading
+
+import pytest
+
+from picdescbot import review
+
+
+def test_get_in_order():
+    counter = itertools.count()
+    prefetcher = review.Prefetcher(lambda: next(counter), depth=2)
+    try:
+        assert [prefetcher.get() for i in range(5)] == list(range(5))
+    finally:
+        prefetcher.close()
+
+
+def test_errors_raised_by_get():
+    def produce():
+        raise ValueError("no pictures")
+    prefetcher = review.Prefetcher(produce, depth=1)
+    try:
+        with pytest.raises(ValueError):
+            prefetcher.get()
+    finally:
+        prefetcher.close()
+
+
+def test_close_keeps_everything_produced():
+    counter = itertools.count()
+    started = threading.Event()
+    release = threading.Event()
+
+    def produce():
+        value = next(counter)
+        if value == 2:
+            # Still preparing this one when we're closed
+            started.set()
+            release.wait(5)
+        return value
+
+    prefetcher = review.Prefetcher(produce, depth=2)
+    assert prefetcher.get() == 0
+    started.wait(5)
+    threading.Timer(0.1, release.set).start()
+    leftovers = prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert leftovers == [1, 2]
+
+
+def test_close_with_full_queue():
+    counter = itertools.count()
+    waiting = threading.Event()
+
+    def produce():
+        value = next(counter)
+        if value == 2:
+            waiting.set()
+        return value
+
+    prefetcher = review.Prefetcher(produce, depth=2)
+    waiting.wait(5)
+    leftovers = prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    # The one it was waiting to put is kept too
+    assert leftovers == [0, 1, 2]
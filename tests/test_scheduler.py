@@ -0,0 +1,95 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the posting schedules
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import datetime
+import itertools
+import threading
+
+import pytest
+
+from picdescbot import scheduler
+
+
+def _next(expression, *when):
+    after = datetime.datetime(*when).timestamp()
+    return datetime.datetime.fromtimestamp(scheduler.Cron(expression).next_after(after))
+
+
+def test_cron_steps():
+    assert _next('*/15 * * * *', 2024, 1, 1, 12, 7) == datetime.datetime(2024, 1, 1, 12, 15)
+
+
+def test_cron_is_strictly_after():
+    assert _next('*/15 * * * *', 2024, 1, 1, 12, 15) == datetime.datetime(2024, 1, 1, 12, 30)
+
+
+def test_cron_weekday():
+    # 2024-01-01 is a monday, so the next 9:30 on a monday is a week later
+    assert _next('30 9 * * 1', 2024, 1, 1, 10, 0) == datetime.datetime(2024, 1, 8, 9, 30)
+
+
+def test_cron_day_of_month_or_weekday():
+    # Either day field matches, like in cron. 2024-01-07 is a sunday.
+    assert _next('0 0 1 * 0', 2024, 1, 2) == datetime.datetime(2024, 1, 7)
+
+
+def test_cron_skips_months():
+    assert _next('0 8 1 6 *', 2024, 1, 15) == datetime.datetime(2024, 6, 1, 8, 0)
+
+
+def test_cron_rejects_bad_expressions():
+    with pytest.raises(ValueError):
+        scheduler.Cron('* * *')
+    with pytest.raises(ValueError):
+        scheduler.Cron('61 * * * *')
+    with pytest.raises(ValueError):
+        scheduler.Cron('0 0 31 2 *').next_after(0)
+
+
+def test_parse_schedule():
+    assert isinstance(scheduler.parse_schedule('90m'), scheduler.Interval)
+    assert scheduler.parse_schedule('90m').next_after(0) == 5400
+    assert isinstance(scheduler.parse_schedule('0 * * * *'), scheduler.Cron)
+
+
+def test_daemon_prepares_ahead_and_posts_every_slot():
+    posted = []
+    prepared = itertools.count()
+    stop = threading.Event()
+
+    def post(result):
+        posted.append(result)
+        if len(posted) == 3:
+            stop.set()
+    daemon = scheduler.Daemon(scheduler.Interval(0.05), lambda: next(prepared), post,
+                              lead=0.02, stop=stop)
+    thread = threading.Thread(target=daemon.run, args=(False,))
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert posted == [0, 1, 2]
+
+
+def test_daemon_skips_a_slot_it_has_nothing_for():
+    posted = []
+    stop = threading.Event()
+    results = iter([None, 'picture'])
+
+    def prepare():
+        result = next(results)
+        if result is None:
+            raise Exception("No picture")
+        return result
+
+    def post(result):
+        posted.append(result)
+        stop.set()
+    daemon = scheduler.Daemon(scheduler.Interval(0.05), prepare, post, lead=0.02, stop=stop)
+    thread = threading.Thread(target=daemon.run, args=(False,))
+    thread.start()
+    thread.join(10)
+    assert posted == ['picture']
@@ -0,0 +1,95 @@
+# coding=utf-8
+# picdescbot: a tiny twitter/tumblr bot that tweets random pictures from wikipedia and their descriptions
+# this file tests the index of pictures the bot has already seen
+# Copyright (C) 2017 Elad Alfassa <elad@fedoraproject.org>
+
+from __future__ import unicode_literals, absolute_import, print_function
+
+import struct
+
+from picdescbot import seen
+
+
+def _false_positives(index, count=2000):
+    return sum(index.bloom.__contains__('File:Unseen {0}.jpg'.format(i)) for i in range(count)) / count
+
+
+def test_record_and_get(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    index = seen.SeenIndex(path, capacity=1000)
+    index.record('File:A.jpg', seen.REJECTED, 'too small')
+    index.record('File:B.jpg', seen.DESCRIBED)
+    index.record('File:B.jpg', seen.POSTED)
+    assert index.get('File:A.jpg') == (seen.REJECTED, 'too small')
+    assert 'File:B.jpg' in index and 'File:C.jpg' not in index
+    index.close()
+    index = seen.SeenIndex(path, capacity=1000)
+    assert index.get('File:B.jpg') == (seen.POSTED, None)
+    assert index.count == 2
+    index.close()
+
+
+def test_forget(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    index = seen.SeenIndex(path, capacity=1000)
+    index.record('File:A.jpg', seen.DESCRIBED)
+    index.record('File:B.jpg', seen.DESCRIBED)
+    index.forget('File:A.jpg')
+    index.forget('File:Never seen.jpg')
+    assert 'File:A.jpg' not in index and index.get('File:A.jpg') is None
+    assert index.get('File:B.jpg') == (seen.DESCRIBED, None)
+    index.close()
+    index = seen.SeenIndex(path, capacity=1000)
+    assert 'File:A.jpg' not in index
+    index.close()
+
+
+def test_the_bloom_filter_grows_with_the_keys(tmp_path):
+    index = seen.SeenIndex(str(tmp_path / 'seen.db'), capacity=100)
+    for i in range(1000):
+        index.record('File:{0}.jpg'.format(i), seen.REJECTED)
+    assert index.bloom.capacity >= 1000
+    assert all('File:{0}.jpg'.format(i) in index for i in range(1000))
+    assert _false_positives(index) < 0.05
+    index.close()
+
+
+def test_a_bigger_capacity_rebuilds_the_bloom_filter(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    index = seen.SeenIndex(path, capacity=100)
+    for i in range(50):
+        index.record('File:{0}.jpg'.format(i), seen.REJECTED)
+    index.close()
+    index = seen.SeenIndex(path, capacity=5000)
+    assert index.bloom.capacity == 5000
+    assert all('File:{0}.jpg'.format(i) in index for i in range(50))
+    index.close()
+
+
+def test_old_bloom_filters_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    index = seen.SeenIndex(path, capacity=100)
+    index.record('File:A.jpg', seen.REJECTED)
+    index.close()
+    # The old header had no capacity, and the filter is empty
+    with open(path + '.bloom', 'r+b') as f:
+        f.write(struct.pack('<8sQQ', b'PDBLOOM1', 1000, 7))
+        f.write(bytes(1000 // 8 + 1))
+        f.truncate()
+    index = seen.SeenIndex(path, capacity=100)
+    assert index.bloom.capacity == 100
+    assert 'File:A.jpg' in index
+    index.close()
+
+
+def test_other_processes_pick_up_a_rebuilt_filter(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    first = seen.SeenIndex(path, capacity=100)
+    second = seen.SeenIndex(path, capacity=100)
+    for i in range(300):
+        first.record('File:{0}.jpg'.format(i), seen.REJECTED)
+    assert first.bloom.capacity > 100
+    assert all('File:{0}.jpg'.format(i) in second for i in range(300))
+    assert second.bloom.capacity == first.bloom.capacity
+    first.close()
+    second.close()